@@ -17,8 +17,37 @@
 # specific language governing permissions and limitations
 # under the License.
 
-from .detector import Detector
-from .ppocr import PPDetector
-from .yolov7.layout_analyzer import LayoutAnalyzer, save_layout_img
+import importlib
+from typing import TYPE_CHECKING
 
-from .cn_std import CnStd
+if TYPE_CHECKING:
+    from .detector import Detector
+    from .ppocr import PPDetector
+    from .yolov7.layout_analyzer import LayoutAnalyzer, save_layout_img
+
+    from .cn_std import CnStd
+    from .document_detector import DocumentDetector
+
+# public names and their modules; the modules (and torch, etc.) are only imported on first access
+_LAZY_ATTRS = {
+    'Detector': '.detector',
+    'PPDetector': '.ppocr',
+    'LayoutAnalyzer': '.yolov7.layout_analyzer',
+    'save_layout_img': '.yolov7.layout_analyzer',
+    'CnStd': '.cn_std',
+    'DocumentDetector': '.document_detector',
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
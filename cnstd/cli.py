@@ -18,15 +18,13 @@
 # under the License.
 
 import os
+import sys
 import click
 import json
 import time
-import glob
 
-from pprint import pformat
 import cv2
 import numpy as np
-import torchvision.transforms as T
 
 from .utils import rotate_page
 from .consts import MODEL_VERSION, MODEL_CONFIGS, AVAILABLE_MODELS
@@ -36,13 +34,19 @@ from .utils import (
     load_model_params,
     imsave,
     read_img,
-    pil_to_numpy,
+    to_uint8_hwc,
     plot_for_debugging,
+    IMG_EXTENSIONS,
+    iter_job_entries,
+    shard_index_of,
+    shard_output_path,
+    JobLog,
+    merge_job_logs,
+    imap_workers,
+    ThroughputMeter,
+    params_fingerprint,
 )
-from .datasets import StdDataModule
-from .trainer import PlTrainer, resave_model
-from .model import gen_model
-from . import CnStd, LayoutAnalyzer
+from . import CnStd
 from .yolov7.consts import CATEGORY_DICT
 
 _CONTEXT_SETTINGS = {"help_option_names": ['-h', '--help']}
@@ -86,6 +90,11 @@ def train(
     model_name, index_dir, train_config_fp, resume_from_checkpoint, pretrained_model_fp
 ):
     """训练文本检测模型"""
+    import torchvision.transforms as T
+    from .datasets import StdDataModule
+    from .trainer import PlTrainer
+    from .model import gen_model
+
     logger = set_logger(log_level='DEBUG')
     train_config = json.load(open(train_config_fp))
     fpn_type = train_config.get('fpn_type', 'fpn')
@@ -175,136 +184,366 @@ MODELS, _ = zip(*AVAILABLE_MODELS.all_models())
 MODELS = sorted(MODELS)
 
 
-@cli.command('predict')
-@click.option(
-    '-m',
-    '--model-name',
-    type=click.Choice(MODELS),
-    default=DEFAULT_MODEL_NAME,
-    help='模型名称。默认值为 %s' % DEFAULT_MODEL_NAME,
+# the number of worker processes, and the logging interval of the throughput
+_NUM_WORKERS_OPTION = click.option(
+    "-w", "--num-workers", type=int, default=1, help="并行处理的进程数。默认为 `1`，表示在当前进程中处理"
 )
-@click.option(
-    '-b',
-    '--model-backend',
-    type=click.Choice(['pytorch', 'onnx']),
-    default='onnx',
-    help='模型类型。默认值为 `onnx`',
+_LOG_INTERVAL_OPTION = click.option(
+    "--log-interval", type=float, default=10.0, help="每隔多少秒打印一次处理速度。默认为 `10`"
 )
-@click.option(
-    '-p',
-    '--pretrained-model-fp',
-    type=str,
-    default=None,
-    help='使用训练好的模型。默认为 `None`，表示使用系统自带的预训练模型',
-)
-@click.option("-r", "--rotated-bbox", is_flag=True, help="是否检测带角度（非水平和垂直）的文本框")
-@click.option(
-    "--resized-shape",
-    type=str,
-    default='768,768',
-    help='格式："height,width"; 预测时把图片resize到此大小再进行预测。两个值都需要是32的倍数。默认为 `768,768`',
-)
-@click.option(
-    "--box-score-thresh", type=float, default=0.3, help="检测结果只保留分数大于此值的文本框。默认值为 `0.3`"
-)
-@click.option(
-    "--preserve-aspect-ratio",
-    type=bool,
-    default=True,
-    help="resize时是否保留图片原始比例。默认值为 `True`",
-)
-@click.option(
-    "--context",
-    help="使用cpu还是 `gpu` 运行代码，也可指定为特定gpu，如`cuda:0`。默认为 `cpu`",
-    type=str,
-    default='cpu',
-)
-@click.option("-i", "--img-file-or-dir", help="输入图片的文件路径或者指定的文件夹")
-@click.option(
-    "-o", "--output-dir", default='./predictions', help="检测结果存放的文件夹。默认为 `./predictions`"
-)
-def predict(
+
+
+def _model_options(func):
+    """检测命令 `predict`、`evaluate` 和 `sweep` 共用的模型参数，由 `_std_params()` 转换为 `CnStd` 和 `detect()` 的参数。"""
+    options = [
+        click.option(
+            '-m',
+            '--model-name',
+            type=click.Choice(MODELS),
+            default=DEFAULT_MODEL_NAME,
+            help='模型名称。默认值为 %s' % DEFAULT_MODEL_NAME,
+        ),
+        click.option(
+            '-b',
+            '--model-backend',
+            type=click.Choice(['pytorch', 'onnx']),
+            default='onnx',
+            help='模型类型。默认值为 `onnx`',
+        ),
+        click.option(
+            '-p',
+            '--pretrained-model-fp',
+            type=str,
+            default=None,
+            help='使用训练好的模型。默认为 `None`，表示使用系统自带的预训练模型',
+        ),
+        click.option("-r", "--rotated-bbox", is_flag=True, help="是否检测带角度（非水平和垂直）的文本框"),
+        click.option(
+            "--resized-shape",
+            type=str,
+            default='768,768',
+            help='格式："height,width"; 预测时把图片resize到此大小再进行预测。两个值都需要是32的倍数。默认为 `768,768`',
+        ),
+        click.option(
+            "--preserve-aspect-ratio",
+            type=bool,
+            default=True,
+            help="resize时是否保留图片原始比例。默认值为 `True`",
+        ),
+        click.option(
+            "--context",
+            help="使用cpu还是 `gpu` 运行代码，也可指定为特定gpu，如`cuda:0`。默认为 `cpu`",
+            type=str,
+            default='cpu',
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _std_params(
     model_name,
     model_backend,
     pretrained_model_fp,
     rotated_bbox,
     resized_shape,
-    box_score_thresh,
     preserve_aspect_ratio,
     context,
-    img_file_or_dir,
-    output_dir,
+    **detect_kwargs,
 ):
-    """预测单个文件，或者指定目录下的所有图片"""
-    std = CnStd(
-        model_name,
+    """
+    `_model_options` 的参数对应的 `CnStd` 参数和 `detect()` 参数（`detect_kwargs` 为其他的 `detect()` 参数），
+    以及决定检测结果的参数（包括 cnstd 的版本，不包括 `context`），用于计算结果的指纹。
+    """
+    from .__version__ import __version__
+
+    resized_shape = list(map(int, resized_shape.split(',')))  # [H, W]
+    if len(resized_shape) == 1:
+        resized_shape.append(resized_shape[0])
+    std_kwargs = dict(
+        model_name=model_name,
         model_backend=model_backend,
         model_fp=pretrained_model_fp,
         rotated_bbox=rotated_bbox,
         context=context,
     )
+    detect_kwargs = dict(
+        resized_shape=tuple(resized_shape),
+        preserve_aspect_ratio=preserve_aspect_ratio,
+        **detect_kwargs,
+    )
+    params = dict(cnstd_version=__version__, **std_kwargs, **detect_kwargs)
+    params.pop('context')
+    return std_kwargs, detect_kwargs, params
 
-    resized_shape = list(map(int, resized_shape.split(',')))  # [H, W]
-    if len(resized_shape) == 1:
-        resized_shape.append(resized_shape[0])
 
-    # process image
-    if os.path.isfile(img_file_or_dir):
-        img_list = [img_file_or_dir]
-    elif os.path.isdir(img_file_or_dir):
-        fnames = glob.glob1(img_file_or_dir, "*g")
-        img_list = [os.path.join(img_file_or_dir, fn) for fn in fnames]
-    else:
-        raise TypeError(
-            'param "image_dir": %s is neither a file or a dir' % img_file_or_dir
+def _cache_prefix(output_dir, cache_dir, name, params):
+    """
+    缓存文件的路径前缀 `<cache_dir>/<name>-<参数的指纹>`，`cache_dir` 默认为 `<output_dir>/cache`；
+    参数存于 `<路径前缀>.params.json` 中以便查看。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    cache_dir = cache_dir or os.path.join(output_dir, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = os.path.join(cache_dir, '%s-%s' % (name, params_fingerprint(params)))
+    with open(prefix + '.params.json', 'w') as f:
+        json.dump(params, f, ensure_ascii=False, indent=2)
+    return prefix
+
+
+def _batch_job_options(func):
+    """批量任务 `predict` 和 `analyze` 共用的参数。"""
+    options = [
+        click.option(
+            "--manifest",
+            type=str,
+            default=None,
+            help="清单文件，每行一个图片路径（相对路径是相对于清单文件所在的文件夹）；指定后忽略 `-i`",
+        ),
+        click.option(
+            "--num-shards", type=int, default=1, help="按图片路径的哈希值把任务分成多少份。默认为 `1`"
+        ),
+        click.option(
+            "--shard-index",
+            type=int,
+            default=0,
+            help="当前任务处理第几份（从 0 开始），结果存于单独的文件中，可用 `cnstd merge` 合并。默认为 `0`",
+        ),
+        _NUM_WORKERS_OPTION,
+        click.option(
+            "--overwrite",
+            is_flag=True,
+            help="忽略已有的结果重新开始；默认从已有的结果文件继续，跳过已处理过的图片（输入或参数不同时会报错）",
+        ),
+        _LOG_INTERVAL_OPTION,
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _job_header(command, img_file_or_dir, manifest, params):
+    """批量任务的描述：输入和参数的指纹。参数不同的任务不能在同一个结果文件上继续。"""
+    return dict(
+        command=command,
+        input=os.path.abspath(manifest if manifest is not None else img_file_or_dir),
+        params=params_fingerprint(params),
+    )
+
+
+def _run_batch_job(
+    entries,
+    out_fp,
+    worker_fn,
+    *,
+    header,
+    num_shards,
+    shard_index,
+    num_workers,
+    overwrite,
+    log_interval,
+    initializer,
+    initargs,
+    finalizer=None,
+):
+    """
+    处理属于当前分片、且还没有结果的图片，每处理完一张图片就往 `out_fp` 中写入一行结果。
+    已有的结果文件若由 `header` 不同的任务写入，则拒绝继续；之前失败的图片会被重新处理。
+    """
+    if not 0 <= shard_index < num_shards:
+        raise click.BadParameter(
+            'shard_index should be in [0, %d), but got %d' % (num_shards, shard_index)
+        )
+    with JobLog(out_fp, resume=not overwrite, header=header) as job_log:
+        todo = (
+            (key, fp)
+            for key, fp in entries
+            if (num_shards == 1 or shard_index_of(key, num_shards) == shard_index)
+            and not job_log.is_done(key)
         )
+        results = imap_workers(
+            worker_fn,
+            todo,
+            num_workers=num_workers,
+            initializer=initializer,
+            initargs=initargs,
+            finalizer=finalizer,
+        )
+        meter = ThroughputMeter(log_interval=log_interval)
+        for record in results:
+            job_log.write(record)
+            meter.update(failed=int('error' in record))
+        meter.log()
+    logger.info('results are saved to %s' % out_fp)
 
-    start_time = time.time()
-    std_out = std.detect(
-        img_list,
-        resized_shape=tuple(resized_shape),
-        preserve_aspect_ratio=preserve_aspect_ratio,
-        box_score_thresh=box_score_thresh,
+
+def _safe_relpath(key):
+    """Relative file path from a job key, which stays inside the output directory."""
+    parts = [p for p in key.replace('\\', '/').split('/') if p not in ('', '.', '..')]
+    return os.path.join(*parts)
+
+
+@cli.command('predict')
+@_model_options
+@click.option(
+    "--box-score-thresh", type=float, default=0.3, help="检测结果只保留分数大于此值的文本框。默认值为 `0.3`"
+)
+@click.option("-i", "--img-file-or-dir", help="输入图片的文件路径或者指定的文件夹（会递归查找其中的所有图片）")
+@click.option(
+    "--extensions",
+    type=str,
+    default=','.join(ext[1:] for ext in IMG_EXTENSIONS),
+    help="指定文件夹时，只处理这些扩展名（不区分大小写）的文件。默认为 `%s`"
+    % ','.join(ext[1:] for ext in IMG_EXTENSIONS),
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    default='./predictions',
+    help="检测结果存放的文件夹，结果存于其中的 `predictions.jsonl`（分片时为 `predictions.shard-*.jsonl`），"
+    "每行对应一张图片。默认为 `./predictions`",
+)
+@click.option("--plot", is_flag=True, help="是否为每张图片画出检测结果，存放在输出文件夹中（后台画图，不影响检测速度）")
+@_batch_job_options
+def predict(
+    box_score_thresh,
+    img_file_or_dir,
+    extensions,
+    output_dir,
+    plot,
+    manifest,
+    num_shards,
+    shard_index,
+    num_workers,
+    overwrite,
+    log_interval,
+    **model_options,
+):
+    """
+    预测单个文件、指定目录下的所有图片，或者清单文件中的所有图片。每处理完一张图片，就往结果文件中写入一行 JSON。
+    任务被中断后，使用相同的参数再次运行，会跳过已处理过的图片继续处理
+    """
+    std_kwargs, detect_kwargs, params = _std_params(
+        box_score_thresh=box_score_thresh, **model_options
     )
-    time_cost = time.time() - start_time
-    logger.info(
-        '%d files are detected by cnstd, total time cost: %f, mean time cost: %f'
-        % (len(img_list), time_cost, time_cost / len(img_list))
+    entries = _job_entries(img_file_or_dir, manifest, extensions)
+
+    os.makedirs(output_dir, exist_ok=True)
+    plot_dir = output_dir if plot else None
+    _run_batch_job(
+        entries,
+        shard_output_path(output_dir, 'predictions', num_shards, shard_index),
+        _predict_one,
+        header=_job_header('predict', img_file_or_dir, manifest, params),
+        num_shards=num_shards,
+        shard_index=shard_index,
+        num_workers=num_workers,
+        overwrite=overwrite,
+        log_interval=log_interval,
+        initializer=_init_predict_worker,
+        initargs=(std_kwargs, detect_kwargs, num_workers, plot_dir),
+        finalizer=_finish_predict_worker,
+    )
+
+
+def _job_entries(img_file_or_dir, manifest, extensions=None):
+    if manifest is None:
+        if img_file_or_dir is None or not os.path.exists(img_file_or_dir):
+            raise TypeError(
+                'param "image_dir": %s is neither a file or a dir' % img_file_or_dir
+            )
+    elif not os.path.isfile(manifest):
+        raise FileNotFoundError(manifest)
+    if extensions is None:
+        extensions = IMG_EXTENSIONS
+    else:
+        extensions = ['.' + ext.strip().lstrip('.') for ext in extensions.split(',')]
+    return iter_job_entries(img_file_or_dir, manifest, extensions=extensions)
+
+
+# state of a `predict` worker process
+_PREDICT_WORKER = dict()
+
+
+def _set_worker_threads(num_workers):
+    if num_workers > 1 and 'torch' in sys.modules:
+        import torch
+
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+
+
+def _init_predict_worker(std_kwargs, detect_kwargs, num_workers, plot_dir):
+    from concurrent.futures import ThreadPoolExecutor
+
+    std = CnStd(**std_kwargs)
+    _set_worker_threads(num_workers)
+    _PREDICT_WORKER.update(
+        std=std,
+        detect_kwargs=detect_kwargs,
+        plot_dir=plot_dir,
+        # one thread: pyplot is not thread-safe
+        plot_executor=ThreadPoolExecutor(max_workers=1) if plot_dir else None,
     )
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    for idx, img_fp in enumerate(img_list):
-        angle = std_out[idx]['rotated_angle']
-        pil_img = read_img(img_fp)
-        img = pil_to_numpy(pil_img).transpose((1, 2, 0)).astype(np.uint8)
-        rotated_img = np.ascontiguousarray(rotate_page(img, -angle))
 
-        fname = os.path.basename(img_fp).rsplit('.', maxsplit=1)[0]
-        prefix_fp = os.path.join(output_dir, fname)
+def _finish_predict_worker():
+    plot_executor = _PREDICT_WORKER.pop('plot_executor', None)
+    if plot_executor is not None:
+        plot_executor.shutdown(wait=True)
+
+
+def _plot_prediction(img, std_out, box_score_thresh, prefix_fp):
+    try:
+        rotated_img = np.ascontiguousarray(rotate_page(img, -std_out['rotated_angle']))
+        os.makedirs(os.path.dirname(prefix_fp), exist_ok=True)
         plot_for_debugging(
-            rotated_img, std_out[idx]['detected_texts'], box_score_thresh, prefix_fp
+            rotated_img, std_out['detected_texts'], box_score_thresh, prefix_fp
         )
+    except Exception as e:
+        logger.warning('failed to plot %s: %s' % (prefix_fp, e))
 
-    try:
-        from cnocr import CnOcr
 
-        ocr = CnOcr()
+def _predict_one(entry):
+    key, img_fp = entry
+    state = _PREDICT_WORKER
+    record = dict(key=key, path=img_fp)
+    start_time = time.perf_counter()
+    try:
+        img = to_uint8_hwc(read_img(img_fp))
+        read_time = time.perf_counter()
+        std_out = state['std'].detect(
+            img,
+            return_cropped_image=state['plot_dir'] is not None,
+            **state['detect_kwargs'],
+        )
+        detect_time = time.perf_counter()
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        return record
 
-        logger.info('use cnocr to predict texts from the FIRST image, as an example')
-        cropped_img_list = [
-            box_info['cropped_img'] for box_info in std_out[0]['detected_texts']
-        ]
-        start_time = time.time()
-        ocr_out = ocr.ocr_for_single_lines(cropped_img_list, batch_size=1)
-        time_cost = time.time() - start_time
-        logger.info(
-            '%d cropped text boxes are recognized by cnocr, total time cost: %f, mean time cost: %f'
-            % (len(cropped_img_list), time_cost, time_cost / len(cropped_img_list))
+    box_infos = std_out['detected_texts']
+    record.update(
+        rotated_angle=float(std_out['rotated_angle']),
+        boxes=[np.round(np.asarray(info['box'], dtype=float), 2).tolist() for info in box_infos],
+        scores=[round(float(info['score']), 4) for info in box_infos],
+        timings=dict(
+            read=round(read_time - start_time, 4),
+            detect=round(detect_time - read_time, 4),
+        ),
+    )
+    if state['plot_executor'] is not None:
+        prefix_fp = os.path.join(
+            state['plot_dir'], _safe_relpath(key).rsplit('.', maxsplit=1)[0]
+        )
+        state['plot_executor'].submit(
+            _plot_prediction,
+            img,
+            std_out,
+            state['detect_kwargs']['box_score_thresh'],
+            prefix_fp,
         )
-        logger.info('ocr result: \n%s' % pformat(ocr_out))
-    except ModuleNotFoundError as e:
-        logger.warning(e)
+    return record
 
 
 @cli.command('resave')
@@ -314,6 +553,8 @@ def resave_model_file(
     input_model_fp, output_model_fp,
 ):
     """训练好的模型会存储训练状态，使用此命令去掉预测时无关的数据，降低模型大小"""
+    from .trainer import resave_model
+
     resave_model(input_model_fp, output_model_fp, map_location='cpu')
 
 
@@ -356,7 +597,11 @@ def resave_model_file(
 @click.option('-y', '--model-arch-yaml', type=str, default=None, help='模型的配置文件路径')
 @click.option('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
 @click.option(
-    '-i', '--img-fp', type=str, default='./examples/mfd/zh.jpg', help='待分析的图片路径或图片目录'
+    '-i',
+    '--img-fp',
+    type=str,
+    default='./examples/mfd/zh.jpg',
+    help='待分析的图片路径或图片目录（会递归查找其中的所有图片）',
 )
 @click.option(
     '-o',
@@ -365,7 +610,8 @@ def resave_model_file(
     default=None,
     help='分析结果输出的图片路径。默认为 `None`，会存储在当前文件夹，文件名称为输入文件名称前面增加`out-`；'
     '如输入文件名为 `img.jpg`, 输出文件名即为 `out-img.jpg`；'
-    '如果输入为目录，则此路径也应该是一个目录，会将输出文件存储在此目录下',
+    '如果输入为目录或清单文件，则此路径也应该是一个目录，会将输出文件存储在此目录下，'
+    '并把所有图片的分析结果存入其中的 `analysis.jsonl`（分片时为 `analysis.shard-*.jsonl`），每行对应一张图片',
 )
 @click.option(
     "--resized-shape", type=int, default=608, help='分析时把图片resize到此大小再进行。默认为 `608`',
@@ -376,6 +622,12 @@ def resave_model_file(
 @click.option(
     '--iou-thresh', type=float, default=0.45, help='IOU threshold for NMS。默认值为 `0.45`'
 )
+@click.option(
+    '--save-img/--no-save-img',
+    default=True,
+    help='输入为目录或清单文件时，是否存储每张图片的分析结果图片。默认为存储',
+)
+@_batch_job_options
 def layout_analyze(
     model_name,
     model_type,
@@ -389,14 +641,21 @@ def layout_analyze(
     resized_shape,
     conf_thresh,
     iou_thresh,
+    save_img,
+    manifest,
+    num_shards,
+    shard_index,
+    num_workers,
+    overwrite,
+    log_interval,
 ):
     """对给定图片进行 MFD 或者 版面分析。"""
-    if not os.path.exists(img_fp):
+    if manifest is None and not os.path.exists(img_fp):
         raise FileNotFoundError(img_fp)
 
     if model_categories is not None:
         model_categories = model_categories.split(',')
-    analyzer = LayoutAnalyzer(
+    analyzer_kwargs = dict(
         model_name=model_name,
         model_type=model_type,
         model_backend=model_backend,
@@ -405,31 +664,552 @@ def layout_analyze(
         model_arch_yaml=model_arch_yaml,
         device=device,
     )
+    analyze_kwargs = dict(
+        resized_shape=resized_shape,
+        conf_threshold=conf_thresh,
+        iou_threshold=iou_thresh,
+    )
 
-    input_fp_list = []
-    if os.path.isfile(img_fp):
-        input_fp_list.append(img_fp)
+    if manifest is None and os.path.isfile(img_fp):
+        from . import LayoutAnalyzer
+
+        analyzer = LayoutAnalyzer(**analyzer_kwargs)
         if output_fp is None:
             output_fp = 'out-' + os.path.basename(img_fp)
-        output_fp_list = [output_fp]
-    elif os.path.isdir(img_fp):
-        fn_list = glob.glob1(img_fp, '*g')
-        input_fp_list = [os.path.join(img_fp, fn) for fn in fn_list]
-        assert (
-            output_fp is not None
-        ), 'output_fp should NOT be None when img_fp is a directory'
-        os.makedirs(output_fp, exist_ok=True)
-        output_fp_list = [os.path.join(output_fp, 'analysis-' + fn) for fn in fn_list]
-
-    for input_fp, output_fp in zip(input_fp_list, output_fp_list):
-        out = analyzer.analyze(
-            input_fp,
-            resized_shape=resized_shape,
-            conf_threshold=conf_thresh,
-            iou_threshold=iou_thresh,
-        )
-        img0 = cv2.imread(input_fp, cv2.IMREAD_COLOR)
+        out = analyzer.analyze(img_fp, **analyze_kwargs)
+        img0 = cv2.imread(img_fp, cv2.IMREAD_COLOR)
         analyzer.save_img(img0, out, output_fp)
+        return
+
+    assert (
+        output_fp is not None
+    ), 'output_fp should NOT be None when img_fp is a directory or a manifest is used'
+    os.makedirs(output_fp, exist_ok=True)
+    from .__version__ import __version__
+
+    params = dict(cnstd_version=__version__, **analyzer_kwargs, **analyze_kwargs)
+    params.pop('device')
+    _run_batch_job(
+        _job_entries(img_fp, manifest),
+        shard_output_path(output_fp, 'analysis', num_shards, shard_index),
+        _analyze_one,
+        header=_job_header('analyze', img_fp, manifest, params),
+        num_shards=num_shards,
+        shard_index=shard_index,
+        num_workers=num_workers,
+        overwrite=overwrite,
+        log_interval=log_interval,
+        initializer=_init_analyze_worker,
+        initargs=(analyzer_kwargs, analyze_kwargs, num_workers, output_fp if save_img else None),
+    )
+
+
+# state of an `analyze` worker process
+_ANALYZE_WORKER = dict()
+
+
+def _init_analyze_worker(analyzer_kwargs, analyze_kwargs, num_workers, img_dir):
+    from . import LayoutAnalyzer
+
+    analyzer = LayoutAnalyzer(**analyzer_kwargs)
+    _set_worker_threads(num_workers)
+    _ANALYZE_WORKER.update(
+        analyzer=analyzer, analyze_kwargs=analyze_kwargs, img_dir=img_dir
+    )
+
+
+def _analyze_one(entry):
+    key, img_fp = entry
+    state = _ANALYZE_WORKER
+    record = dict(key=key, path=img_fp)
+    start_time = time.perf_counter()
+    try:
+        img = read_img(img_fp)
+        read_time = time.perf_counter()
+        out = state['analyzer'].analyze(img, **state['analyze_kwargs'])
+        analyze_time = time.perf_counter()
+        if state['img_dir'] is not None:
+            rel_dir, fname = os.path.split(_safe_relpath(key))
+            save_fp = os.path.join(state['img_dir'], rel_dir, 'analysis-' + fname)
+            os.makedirs(os.path.dirname(save_fp), exist_ok=True)
+            state['analyzer'].save_img(img, out, save_fp)
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        return record
+
+    record.update(
+        elements=[
+            dict(
+                type=info['type'],
+                box=np.round(np.asarray(info['box'], dtype=float), 2).tolist(),
+                score=round(float(info['score']), 4),
+            )
+            for info in out
+        ],
+        timings=dict(
+            read=round(read_time - start_time, 4),
+            analyze=round(analyze_time - read_time, 4),
+        ),
+    )
+    return record
+
+
+@cli.command('merge')
+@click.option('-o', '--output-fp', type=str, required=True, help='合并后的结果文件路径')
+@click.argument('shard_fps', nargs=-1, required=True)
+def merge_shards(output_fp, shard_fps):
+    """合并批量任务（`predict` 或 `analyze`）各个分片的结果文件，每张图片只保留一行结果"""
+    num_records = merge_job_logs(sorted(shard_fps), output_fp)
+    logger.info(
+        '%d records of %d files are merged into %s'
+        % (num_records, len(shard_fps), output_fp)
+    )
+
+
+@cli.command('evaluate')
+@_model_options
+@click.option(
+    "--box-score-thresh", type=float, default=0.3, help="检测结果只保留分数大于此值的文本框。默认值为 `0.3`"
+)
+@click.option(
+    "--min-box-size", type=int, default=8, help="检测结果只保留高和宽都不低于此值的文本框。默认值为 `8`"
+)
+@click.option(
+    '-i',
+    '--index-fp',
+    type=str,
+    required=True,
+    help='索引文件，格式与训练时的 `dev.tsv` 相同：每行为 "图片路径<tab>标注文件路径"',
+)
+@click.option(
+    '--data-root-dir',
+    type=str,
+    default=None,
+    help='索引文件中的相对路径所相对的文件夹。默认为索引文件所在的文件夹',
+)
+@click.option(
+    '-o',
+    '--output-dir',
+    default='./evaluation',
+    help='评估结果存放的文件夹：每张图片的指标存于 `per_image.jsonl`，整体指标和耗时统计存于 `summary.json`。'
+    '默认为 `./evaluation`',
+)
+@click.option(
+    '--cache-dir',
+    type=str,
+    default=None,
+    help='检测结果的缓存文件夹，按（模型，检测参数，图片内容的哈希值）缓存；'
+    '只修改评估参数时不会重新检测。默认为输出文件夹中的 `cache`',
+)
+@click.option(
+    '--iou-thresh', type=float, default=0.5, help='检测框与标注框的 IoU 不低于此值时才算匹配。默认值为 `0.5`'
+)
+@click.option(
+    '--min-score',
+    type=float,
+    default=0.0,
+    help='评估时只使用分数不低于此值的检测框（在缓存的检测结果上过滤，不会重新检测）。默认值为 `0`',
+)
+@click.option("--batch-size", type=int, default=8, help="每批检测的图片数。默认为 `8`")
+@_NUM_WORKERS_OPTION
+@_LOG_INTERVAL_OPTION
+def evaluate(
+    box_score_thresh,
+    min_box_size,
+    index_fp,
+    data_root_dir,
+    output_dir,
+    cache_dir,
+    iou_thresh,
+    min_score,
+    batch_size,
+    num_workers,
+    log_interval,
+    **model_options,
+):
+    """
+    在标注数据上评估检测模型，计算 precision、recall、H-mean 和 mean IoU，以及每张图片的指标和耗时统计。
+    检测结果会被缓存，使用相同的模型和检测参数再次评估时，只检测缓存中没有的图片
+    """
+    from .utils import (
+        read_eval_index,
+        load_gt_polygons,
+        read_prediction_cache,
+        evaluate_image,
+        summarize_evaluation,
+    )
+
+    std_kwargs, detect_kwargs, params = _std_params(
+        min_box_size=min_box_size, box_score_thresh=box_score_thresh, **model_options
+    )
+    detect_kwargs['batch_size'] = batch_size
+    cache_fp = _cache_prefix(output_dir, cache_dir, 'predictions', params) + '.jsonl'
+
+    entries = read_eval_index(index_fp, data_root_dir)
+    image_hashes, errors = _hash_images(entries)
+    failed = dict()
+
+    # predict the images not in the cache, and add them into it
+    num_predicted, start_time = 0, time.perf_counter()
+    with JobLog(cache_fp, key='image_hash') as cache:
+        todo = dict()
+        for key, img_fp, _ in entries:
+            image_hash = image_hashes.get(key)
+            if image_hash is not None and not cache.is_done(image_hash):
+                todo.setdefault(image_hash, img_fp)
+        num_cached = len(set(image_hashes.values())) - len(todo)
+        logger.info(
+            '%d images to predict, %d found in the cache %s' % (len(todo), num_cached, cache_fp)
+        )
+        todo = list(todo.items())
+        batches = [todo[i : i + batch_size] for i in range(0, len(todo), batch_size)]
+        if batches:  # no model is loaded if all the predictions are cached
+            results = imap_workers(
+                _predict_batch,
+                batches,
+                num_workers=num_workers,
+                initializer=_init_predict_worker,
+                initargs=(std_kwargs, detect_kwargs, num_workers, None),
+            )
+            meter = ThroughputMeter(log_interval=log_interval)
+            for records in results:
+                for record in records:
+                    if 'error' in record:
+                        failed[record['image_hash']] = record['error']
+                    else:
+                        cache.write(record)
+                num_predicted += len(records)
+                meter.update(len(records), failed=sum('error' in r for r in records))
+            meter.log()
+    inference_time = time.perf_counter() - start_time
+
+    predictions = read_prediction_cache(cache_fp, set(image_hashes.values()))
+    image_results, failed_results = [], []
+    for key, img_fp, gt_fp in entries:
+        image_hash = image_hashes.get(key)
+        res = dict(key=key, path=img_fp, image_hash=image_hash)
+        if image_hash is None or image_hash not in predictions:
+            res['error'] = errors.get(key) or failed.get(image_hash, 'no prediction')
+            failed_results.append(res)
+            continue
+        pred = predictions[image_hash]
+        pred_polys = [
+            box for box, score in zip(pred['boxes'], pred['scores']) if score >= min_score
+        ]
+        try:
+            gt_polys, ignore_tags = load_gt_polygons(gt_fp)
+        except Exception as e:
+            res['error'] = '%s: %s' % (type(e).__name__, e)
+            failed_results.append(res)
+            continue
+        res.update(evaluate_image(gt_polys, ignore_tags, pred_polys, iou_thresh))
+        res['timings'] = pred['timings']
+        image_results.append(res)
+
+    summary = summarize_evaluation(image_results)
+    with open(os.path.join(output_dir, 'per_image.jsonl'), 'w', encoding='utf-8') as f:
+        for res in image_results + failed_results:
+            res.pop('iou_sum', None)
+            f.write(json.dumps(res, ensure_ascii=False) + '\n')
+
+    summary.update(
+        num_failed=len(failed_results),
+        iou_thresh=iou_thresh,
+        min_score=min_score,
+        params=params,
+        cache_fp=cache_fp,
+        inference=dict(
+            num_predicted=num_predicted,
+            num_cached=num_cached,
+            wall_time=round(inference_time, 4),
+            throughput=round(num_predicted / max(inference_time, 1e-6), 4),
+        ),
+    )
+    with open(os.path.join(output_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    logger.info(
+        'precision: %.4f, recall: %.4f, hmean: %.4f, mean_iou: %.4f, on %d images (%d failed)'
+        % (
+            summary['precision'],
+            summary['recall'],
+            summary['hmean'],
+            summary['mean_iou'],
+            summary['num_images'],
+            summary['num_failed'],
+        )
+    )
+    logger.info('results are saved to %s' % output_dir)
+
+
+def _predict_batch(batch):
+    """检测一批图片，供 `evaluate` 使用；返回每张图片的检测结果（或错误信息）。"""
+    state = _PREDICT_WORKER
+    records, imgs = [], []
+    for image_hash, img_fp in batch:
+        start_time = time.perf_counter()
+        record = dict(image_hash=image_hash, path=img_fp)
+        try:
+            imgs.append(to_uint8_hwc(read_img(img_fp)))
+            record['timings'] = dict(read=round(time.perf_counter() - start_time, 4))
+        except Exception as e:
+            record['error'] = '%s: %s' % (type(e).__name__, e)
+        records.append(record)
+
+    ok_records = [record for record in records if 'error' not in record]
+    if not imgs:
+        return records
+    start_time = time.perf_counter()
+    try:
+        outs = state['std'].detect(imgs, return_cropped_image=False, **state['detect_kwargs'])
+    except Exception as e:
+        for record in ok_records:
+            record['error'] = '%s: %s' % (type(e).__name__, e)
+        return records
+    # latency of an image in a batch: its share of the batch
+    detect_time = (time.perf_counter() - start_time) / len(imgs)
+
+    for record, std_out in zip(ok_records, outs):
+        box_infos = std_out['detected_texts']
+        record.update(
+            rotated_angle=float(std_out['rotated_angle']),
+            boxes=[np.round(np.asarray(info['box'], dtype=float), 2).tolist() for info in box_infos],
+            scores=[round(float(info['score']), 4) for info in box_infos],
+        )
+        record['timings']['detect'] = round(detect_time, 4)
+    return records
+
+
+def _hash_images(entries):
+    """Content hashes of the images of an evaluation index, and the errors of the unreadable ones, by key."""
+    from .utils import file_sha1
+
+    image_hashes, errors = dict(), dict()
+    for key, img_fp, _ in entries:
+        try:
+            image_hashes[key] = file_sha1(img_fp)
+        except OSError as e:
+            errors[key] = '%s: %s' % (type(e).__name__, e)
+    return image_hashes, errors
+
+
+@cli.command('sweep')
+@_model_options
+@click.option(
+    '-i',
+    '--index-fp',
+    type=str,
+    required=True,
+    help='索引文件，格式与训练时的 `dev.tsv` 相同：每行为 "图片路径<tab>标注文件路径"',
+)
+@click.option(
+    '--data-root-dir',
+    type=str,
+    default=None,
+    help='索引文件中的相对路径所相对的文件夹。默认为索引文件所在的文件夹',
+)
+@click.option(
+    '-g',
+    '--grid',
+    type=str,
+    required=True,
+    help='后处理参数的取值网格，如 "bin_thresh=0.2,0.3;box_score_thresh=0.3,0.5;unclip_ratio=1.5,2.0"，'
+    '会评估所有取值的组合。可用的参数：`box_score_thresh`, `min_box_size`, `bin_thresh`, `unclip_ratio`, '
+    '`kernel_size`；CnSTD 模型还可用 `box_thresh`，PaddleOCR 模型还可用 `use_dilation`',
+)
+@click.option(
+    '-o',
+    '--output-dir',
+    default='./sweep',
+    help='结果存放的文件夹，每组参数的指标按 H-mean 从高到低存于 `sweep.jsonl`。默认为 `./sweep`',
+)
+@click.option(
+    '--cache-dir',
+    type=str,
+    default=None,
+    help='概率图的缓存文件夹，按（模型，resize 参数，图片内容的哈希值）缓存，每张图片一个压缩的 `.npz` 文件。'
+    '默认为输出文件夹中的 `cache`',
+)
+@click.option(
+    '--iou-thresh', type=float, default=0.5, help='检测框与标注框的 IoU 不低于此值时才算匹配。默认值为 `0.5`'
+)
+@click.option("--batch-size", type=int, default=8, help="计算概率图时每批的图片数。默认为 `8`")
+@_NUM_WORKERS_OPTION
+@_LOG_INTERVAL_OPTION
+def sweep(
+    index_fp,
+    data_root_dir,
+    grid,
+    output_dir,
+    cache_dir,
+    iou_thresh,
+    batch_size,
+    num_workers,
+    log_interval,
+    **model_options,
+):
+    """
+    在标注数据上搜索检测后处理参数的最优取值。每张图片只运行一次模型，得到的概率图被缓存；
+    每组参数只对缓存的概率图重新做后处理，并计算 precision、recall、H-mean 和 mean IoU
+    """
+    from .utils import (
+        read_eval_index,
+        parse_param_grid,
+        load_prob_map,
+        summarize_sweep,
+        SWEEP_PARAMS,
+    )
+
+    grid = parse_param_grid(grid)
+    # the boxes are not used, only the probability maps
+    std_kwargs, detect_kwargs, params = _std_params(**model_options)
+    detect_kwargs['batch_size'] = batch_size
+    prob_map_dir = _cache_prefix(output_dir, cache_dir, 'prob-maps', params)
+    os.makedirs(prob_map_dir, exist_ok=True)
+
+    entries = read_eval_index(index_fp, data_root_dir)
+    image_hashes, errors = _hash_images(entries)
+    failed = dict()
+    prob_map_fps = {
+        image_hash: os.path.join(prob_map_dir, image_hash + '.npz')
+        for image_hash in image_hashes.values()
+    }
+
+    # compute the probability maps missing in the cache, only once for each image
+    todo = dict()
+    for key, img_fp, _ in entries:
+        image_hash = image_hashes.get(key)
+        if image_hash is not None and not os.path.exists(prob_map_fps[image_hash]):
+            todo.setdefault(image_hash, (img_fp, prob_map_fps[image_hash]))
+    logger.info(
+        '%d probability maps to compute, %d found in the cache %s'
+        % (len(todo), len(prob_map_fps) - len(todo), prob_map_dir)
+    )
+    todo = [(image_hash, img_fp, fp) for image_hash, (img_fp, fp) in todo.items()]
+    if todo:
+        batches = [todo[i : i + batch_size] for i in range(0, len(todo), batch_size)]
+        results = imap_workers(
+            _save_prob_maps_batch,
+            batches,
+            num_workers=num_workers,
+            initializer=_init_predict_worker,
+            initargs=(std_kwargs, detect_kwargs, num_workers, None),
+        )
+        meter = ThroughputMeter(log_interval=log_interval)
+        for num_images, batch_failed in results:
+            failed.update(batch_failed)
+            meter.update(num_images, failed=len(batch_failed))
+        meter.log()
+
+    # replay the post-processing of each image for all the points of the grid
+    items = []
+    for key, _, gt_fp in entries:
+        image_hash = image_hashes.get(key)
+        if image_hash is None:
+            continue
+        if not os.path.exists(prob_map_fps[image_hash]):
+            errors[key] = failed.get(image_hash, 'no probability map')
+            continue
+        items.append((key, prob_map_fps[image_hash], gt_fp))
+    if items:
+        detector = load_prob_map(items[0][1])['detector']
+        unknown = {name for params in grid for name in params} - set(SWEEP_PARAMS[detector])
+        if unknown:
+            raise click.BadParameter(
+                'unknown parameters %s for %s models, which support %s'
+                % (sorted(unknown), detector, SWEEP_PARAMS[detector])
+            )
+    logger.info(
+        'sweep %d parameter settings on %d images (%d failed)'
+        % (len(grid), len(items), len(entries) - len(items))
+    )
+    image_results = []
+    meter = ThroughputMeter(log_interval=log_interval)
+    for key, results in imap_workers(
+        _sweep_one,
+        items,
+        num_workers=num_workers,
+        initializer=_init_sweep_worker,
+        initargs=(grid, iou_thresh),
+    ):
+        if isinstance(results, str):
+            errors[key] = results
+            meter.update(failed=1)
+            continue
+        image_results.append(results)
+        meter.update()
+    meter.log()
+
+    points = summarize_sweep(grid, image_results)
+    out_fp = os.path.join(output_dir, 'sweep.jsonl')
+    with open(out_fp, 'w', encoding='utf-8') as f:
+        for point in points:
+            f.write(json.dumps(point, ensure_ascii=False) + '\n')
+    for key, error in errors.items():
+        logger.warning('failed to evaluate %s: %s' % (key, error))
+    for point in points[:5]:
+        logger.info(
+            'hmean: %.4f, precision: %.4f, recall: %.4f, replay: %.1fms/image, params: %s'
+            % (
+                point['hmean'],
+                point['precision'],
+                point['recall'],
+                1000 * point['replay_time'],
+                json.dumps(point['params']),
+            )
+        )
+    logger.info('results are saved to %s' % out_fp)
+
+
+def _save_prob_maps_batch(batch):
+    """
+    计算一批图片的概率图并存入缓存，供 `sweep` 使用；
+    返回 (图片数, 出错图片的错误信息)，概率图不传回主进程。
+    """
+    from .utils import save_prob_map
+
+    state = _PREDICT_WORKER
+    errors, imgs, fps = dict(), [], []
+    for image_hash, img_fp, prob_map_fp in batch:
+        try:
+            imgs.append(to_uint8_hwc(read_img(img_fp)))
+            fps.append(prob_map_fp)
+        except Exception as e:
+            errors[image_hash] = '%s: %s' % (type(e).__name__, e)
+    if not imgs:
+        return len(batch), errors
+    try:
+        outs = state['std'].detect(
+            imgs, return_cropped_image=False, return_prob_map=True, **state['detect_kwargs']
+        )
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        return len(batch), {image_hash: error for image_hash, _, _ in batch}
+    for std_out, prob_map_fp in zip(outs, fps):
+        save_prob_map(prob_map_fp, std_out['prob_map'])
+    return len(batch), errors
+
+
+# state of a `sweep` worker process
+_SWEEP_WORKER = dict()
+
+
+def _init_sweep_worker(grid, iou_thresh):
+    _SWEEP_WORKER.update(grid=grid, iou_thresh=iou_thresh)
+
+
+def _sweep_one(item):
+    from .utils import load_prob_map, load_gt_polygons, sweep_image
+
+    key, prob_map_fp, gt_fp = item
+    try:
+        prob_map = load_prob_map(prob_map_fp)
+        gt_polys, ignore_tags = load_gt_polygons(gt_fp)
+        results = sweep_image(
+            prob_map, gt_polys, ignore_tags, _SWEEP_WORKER['grid'], _SWEEP_WORKER['iou_thresh']
+        )
+    except Exception as e:
+        return key, '%s: %s' % (type(e).__name__, e)
+    return key, results
 
 
 if __name__ == '__main__':
@@ -19,19 +19,55 @@
 
 from __future__ import absolute_import
 
+import os
 import logging
+import threading
 import traceback
 from pathlib import Path
-from typing import Tuple, List, Dict, Union, Any, Optional
+from typing import (
+    TYPE_CHECKING,
+    Tuple,
+    List,
+    Dict,
+    Union,
+    Any,
+    Optional,
+    Iterable,
+    Iterator,
+)
 
 from PIL import Image
+import cv2
 import numpy as np
 
 from .consts import AVAILABLE_MODELS
-from .detector import Detector
 from .ppocr import PP_SPACE, PPDetector
 from .ppocr.angle_classifier import AngleClassifier
-from .utils import data_dir
+from .utils import (
+    data_dir,
+    pack_crops,
+    check_color_order,
+    split_image_batch,
+    FrameChangeEstimator,
+    iter_frames,
+    reuse_detections,
+    iter_img_pages,
+    prefetch,
+    read_img,
+    to_uint8_hwc,
+    sort_boxes,
+    get_resized_ratio,
+    extract_quad_crops,
+    rotate_page,
+    dequantize_prob_map,
+    split_refine_tiles,
+    prob_map_text_regions,
+    select_refine_tiles,
+    merge_refined_boxes,
+)
+
+if TYPE_CHECKING:
+    import torch
 
 logger = logging.getLogger(__name__)
 
@@ -68,11 +104,18 @@ class CnStd(object):
                 Linux/Mac下默认值为 `~/.cnstd`，表示模型文件所处文件夹类似 `~/.cnstd/1.2/db_resnet18`
                 Windows下默认值为 `C:/Users/<username>/AppData/Roaming/cnstd`。
             use_angle_clf (bool): 对于检测出的文本框，是否使用角度分类模型进行调整（检测出的文本框可能会存在倒转180度的情况）。
-                默认为 `False`
+                角度分类模型在第一次使用时才会被加载；可调用 `self.warmup()` 提前加载。默认为 `False`
             angle_clf_configs (dict): 角度分类模型对应的参数取值，主要包含以下值：
                 - model_name: 模型名称。默认为 'ch_ppocr_mobile_v2.0_cls'
                 - model_fp: 如果不使用系统自带的模型，可以通过此参数直接指定所使用的模型文件（'.onnx' 文件）。默认为 `None`
                 具体可参考类 `AngleClassifier` 的说明
+            **kwargs: 其他传给检测模型的参数，如：
+                - crop_interpolation (str): 截取文本框图片时使用的插值方法，可选值：
+                  'nearest', 'linear', 'cubic', 'area', 'lanczos'。默认为 'linear'
+                - crop_num_workers (int): 截取文本框图片时使用的线程数。默认为 `4`
+                - postprocess_num_workers (int): PaddleOCR 模型并行后处理一批中各张图片时使用的线程数。默认为 `1`
+                - inference_mode (str): PyTorch 模型的推理方式，可选值：'eager', 'channels_last', 'bf16', 'compiled'；
+                  具体可参考类 `Detector` 的说明。默认为 'eager'
         """
         self.space = AVAILABLE_MODELS.get_space(model_name, model_backend)
         if self.space is None:
@@ -87,6 +130,8 @@ class CnStd(object):
             self.space = AVAILABLE_MODELS.get_space(model_name, model_backend)
 
         if self.space == AVAILABLE_MODELS.CNSTD_SPACE:
+            from .detector import Detector  # imports torch
+
             det_cls = Detector
         elif self.space == PP_SPACE:
             det_cls = PPDetector
@@ -103,13 +148,41 @@ class CnStd(object):
             model_fp=model_fp,
             model_backend=model_backend,
             root=root,
+            **kwargs,
         )
 
         self.use_angle_clf = use_angle_clf
+        self._angle_clf = None
+        self._angle_clf_lock = threading.Lock()
         if self.use_angle_clf:
-            angle_clf_configs = angle_clf_configs or dict()
+            angle_clf_configs = dict(angle_clf_configs or dict())
             angle_clf_configs['root'] = root
-            self.angle_clf = AngleClassifier(**angle_clf_configs)
+            self._angle_clf_configs = angle_clf_configs
+
+    @property
+    def angle_clf(self) -> Optional[AngleClassifier]:
+        """角度分类模型，在第一次使用时才加载；`use_angle_clf==False` 时为 `None`。"""
+        if not self.use_angle_clf:
+            return None
+        if self._angle_clf is None:
+            with self._angle_clf_lock:
+                if self._angle_clf is None:
+                    self._angle_clf = AngleClassifier(**self._angle_clf_configs)
+        return self._angle_clf
+
+    def warmup(self, resized_shape: Union[int, Tuple[int, int]] = (768, 768)) -> 'CnStd':
+        """
+        提前加载所有延迟加载的子模型（如角度分类模型），并用空白图片把每个模型都跑一遍，
+        使得之后第一次调用 `self.detect()` 时不会再有加载和初始化的开销。
+        Args:
+            resized_shape: 检测模型预热时使用的尺寸，含义与 `self.detect()` 相同。默认为 `(768, 768)`。
+
+        Returns: self
+        """
+        self.detect(np.zeros((64, 64, 3), dtype=np.uint8), resized_shape=resized_shape)
+        if self.use_angle_clf:
+            self.angle_clf([np.zeros((32, 100, 3), dtype=np.uint8)])
+        return self
 
     def detect(
         self,
@@ -118,20 +191,33 @@ class CnStd(object):
             Path,
             Image.Image,
             np.ndarray,
-            List[Union[str, Path, Image.Image, np.ndarray]],
+            'torch.Tensor',
+            List[Union[str, Path, Image.Image, np.ndarray, 'torch.Tensor']],
         ],
         resized_shape: Union[int, Tuple[int, int]] = (768, 768),
         preserve_aspect_ratio: bool = True,
         min_box_size: int = 8,
         box_score_thresh: float = 0.3,
         batch_size: int = 20,
+        color_order: str = 'rgb',
+        pack_crops: bool = False,
+        crop_height: int = 32,
+        crop_dtype: str = 'uint8',
+        return_cropped_image: bool = True,
+        return_prob_map: bool = False,
         **kwargs,
-    ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+    ) -> Union[
+        Dict[str, Any],
+        List[Dict[str, Any]],
+        Tuple[Union[Dict[str, Any], List[Dict[str, Any]]], Dict[str, np.ndarray]],
+    ]:
         """
         检测图片中的文本。
         Args:
             img_list: 支持对单个图片或者多个图片（列表）的检测。每个值可以是图片路径，或者已经读取进来 PIL.Image.Image 或 np.ndarray,
-                格式应该是 RGB 3通道，shape: (height, width, 3), 取值：[0, 255]
+                格式应该是 3通道，shape: (height, width, 3), 取值：[0, 255]。
+                也可以是 shape 为 (batch, height, width, 3) 的 np.ndarray 或 torch.Tensor（CPU上的 torch.Tensor 不会被复制）。
+                uint8 类型的 np.ndarray 会被直接使用，不会产生整张图片大小的拷贝。
             resized_shape: `int` or `tuple`, `tuple` 含义为 (height, width), `int` 则表示高宽都为此值；
                 检测前，先把原始图片resize到接近此大小（只是接近，未必相等）。默认为 `(768, 768)`。
                 注：这个取值对检测结果的影响较大，可以针对自己的应用多尝试几组值，再选出最优值。
@@ -140,6 +226,16 @@ class CnStd(object):
             min_box_size: 如果检测出的文本框高度或者宽度低于此值，此文本框会被过滤掉。默认为 `8`，也即高或者宽低于 `8` 的文本框会被过滤去掉。
             box_score_thresh: 过滤掉得分低于此值的文本框。默认为 `0.3`。
             batch_size: 待处理图片很多时，需要分批处理，每批图片的数量由此参数指定。默认为 `20`。
+            color_order: np.ndarray 或 torch.Tensor 图片的颜色顺序，'rgb' 或 'bgr'（如 `cv2.imread()` 的结果）。默认为 'rgb'。
+                传入 'bgr' 可以省掉颜色转换；返回的 'cropped_img' 总是 RGB 格式。
+            pack_crops: 是否额外返回打包好的文本框图片，可直接作为识别模型的一批输入。默认为 `False`。
+            crop_height: `pack_crops==True` 时，文本框图片保持高宽比 resize 到此高度。默认为 `32`。
+            crop_dtype: `pack_crops==True` 时，打包后的数据类型，'uint8' 或 'float32'，取值范围都是 [0, 255]。默认为 'uint8'。
+            return_cropped_image: 是否截取文本框对应的图片 'cropped_img'。为 `False` 时结果中不包含 'cropped_img'，
+                也不做方向分类，且不能与 `pack_crops==True` 同时使用。默认为 `True`。
+            return_prob_map: 是否在结果中返回检测模型输出的概率图 'prob_map'（量化为 uint8 的 np.ndarray 及后处理所需的信息），
+                可用 `cnstd.utils.save_prob_map()` 存储；之后调用检测模型的 `postprocess_prob_map()`
+                （`Detector` 或 `PPDetector`）即可用其他后处理参数重新获得文本框，而不需要再次运行模型。默认为 `False`。
             kwargs: 保留参数，目前未被使用。
 
         Returns:
@@ -166,15 +262,18 @@ class CnStd(object):
                     ...
               ]
 
+            `pack_crops==True` 时，返回 `(上面的结果, packed)`，其中 `packed` 为 Dict，包含以下 keys：
+               * 'buffer': np.ndarray, shape: (crop_height, total_width, 3)，所有文本框图片（RGB格式）按顺序左右拼接，
+                   每张图片的起始列都对齐到 8 的倍数，中间用 0 填充；
+               * 'meta': np.ndarray, shape: (N, 4)，每行对应一张文本框图片：(offset, width, 图片序号, 文本框序号)，
+                   也即 `buffer[:, offset:offset + width]` 为 `outs[图片序号]['detected_texts'][文本框序号]['cropped_img']`
+                   resize 后的结果。
+
         """
-        single = False
-        if isinstance(img_list, (list, tuple)):
-            pass
-        elif isinstance(img_list, (str, Path, Image.Image, np.ndarray)):
-            img_list = [img_list]
-            single = True
-        else:
-            raise TypeError('type %s is not supported now' % str(type(img_list)))
+        color_order = check_color_order(color_order)
+        if pack_crops and not return_cropped_image:
+            raise ValueError('`pack_crops` requires `return_cropped_image==True`')
+        img_list, single = split_image_batch(img_list)
 
         outs = self.det_model.detect(
             img_list,
@@ -183,21 +282,272 @@ class CnStd(object):
             min_box_size=min_box_size,
             box_score_thresh=box_score_thresh,
             batch_size=batch_size,
+            color_order=color_order,
+            return_cropped_image=return_cropped_image,
+            return_prob_map=return_prob_map,
         )
 
-        if self.use_angle_clf:
+        if self.use_angle_clf and return_cropped_image:
             for out in outs:
-                crop_img_list = [info['cropped_img'] for info in out['detected_texts']]
-                try:
-                    crop_img_list, angle_list = self.angle_clf(crop_img_list)
-                    for info, crop_img in zip(out['detected_texts'], crop_img_list):
-                        info['cropped_img'] = crop_img
-                except Exception as e:
-                    logger.info(traceback.format_exc())
-                    logger.info(e)
+                self._classify_angles(out['detected_texts'])
+
+        res = outs[0] if single else outs
+        if pack_crops:
+            return res, self._pack_crops(outs, crop_height, crop_dtype)
+        return res
+
+    def _classify_angles(self, detected_texts: List[Dict[str, Any]]) -> None:
+        crop_img_list = [info['cropped_img'] for info in detected_texts]
+        try:
+            crop_img_list, angle_list = self.angle_clf(crop_img_list)
+            for info, crop_img in zip(detected_texts, crop_img_list):
+                info['cropped_img'] = crop_img
+        except Exception as e:
+            logger.info(traceback.format_exc())
+            logger.info(e)
+
+    def detect_multiscale(
+        self,
+        img_list: Union[
+            str,
+            Path,
+            Image.Image,
+            np.ndarray,
+            'torch.Tensor',
+            List[Union[str, Path, Image.Image, np.ndarray, 'torch.Tensor']],
+        ],
+        resized_shape: Union[int, Tuple[int, int]] = 512,
+        preserve_aspect_ratio: bool = True,
+        min_box_size: int = 8,
+        box_score_thresh: float = 0.3,
+        batch_size: int = 20,
+        color_order: str = 'rgb',
+        refine_scale: float = 2.0,
+        min_text_height: float = 12,
+        borderline_margin: float = 0.1,
+        tile_overlap: float = 0.1,
+        **kwargs,
+    ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        """
+        由粗到细的多尺度文本检测。先在较低的分辨率（`resized_shape`）下检测整张图片，根据检出文本框的大小
+        以及概率图中各文字区域的大小估计文字高度；只对包含过小文字或者得分处于临界值附近的文本框的区域（tile），
+        再以更高的分辨率重新检测，最后合并结果。合并后才截取文本框图片（以及做方向分类），每个文本框只截取一次。
+        这样对于大部分文字都较大的图片，可以使用较小的 `resized_shape`，同时不会漏掉小字。
+        Args:
+            img_list: 与 `self.detect()` 相同。
+            resized_shape: 粗检测时使用的尺寸，含义与 `self.detect()` 相同。默认为 `512`。
+            preserve_aspect_ratio: 与 `self.detect()` 相同。
+            min_box_size: 与 `self.detect()` 相同。
+            box_score_thresh: 与 `self.detect()` 相同。
+            batch_size: 与 `self.detect()` 相同。
+            color_order: 与 `self.detect()` 相同。
+            refine_scale: 细检测相对粗检测放大的倍数；图片被切分为 `ceil(refine_scale) x ceil(refine_scale)` 个 tile。默认为 `2.0`。
+            min_text_height: 文本框在粗检测 resize 后的图片中的高度低于此值时，所在的 tile 需要细检测。默认为 `12`。
+            borderline_margin: 得分在 `[box_score_thresh - borderline_margin, box_score_thresh)` 之间的文本框，
+                所在的 tile 也需要细检测。默认为 `0.1`。
+            tile_overlap: 相邻 tile 之间重叠的比例。默认为 `0.1`。
+            kwargs: 保留参数，目前未被使用。
+
+        Returns:
+            与 `self.detect()` 相同。
+
+        """
+        color_order = check_color_order(color_order)
+        img_list, single = split_image_batch(img_list)
+        imgs = [self._to_array(img, color_order) for img in img_list]
+        resized_shape = calibrate_resized_shape(resized_shape)
+        detect_kwargs = dict(
+            resized_shape=resized_shape,
+            preserve_aspect_ratio=preserve_aspect_ratio,
+            min_box_size=min_box_size,
+            batch_size=batch_size,
+            color_order=color_order,
+            # the boxes are only cropped after merging, since many coarse and fine boxes are dropped
+            return_cropped_image=False,
+        )
+        outs = self.detect(
+            imgs,
+            box_score_thresh=max(0.0, box_score_thresh - borderline_margin),
+            return_prob_map=True,
+            **detect_kwargs,
+        )
+
+        for img, out in zip(imgs, outs):
+            box_infos = out['detected_texts']
+            prob_map = out.pop('prob_map')
+            resize_ratio = get_resized_ratio(
+                img.shape[:2], resized_shape, preserve_aspect_ratio
+            )[0]
+            text_regions = prob_map_text_regions(
+                dequantize_prob_map(prob_map['map']),
+                self._prob_map_scale(prob_map),
+                bin_thresh=prob_map['params']['bin_thresh'],
+                unclip_ratio=prob_map['params']['unclip_ratio'],
+            )
+            tiles = split_refine_tiles(img.shape[:2], refine_scale, tile_overlap)
+            selected, flags = select_refine_tiles(
+                box_infos,
+                tiles,
+                resize_ratio,
+                min_text_height=min_text_height,
+                box_score_thresh=box_score_thresh,
+                text_regions=text_regions,
+            )
+            if len(selected) == 0:
+                box_infos = [info for info in box_infos if info['score'] >= box_score_thresh]
+            else:
+                tiles = [tiles[idx] for idx in selected]
+                tile_outs = self.detect(
+                    [img[y0:y1, x0:x1] for x0, y0, x1, y1 in tiles],
+                    box_score_thresh=box_score_thresh,
+                    **detect_kwargs,
+                )
+                kept, new = merge_refined_boxes(
+                    box_infos,
+                    flags,
+                    [tile_out['detected_texts'] for tile_out in tile_outs],
+                    tiles,
+                    box_score_thresh=box_score_thresh,
+                )
+                box_infos = sort_boxes(kept + new, key='box')
+
+            # the boxes are in the coordinates of the rotated image, as in `detect()`
+            page = rotate_page(img, -out['rotated_angle']) if out['rotated_angle'] else img
+            crops = extract_quad_crops(
+                page,
+                np.array([info['box'] for info in box_infos]).reshape(-1, 4, 2),
+                interpolation=self.det_model.crop_interpolation,
+                num_workers=self.det_model.crop_num_workers,
+                cvt_code=cv2.COLOR_BGR2RGB if color_order == 'bgr' else None,
+            )
+            box_infos = [dict(info, cropped_img=crop) for info, crop in zip(box_infos, crops)]
+            if self.use_angle_clf and len(box_infos) > 0:
+                self._classify_angles(box_infos)
+            out['detected_texts'] = box_infos
 
         return outs[0] if single else outs
 
+    @staticmethod
+    def _prob_map_scale(prob_map: Dict[str, Any]) -> Tuple[float, float]:
+        """(x, y) scales from the coordinates of a probability map returned by `detect()` to those of the image."""
+        map_h, map_w = prob_map['map'].shape[:2]
+        if prob_map['detector'] == 'ppocr':
+            _, _, ratio_h, ratio_w = prob_map['shape_list']
+            return 1.0 / ratio_w, 1.0 / ratio_h
+        img_h, img_w = prob_map['image_shape']
+        ratio_h, ratio_w = prob_map['compress_ratio']
+        return img_w / (map_w * ratio_w), img_h / (map_h * ratio_h)
+
+    @staticmethod
+    def _to_array(
+        img: Union[str, Path, Image.Image, np.ndarray], color_order: str
+    ) -> np.ndarray:
+        if isinstance(img, (str, Path)):
+            if not os.path.isfile(img):
+                raise FileNotFoundError(img)
+            img = read_img(img)
+        if isinstance(img, Image.Image):
+            img = to_uint8_hwc(img)  # RGB-style
+            if color_order == 'bgr':
+                img = np.ascontiguousarray(img[:, :, ::-1])
+            return img
+        if isinstance(img, np.ndarray):
+            return to_uint8_hwc(img)
+        raise TypeError('type %s is not supported now' % str(type(img)))
+
+    def detect_stream(
+        self,
+        frames: Union[str, Path, np.ndarray, 'torch.Tensor', Iterable[Any]],
+        *,
+        color_order: str = 'rgb',
+        keyframe_interval: int = 50,
+        change_estimator: Optional[FrameChangeEstimator] = None,
+        **kwargs,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        检测视频或者连续帧中的文本。相邻帧变化很小时（如录屏、课程视频），会复用之前的检测结果，
+        只在关键帧或者有变化的区域上重新检测。
+        Args:
+            frames: 视频文件路径；或者 shape 为 (N, height, width, 3) 的 np.ndarray 或 torch.Tensor；
+                或者可迭代的帧序列，每帧为 PIL.Image.Image、np.ndarray 或 torch.Tensor。
+            color_order: np.ndarray 或 torch.Tensor 帧的颜色顺序，'rgb' 或 'bgr'。视频文件读出的帧总是 'bgr'。默认为 'rgb'。
+            keyframe_interval: 至少每隔这么多帧，对整帧重新检测一次。默认为 `50`。
+            change_estimator: 用于度量帧间变化的 `FrameChangeEstimator`；为 `None` 时使用默认参数。
+            kwargs: 其他传给 `self.detect()` 的参数，如 `resized_shape`、`box_score_thresh` 等。
+
+        Returns:
+            迭代器，每个元素对应一帧的检测结果，为 Dict，除了 `self.detect()` 返回的 keys，还包括：
+               * 'frame_idx': int, 帧的序号，从 0 开始；
+               * 'frame_status': str, 此帧结果的来源，取值为：
+                   'keyframe'：对整帧做了检测；
+                   'static'：与参考帧相同，直接复用其结果；
+                   'shifted'：整帧内容相对参考帧发生了平移，复用其结果并平移文本框；
+                   'region'：只对发生变化的区域做了检测，其他区域复用参考帧的结果。
+               复用的 'cropped_img' 来自之前的帧，其内容与当前帧对应位置相同。
+
+        """
+        color_order = check_color_order(color_order)
+        frames, color_order = iter_frames(frames, color_order)
+        state = dict(rotated_angle=0.0)
+
+        def detect_fn(img):
+            out = self.detect(img, color_order=color_order, **kwargs)
+            state['rotated_angle'] = out['rotated_angle']
+            return out['detected_texts']
+
+        for idx, status, box_infos in reuse_detections(
+            frames,
+            detect_fn,
+            estimator=change_estimator,
+            keyframe_interval=keyframe_interval,
+        ):
+            yield dict(
+                frame_idx=idx,
+                frame_status=status,
+                rotated_angle=state['rotated_angle'],
+                detected_texts=box_infos,
+            )
+
+    def detect_pages(
+        self,
+        img_fps: Union[str, Path, List[Union[str, Path]]],
+        *,
+        num_prefetch: int = 1,
+        **kwargs,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        检测多页图片（如扫描仪输出的多页 TIFF、GIF 等）或者图片序列中每一页的文本。
+        页面逐页解码：检测第 i 页时，后台线程解码第 i+1 页，所有页面不会同时放在内存中。
+        Args:
+            img_fps: 单个图片文件路径，或者多个图片文件路径（列表）；每个文件都可以包含多页。
+            num_prefetch: 后台最多提前解码的页数。默认为 `1`。
+            kwargs: 其他传给 `self.detect()` 的参数，如 `resized_shape`、`box_score_thresh` 等。
+
+        Returns:
+            迭代器，每个元素对应一页的检测结果，为 Dict，除了 `self.detect()` 返回的 keys，还包括：
+               * 'img_fp': str, 此页所在的图片文件路径；
+               * 'page_idx': int, 此页在其文件中的序号，从 0 开始。
+
+        """
+        for img_fp, page_idx, page in prefetch(iter_img_pages(img_fps), num_prefetch):
+            out = self.detect(page, **kwargs)
+            out.update(img_fp=img_fp, page_idx=page_idx)
+            yield out
+
+    @staticmethod
+    def _pack_crops(
+        outs: List[Dict[str, Any]], crop_height: int, crop_dtype: str
+    ) -> Dict[str, np.ndarray]:
+        crops, indices = [], []
+        for img_idx, out in enumerate(outs):
+            for box_idx, info in enumerate(out['detected_texts']):
+                crops.append(info['cropped_img'])
+                indices.append((img_idx, box_idx))
+        buffer, offsets, widths = pack_crops(crops, crop_height, dtype=crop_dtype)
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1, 2)
+        meta = np.concatenate((offsets[:, None], widths[:, None], indices), axis=1)
+        return dict(buffer=buffer, meta=meta)
+
 
 def calibrate_resized_shape(resized_shape):
     if isinstance(resized_shape, int):
@@ -24,22 +24,33 @@ from typing import Tuple, Set, Dict, Any, Optional, Union
 from copy import deepcopy
 from collections import OrderedDict
 
-from torchvision.models import (
-    resnet50,
-    resnet34,
-    resnet18,
-    mobilenet_v3_large,
-    mobilenet_v3_small,
-    shufflenet_v2_x1_0,
-    shufflenet_v2_x1_5,
-    shufflenet_v2_x2_0,
-)
-
 from .__version__ import __version__
 
 logger = logging.getLogger(__name__)
 
 
+def _torchvision_backbone(name: str):
+    """Builder of a torchvision backbone; torchvision is only imported when it is called."""
+
+    def build(*args, **kwargs):
+        from torchvision import models
+
+        return getattr(models, name)(*args, **kwargs)
+
+    build.__name__ = build.__qualname__ = name
+    return build
+
+
+resnet50 = _torchvision_backbone('resnet50')
+resnet34 = _torchvision_backbone('resnet34')
+resnet18 = _torchvision_backbone('resnet18')
+mobilenet_v3_large = _torchvision_backbone('mobilenet_v3_large')
+mobilenet_v3_small = _torchvision_backbone('mobilenet_v3_small')
+shufflenet_v2_x1_0 = _torchvision_backbone('shufflenet_v2_x1_0')
+shufflenet_v2_x1_5 = _torchvision_backbone('shufflenet_v2_x1_5')
+shufflenet_v2_x2_0 = _torchvision_backbone('shufflenet_v2_x2_0')
+
+
 # 模型版本只对应到第二层，第三层的改动表示模型兼容。
 # 如: __version__ = '1.0.*'，对应的 MODEL_VERSION 都是 '1.0'
 MODEL_VERSION = '.'.join(__version__.split('.', maxsplit=2)[:2])
@@ -122,19 +133,24 @@ CN_OSS_ENDPOINT = (
 )
 
 
-def format_hf_hub_url(url: str) -> dict:
-    return {
+def format_hf_hub_url(url: str, sha1: Optional[str] = None) -> dict:
+    out = {
         'repo_id': HF_HUB_REPO_ID,
         'subfolder': HF_HUB_SUBFOLDER,
         'filename': url,
         'cn_oss': CN_OSS_ENDPOINT,
     }
+    if sha1:
+        # downloaded files are verified against it before being used
+        out['sha1'] = sha1
+    return out
 
 
 class AvailableModels(object):
     CNSTD_SPACE = '__cnstd__'
 
     # name: (epochs, url)
+    # 每个模型还可以通过 'sha1' 指定其 zip 文件的 sha1 值（十六进制，可以只取前缀），下载后会先校验再使用
     # 免费模型
     FREE_MODELS = OrderedDict(
         {
@@ -230,10 +246,13 @@ class AvailableModels(object):
     def get_fpn_type(self, model_name, model_backend) -> Optional[int]:
         return self.get_value(model_name, model_backend, 'fpn_type')
 
+    def get_sha1(self, model_name, model_backend) -> Optional[str]:
+        return self.get_value(model_name, model_backend, 'sha1')
+
     def get_url(self, model_name, model_backend) -> Optional[dict]:
         url = self.get_value(model_name, model_backend, 'url')
         if url:
-            url = format_hf_hub_url(url)
+            url = format_hf_hub_url(url, self.get_sha1(model_name, model_backend))
 
         return url
 
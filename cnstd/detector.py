@@ -27,9 +27,11 @@ from typing import Tuple, List, Dict, Union, Any, Optional
 
 from PIL import Image
 import numpy as np
+import torch
 
 from .consts import MODEL_VERSION, AVAILABLE_MODELS, DOWNLOAD_SOURCE
 from .model import gen_model
+from .model.base import DBPostProcessor
 from .model.core import DetectionPredictor
 from .utils import (
     data_dir,
@@ -38,6 +40,10 @@ from .utils import (
     get_model_file,
     load_model_params,
     read_img,
+    check_color_order,
+    split_image_batch,
+    check_inference_mode,
+    dequantize_prob_map,
 )
 
 logger = logging.getLogger(__name__)
@@ -60,6 +66,9 @@ class Detector(object):
         model_fp: Optional[str] = None,
         model_backend: str = 'pytorch',  # ['pytorch', 'onnx']
         root: Union[str, Path] = data_dir(),
+        crop_interpolation: str = 'linear',
+        crop_num_workers: int = 4,
+        inference_mode: str = 'eager',
         **kwargs,
     ):
         """
@@ -74,6 +83,14 @@ class Detector(object):
             root: 模型文件所在的根目录。
                 Linux/Mac下默认值为 `~/.cnstd`，表示模型文件所处文件夹类似 `~/.cnstd/1.0/db_resnet18`
                 Windows下默认值为 `C:/Users/<username>/AppData/Roaming/cnstd`。
+            crop_interpolation: 截取文本框图片时使用的插值方法，可选值：'nearest', 'linear', 'cubic', 'area', 'lanczos'。
+                默认为 'linear'
+            crop_num_workers: 截取文本框图片时使用的线程数。默认为 `4`
+            inference_mode: PyTorch 模型的推理方式，可选值：
+                'eager'（普通的 FP32 NCHW 计算）、'channels_last'（使用 channels-last 内存格式）、
+                'bf16'（channels-last 加 bfloat16 autocast，设备不支持时退回 'channels_last'）、
+                'compiled'（channels-last 加 `torch.compile()`，batch 大小补齐到 2 的幂次，最多编译 8 种输入尺寸，其他尺寸使用 eager 计算）。
+                非 'eager' 的方式在加载时会与 'eager' 的输出做一致性检查，不一致时自动退回 'eager'。默认为 'eager'
         """
         model_backend = model_backend.lower()
         assert model_backend in ('pytorch', 'onnx')
@@ -91,6 +108,9 @@ class Detector(object):
             context = 'cuda'
         self.context = context
         self.rotated_bbox = rotated_bbox
+        self.crop_interpolation = crop_interpolation
+        self.crop_num_workers = crop_num_workers
+        self.inference_mode = check_inference_mode(inference_mode)
 
         try:
             self._assert_and_prepare_model_files(model_fp, root)
@@ -160,9 +180,15 @@ class Detector(object):
         )
         model.eval()
         model.to(self.context)
-        load_model_params(model, self._model_fp, self.context)
+        load_model_params(model, self._model_fp, self.context, mmap=True)
 
-        predictor = DetectionPredictor(model, context=self.context)
+        predictor = DetectionPredictor(
+            model,
+            context=self.context,
+            crop_interpolation=self.crop_interpolation,
+            crop_num_workers=self.crop_num_workers,
+            inference_mode=self.inference_mode,
+        )
         return predictor
 
     def detect(
@@ -172,20 +198,26 @@ class Detector(object):
             Path,
             Image.Image,
             np.ndarray,
-            List[Union[str, Path, Image.Image, np.ndarray]],
+            torch.Tensor,
+            List[Union[str, Path, Image.Image, np.ndarray, torch.Tensor]],
         ],
         resized_shape: Tuple[int, int] = (768, 768),
         preserve_aspect_ratio: bool = True,
         min_box_size: int = 8,
         box_score_thresh: float = 0.3,
         batch_size: int = 20,
+        color_order: str = 'rgb',
+        return_cropped_image: bool = True,
+        return_prob_map: bool = False,
         **kwargs,
     ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
         """
         检测图片中的文本。
         Args:
             img_list: 支持对单个图片或者多个图片（列表）的检测。每个值可以是图片路径，或者已经读取进来 PIL.Image.Image 或 np.ndarray,
-                格式应该是 RGB 3通道，shape: (height, width, 3), 取值：[0, 255]
+                格式应该是 3通道，shape: (height, width, 3), 取值：[0, 255]。
+                也可以是 shape 为 (batch, height, width, 3) 的 np.ndarray 或 torch.Tensor（CPU上的 torch.Tensor 不会被复制）。
+                uint8 类型的 np.ndarray 会被直接使用，不会产生整张图片大小的拷贝。
             resized_shape: (height, width), 检测前，先把原始图片resize到此大小。默认为 `(768, 768)`。
                 注：其中取值必须都能整除32。这个取值对检测结果的影响较大，可以针对自己的应用多尝试几组值，再选出最优值。
                     例如 (512, 768), (768, 768), (768, 1024)等。
@@ -193,6 +225,12 @@ class Detector(object):
             min_box_size: 如果检测出的文本框高度或者宽度低于此值，此文本框会被过滤掉。默认为 `8`，也即高或者宽低于 `8` 的文本框会被过滤去掉。
             box_score_thresh: 过滤掉得分低于此值的文本框。默认为 `0.3`。
             batch_size: 待处理图片很多时，需要分批处理，每批图片的数量由此参数指定。默认为 `20`。
+            color_order: np.ndarray 或 torch.Tensor 图片的颜色顺序，'rgb' 或 'bgr'（如 `cv2.imread()` 的结果）。默认为 'rgb'。
+            return_cropped_image: 是否截取文本框对应的图片 'cropped_img'。为 `False` 时结果中不包含 'cropped_img'，
+                只需要文本框位置时可以省掉截图的开销。默认为 `True`。
+            return_prob_map: 是否在结果中返回模型输出的概率图 'prob_map'（量化为 uint8），
+                可用 `save_prob_map()` 存储，并用 `Detector.postprocess_prob_map()` 以其他后处理参数重新获得文本框，
+                而不需要再次运行模型。默认为 `False`。
             kwargs: 保留参数，目前未被使用。
 
         Returns:
@@ -218,16 +256,15 @@ class Detector(object):
                                                           [11, 11, 13]]], dtype=uint8)},
                     ...
               ]
+               * 'prob_map': dict, 只有 `return_prob_map==True` 时才有，包含以下 keys：
+                   'map'：模型输出的概率图，np.ndarray, uint8 类型，shape: (H, W)，值为概率乘以 255；
+                   'detector'：'cnstd'；
+                   'image_shape', 'compress_ratio'：原始图片的 (height, width)，以及 resize 的比例；
+                   'params'：检测时使用的后处理参数。
 
         """
-        single = False
-        if isinstance(img_list, (list, tuple)):
-            pass
-        elif isinstance(img_list, (str, Path, Image.Image, np.ndarray)):
-            img_list = [img_list]
-            single = True
-        else:
-            raise TypeError('type %s is not supported now' % str(type(img_list)))
+        color_order = check_color_order(color_order)
+        img_list, single = split_image_batch(img_list)
 
         idx = 0
         out = []
@@ -239,6 +276,9 @@ class Detector(object):
                 preserve_aspect_ratio=preserve_aspect_ratio,
                 min_box_size=min_box_size,
                 box_score_thresh=box_score_thresh,
+                color_order=color_order,
+                return_cropped_image=return_cropped_image,
+                return_prob_map=return_prob_map,
                 **kwargs,
             )
             out.extend(res)
@@ -253,6 +293,9 @@ class Detector(object):
         preserve_aspect_ratio: bool,
         min_box_size: int,
         box_score_thresh: float,
+        color_order: str = 'rgb',
+        return_cropped_image: bool = True,
+        return_prob_map: bool = False,
         **kwargs,
     ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
         img_list = self._preprocess_images(img_list)
@@ -262,7 +305,47 @@ class Detector(object):
             preserve_aspect_ratio=preserve_aspect_ratio,
             min_box_size=min_box_size,
             box_score_thresh=box_score_thresh,
+            color_order=color_order,
+            return_cropped_image=return_cropped_image,
+            return_prob_map=return_prob_map,
+        )
+
+    @staticmethod
+    def postprocess_prob_map(prob_map: Dict[str, Any], **params) -> Dict[str, Any]:
+        """
+        只对 `detect(..., return_prob_map=True)` 返回的概率图重新做后处理，不需要再次运行模型。
+
+        Args:
+            prob_map: 检测结果中的 'prob_map'
+            **params: 替换检测时所用的后处理参数，可以是：
+                'box_score_thresh', 'min_box_size': 含义与 `detect()` 中的相同；
+                'bin_thresh'：概率图二值化的阈值；
+                'box_thresh'：后处理中文本框分数的最低值；
+                'unclip_ratio'：文本框向外扩张的比例；
+                'kernel_size'：二值图做 opening 的 kernel 大小，`None` 表示根据概率图的高度决定。
+
+        Returns:
+            Dict, 与 `detect(..., return_cropped_image=False)` 返回的每张图片的结果格式相同
+        """
+        params = {**prob_map['params'], **params}
+        postprocessor = DBPostProcessor(
+            auto_rotate_whole_image=params['auto_rotate_whole_image'],
+            box_thresh=params['box_thresh'],
+            bin_thresh=params['bin_thresh'],
+            rotated_bbox=params['rotated_bbox'],
+            unclip_ratio=params['unclip_ratio'],
+            kernel_size=params['kernel_size'],
+        )
+        (quads, scores, angle), = DetectionPredictor.postprocess(
+            postprocessor,
+            dequantize_prob_map(prob_map['map'])[None],
+            [prob_map['image_shape']],
+            [prob_map['compress_ratio']],
+            params['box_score_thresh'],
+            params['min_box_size'],
         )
+        detected_texts = [dict(box=box, score=score) for box, score in zip(quads, scores)]
+        return {'rotated_angle': angle, 'detected_texts': detected_texts}
 
     @classmethod
     def _preprocess_images(
@@ -0,0 +1,349 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Tuple, List, Dict, Union, Any, Optional
+
+from PIL import Image
+import cv2
+import numpy as np
+import torch
+
+from .cn_std import CnStd, calibrate_resized_shape
+from .yolov7.layout_analyzer import LayoutAnalyzer
+from .utils import (
+    check_color_order,
+    split_image_batch,
+    prefetch,
+    read_img,
+    to_uint8_hwc,
+    sort_boxes,
+    get_resized_ratio,
+    rotate_page,
+    extract_quad_crops,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _bboxes(box_infos: List[Dict[str, Any]]) -> np.ndarray:
+    """(N, 4) axis-aligned boxes (xmin, ymin, xmax, ymax) of the 'box' values."""
+    if len(box_infos) == 0:
+        return np.zeros((0, 4), dtype=np.float32)
+    quads = np.stack(
+        [np.asarray(info['box'], dtype=np.float32).reshape(4, 2) for info in box_infos]
+    )
+    return np.concatenate((quads.min(axis=1), quads.max(axis=1)), axis=1)
+
+
+def _covered_ratios(bboxes: np.ndarray, cover_bboxes: np.ndarray) -> np.ndarray:
+    """Largest ratio of the area of each box in `bboxes` inside one of `cover_bboxes`."""
+    if len(bboxes) == 0 or len(cover_bboxes) == 0:
+        return np.zeros(len(bboxes), dtype=np.float32)
+    lt = np.maximum(bboxes[:, None, :2], cover_bboxes[None, :, :2])
+    rb = np.minimum(bboxes[:, None, 2:], cover_bboxes[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    areas = np.maximum((bboxes[:, 2:] - bboxes[:, :2]).prod(axis=1), 1e-6)
+    return (inter / areas[:, None]).max(axis=1)
+
+
+def _rotate_points(
+    points: np.ndarray, angle: float, img_hw: Tuple[int, int], min_angle: float = 1.0
+) -> np.ndarray:
+    """Map points of an image to the page rotated by `rotate_page(img, angle)`."""
+    if abs(angle) < min_angle or abs(angle) > 90 - min_angle:
+        return points
+    height, width = img_hw
+    # same rotation center as `rotate_page()`
+    rot_mat = cv2.getRotationMatrix2D((height / 2, width / 2), angle, 1.0)
+    return points @ rot_mat[:, :2].T + rot_mat[:, 2]
+
+
+class DocumentDetector(object):
+    """
+    文档检测器：同时检测文档图片中的文字（`CnStd`）和数学公式（`LayoutAnalyzer('mfd')`），
+    返回合并后、按阅读顺序排列的结果。
+
+    每张图片只解码一次，并只缩小一次（缩小到两个模型所需分辨率中较大的那个），两个模型共用缩小后的图片；
+    CPU 核数不少于 2 时，两个模型并发执行。文本框图片最后才从原始分辨率的图片中截取，
+    被独立公式（'isolated'）覆盖的文本框会先被去掉，不会截图。
+    """
+
+    def __init__(
+        self,
+        text_detector: Optional[CnStd] = None,
+        formula_detector: Optional[LayoutAnalyzer] = None,
+        *,
+        text_configs: Optional[Dict[str, Any]] = None,
+        mfd_configs: Optional[Dict[str, Any]] = None,
+        num_workers: Optional[int] = None,
+    ):
+        """
+        Args:
+            text_detector (CnStd): 文字检测器；默认为 `None`，表示使用 `text_configs` 新建一个
+            formula_detector (LayoutAnalyzer): 数学公式检测器，类别须包含 'isolated'；
+                默认为 `None`，表示使用 `mfd_configs` 新建一个 `LayoutAnalyzer('mfd')`
+            text_configs (dict): 新建 `CnStd` 时使用的参数；默认为 `None`
+            mfd_configs (dict): 新建 `LayoutAnalyzer` 时使用的参数；默认为 `None`
+            num_workers (int): 并发执行两个模型的线程数，取值为 1 或 2；
+                默认为 `None`，表示 CPU 核数不少于 2 时取 2，否则取 1（顺序执行）
+        """
+        if text_detector is None:
+            text_detector = CnStd(**(text_configs or dict()))
+        if formula_detector is None:
+            mfd_configs = dict(mfd_configs or dict())
+            mfd_configs.setdefault('model_name', 'mfd')
+            formula_detector = LayoutAnalyzer(**mfd_configs)
+        if 'isolated' not in formula_detector.categories:
+            raise ValueError(
+                'the formula detector should detect "isolated" formulas, but its categories are %s'
+                % (formula_detector.categories,)
+            )
+        self.text_detector = text_detector
+        self.formula_detector = formula_detector
+
+        if num_workers is None:
+            num_workers = 2 if (os.cpu_count() or 1) >= 2 else 1
+        self.num_workers = min(max(1, num_workers), 2)
+        self._executor = (
+            ThreadPoolExecutor(max_workers=self.num_workers)
+            if self.num_workers > 1
+            else None
+        )
+
+    def __call__(self, *args, **kwargs):
+        return self.detect(*args, **kwargs)
+
+    def warmup(self) -> 'DocumentDetector':
+        """提前加载文字检测器中延迟加载的子模型，并用空白图片把两个模型都跑一遍。"""
+        self.text_detector.warmup()
+        self.formula_detector.analyze(np.zeros((64, 64, 3), dtype=np.uint8))
+        return self
+
+    def detect(
+        self,
+        img_list: Union[
+            str,
+            Path,
+            Image.Image,
+            np.ndarray,
+            torch.Tensor,
+            List[Union[str, Path, Image.Image, np.ndarray, torch.Tensor]],
+        ],
+        *,
+        text_resized_shape: Union[int, Tuple[int, int]] = (768, 768),
+        mfd_resized_shape: Union[int, Tuple[int, int]] = 700,
+        min_box_size: int = 8,
+        box_score_thresh: float = 0.3,
+        box_margin: int = 2,
+        conf_threshold: float = 0.25,
+        iou_threshold: float = 0.45,
+        suppress_isolated: bool = True,
+        isolated_overlap_thresh: float = 0.8,
+        return_cropped_image: bool = True,
+        color_order: str = 'rgb',
+        num_prefetch: int = 1,
+        **kwargs,
+    ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        """
+        检测文档图片中的文字和数学公式。
+
+        Args:
+            img_list: 支持对单个图片或者多个图片（列表）的检测，取值同 `CnStd.detect()`。
+                多张图片时，检测第 i 张图片的同时，后台线程解码第 i+1 张图片。
+            text_resized_shape: 文字检测使用的尺寸，含义同 `CnStd.detect()` 的 `resized_shape`。默认为 `(768, 768)`。
+            mfd_resized_shape: 公式检测使用的尺寸，含义同 `LayoutAnalyzer.analyze()` 的 `resized_shape`。默认为 `700`。
+            min_box_size: 原始图片中高或者宽低于此值的文本框会被过滤掉。默认为 `8`。
+            box_score_thresh: 过滤掉得分低于此值的文本框。默认为 `0.3`。
+            box_margin: 对检测出的公式框往外扩展的像素大小（原始图片中）。默认为 `2`。
+            conf_threshold: 公式检测的分数阈值。默认为 `0.25`。
+            iou_threshold: 公式检测的 IOU 阈值。默认为 `0.45`。
+            suppress_isolated: 是否去掉被独立公式（'isolated'）覆盖的文本框。默认为 `True`。
+            isolated_overlap_thresh: 文本框面积的这个比例以上落在某个独立公式框内时，此文本框被去掉。默认为 `0.8`。
+            return_cropped_image: 是否截取文本框对应的图片 'cropped_img'。默认为 `True`。
+            color_order: np.ndarray 或 torch.Tensor 图片的颜色顺序，'rgb' 或 'bgr'。默认为 'rgb'。
+            num_prefetch: 后台最多提前解码的图片数。默认为 `1`。
+            kwargs: 保留参数，目前未被使用。
+
+        Returns:
+            List[Dict], 每个Dict对应一张图片的检测结果。Dict 中包含以下 keys：
+               * 'rotated_angle': float, 整张图片旋转的角度，含义同 `CnStd.detect()`；
+               * 'elements': list, 按阅读顺序（从上到下、从左到右）排列的文字和公式，每个元素为 Dict，包括以下几个值：
+                   'type'：'text'，或者公式的类别 'embedding'（行内公式）、'isolated'（独立公式）；
+                   'box'：np.ndarray, shape: (4, 2)，对应 box 4个点在原始图片（`rotated_angle` 非0时为旋转后的图片）中的坐标值 (x, y)；
+                   'score'：得分；float 类型；分数越高表示越可靠；
+                   'cropped_img'：只有文字才有，对应'box'中的图片patch（RGB格式）。
+
+        """
+        color_order = check_color_order(color_order)
+        img_list, single = split_image_batch(img_list)
+        text_resized_shape = calibrate_resized_shape(text_resized_shape)
+        if isinstance(mfd_resized_shape, int):
+            mfd_resized_shape = (mfd_resized_shape, mfd_resized_shape)
+
+        outs = []
+        images = (self._decode(img, color_order) for img in img_list)
+        for img, img_color_order in prefetch(images, num_prefetch):
+            outs.append(
+                self._detect_one(
+                    img,
+                    img_color_order,
+                    text_resized_shape=text_resized_shape,
+                    mfd_resized_shape=mfd_resized_shape,
+                    min_box_size=min_box_size,
+                    box_score_thresh=box_score_thresh,
+                    box_margin=box_margin,
+                    conf_threshold=conf_threshold,
+                    iou_threshold=iou_threshold,
+                    suppress_isolated=suppress_isolated,
+                    isolated_overlap_thresh=isolated_overlap_thresh,
+                    return_cropped_image=return_cropped_image,
+                )
+            )
+        return outs[0] if single else outs
+
+    @staticmethod
+    def _decode(
+        img: Union[str, Path, Image.Image, np.ndarray], color_order: str
+    ) -> Tuple[np.ndarray, str]:
+        """Returns: (uint8 array with shape [H, W, 3], its color order)"""
+        if isinstance(img, (str, Path)):
+            if not os.path.isfile(img):
+                raise FileNotFoundError(img)
+            img = read_img(img)
+        if isinstance(img, Image.Image):
+            return to_uint8_hwc(img), 'rgb'
+        if isinstance(img, np.ndarray):
+            return to_uint8_hwc(img), color_order
+        raise TypeError('type %s is not supported now' % str(type(img)))
+
+    @staticmethod
+    def _shared_ratio(
+        img_hw: Tuple[int, int],
+        text_resized_shape: Tuple[int, int],
+        mfd_resized_shape: Tuple[int, int],
+    ) -> float:
+        """Downscaling ratio keeping enough resolution for both models, at most 1."""
+        text_ratio = get_resized_ratio(img_hw, text_resized_shape, True)[0]
+        mfd_ratio = get_resized_ratio(img_hw, mfd_resized_shape, True)[0]
+        return min(1.0, max(text_ratio, mfd_ratio))
+
+    def _detect_one(
+        self,
+        img: np.ndarray,
+        color_order: str,
+        *,
+        text_resized_shape: Tuple[int, int],
+        mfd_resized_shape: Tuple[int, int],
+        min_box_size: int,
+        box_score_thresh: float,
+        box_margin: int,
+        conf_threshold: float,
+        iou_threshold: float,
+        suppress_isolated: bool,
+        isolated_overlap_thresh: float,
+        return_cropped_image: bool,
+    ) -> Dict[str, Any]:
+        height, width = img.shape[:2]
+        ratio = self._shared_ratio((height, width), text_resized_shape, mfd_resized_shape)
+        small = img
+        if ratio < 1.0:
+            small_wh = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+            small = cv2.resize(img, small_wh, interpolation=cv2.INTER_AREA)
+        scale = np.array(
+            [width / small.shape[1], height / small.shape[0]], dtype=np.float32
+        )
+
+        def detect_texts():
+            return self.text_detector.detect(
+                small,
+                resized_shape=text_resized_shape,
+                preserve_aspect_ratio=True,
+                min_box_size=max(1, int(min_box_size / scale.max())),
+                box_score_thresh=box_score_thresh,
+                color_order=color_order,
+                return_cropped_image=False,
+            )
+
+        def detect_formulas():
+            return self.formula_detector.analyze(
+                small,
+                resized_shape=mfd_resized_shape,
+                box_margin=0,
+                conf_threshold=conf_threshold,
+                iou_threshold=iou_threshold,
+                color_order=color_order,
+            )
+
+        if self._executor is not None:
+            formula_future = self._executor.submit(detect_formulas)
+            text_out = detect_texts()
+            formulas = formula_future.result()
+        else:
+            text_out = detect_texts()
+            formulas = detect_formulas()
+
+        angle = text_out['rotated_angle']
+        texts = []
+        for info in text_out['detected_texts']:
+            box = np.asarray(info['box'], dtype=np.float32).reshape(4, 2) * scale
+            texts.append({'type': 'text', 'box': box, 'score': info['score']})
+        lower = np.zeros(2, dtype=np.float32)
+        upper = np.array([width - 1, height - 1], dtype=np.float32)
+        for info in formulas:
+            box = np.asarray(info['box'], dtype=np.float32).reshape(4, 2) * scale
+            box += np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * box_margin
+            # text boxes are in the coordinates of the rotated page
+            info['box'] = _rotate_points(np.clip(box, lower, upper), -angle, (height, width))
+
+        if suppress_isolated:
+            isolated = [info for info in formulas if info['type'] == 'isolated']
+            covered = _covered_ratios(_bboxes(texts), _bboxes(isolated))
+            texts = [
+                info
+                for info, ratio in zip(texts, covered)
+                if ratio < isolated_overlap_thresh
+            ]
+
+        if return_cropped_image and len(texts) > 0:
+            self._crop_texts(img, color_order, angle, texts)
+        return dict(rotated_angle=angle, elements=sort_boxes(texts + formulas, key='box'))
+
+    def _crop_texts(
+        self,
+        img: np.ndarray,
+        color_order: str,
+        angle: float,
+        texts: List[Dict[str, Any]],
+    ) -> None:
+        det_model = self.text_detector.det_model
+        crops = extract_quad_crops(
+            rotate_page(img, -angle),
+            np.stack([info['box'] for info in texts]),
+            interpolation=det_model.crop_interpolation,
+            num_workers=det_model.crop_num_workers,
+            cvt_code=cv2.COLOR_BGR2RGB if color_order == 'bgr' else None,
+        )
+        for info, crop in zip(texts, crops):
+            info['cropped_img'] = crop
+        if self.text_detector.use_angle_clf:
+            self.text_detector._classify_angles(texts)
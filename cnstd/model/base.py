@@ -40,6 +40,8 @@ class DBPostProcessor(DetectionPostProcessor):
         box_thresh: minimal objectness score to consider a box
         bin_thresh: threshold used to binzarized p_map at inference time
         rotated_bbox: whether to detect non-vertical and non-horizontal boxes
+        unclip_ratio: ratio to expand the polygons; default to 2.2 with `rotated_bbox`, or else 1.5
+        kernel_size: size of the kernel opening the bitmap; default to `1 + height // 512` of the p_map
 
     """
 
@@ -50,6 +52,8 @@ class DBPostProcessor(DetectionPostProcessor):
         box_thresh: float = 0.1,
         bin_thresh: float = 0.3,
         rotated_bbox: bool = False,
+        unclip_ratio: Optional[float] = None,
+        kernel_size: Optional[int] = None,
     ) -> None:
 
         super().__init__(
@@ -57,8 +61,11 @@ class DBPostProcessor(DetectionPostProcessor):
             box_thresh=box_thresh,
             bin_thresh=bin_thresh,
             rotated_bbox=rotated_bbox,
+            kernel_size=kernel_size,
         )
-        self.unclip_ratio = 2.2 if self.rotated_bbox else 1.5
+        if unclip_ratio is None:
+            unclip_ratio = 2.2 if self.rotated_bbox else 1.5
+        self.unclip_ratio = unclip_ratio
 
     def polygon_to_box(
         self, points: np.ndarray,
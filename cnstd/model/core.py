@@ -18,23 +18,33 @@
 # under the License.
 # Credits: adapted from https://github.com/mindee/doctr
 
+import inspect
 import logging
-from typing import List, Any, Optional, Dict, Tuple, Union, Callable
+import warnings
+from functools import lru_cache
+from typing import List, Any, Optional, Dict, Tuple, Union
 
 import numpy as np
 import cv2
 from PIL import Image
 import torch
 
-from ..transforms import Resize
 from ..utils import (
-    pil_to_numpy,
     normalize_img_array,
     get_resized_ratio,
-    transform_rbbox_to_bbox,
+    check_color_order,
+    to_uint8_hwc,
+    InferenceRunner,
+    quantize_prob_map,
 )
+from ..utils.geometry import rbboxes_to_polygons, sort_polygons_points
 from ..utils.repr import NestedObject
-from ..utils._utils import rotate_page, get_bitmap_angle, extract_crops, extract_rcrops
+from ..utils._utils import (
+    rotate_page,
+    get_bitmap_angle,
+    extract_quad_crops,
+    quad_crop_sizes,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -58,6 +68,7 @@ class DetectionPostProcessor(NestedObject):
         box_thresh: minimal objectness score to consider a box
         bin_thresh: threshold used to binzarized p_map at inference time
         rotated_bbox: whether to detect non-vertical and non-horizontal boxes
+        kernel_size: size of the kernel opening the bitmap; default to `1 + height // 512` of the p_map
     """
 
     def __init__(
@@ -67,12 +78,14 @@ class DetectionPostProcessor(NestedObject):
         box_thresh: float = 0.5,
         bin_thresh: float = 0.5,
         rotated_bbox: bool = False,
+        kernel_size: Optional[int] = None,
     ) -> None:
 
         self.auto_rotate_whole_image = auto_rotate_whole_image
         self.box_thresh = box_thresh
         self.bin_thresh = bin_thresh
         self.rotated_bbox = rotated_bbox
+        self.kernel_size = kernel_size
 
     def extra_repr(self) -> str:
         return f"box_thresh={self.box_thresh}"
@@ -122,7 +135,7 @@ class DetectionPostProcessor(NestedObject):
 
         boxes_batch, angles_batch = [], []
         # Kernel for opening, empirical law for ksize
-        k_size = 1 + int(proba_map[0].shape[0] / 512)
+        k_size = self.kernel_size or 1 + int(proba_map[0].shape[0] / 512)
         kernel = np.ones((k_size, k_size), np.uint8)
 
         for p_, bitmap_ in zip(proba_map, bitmap):
@@ -141,23 +154,61 @@ class DetectionPostProcessor(NestedObject):
         return boxes_batch, angles_batch
 
 
+@lru_cache()
+def _uint8_interpolate_supported() -> bool:
+    """Whether `interpolate` resizes uint8 tensors with bilinear antialiasing, as torch >= 2.1 does on CPU."""
+    try:
+        torch.nn.functional.interpolate(
+            torch.zeros(1, 3, 4, 4, dtype=torch.uint8),
+            size=(2, 2),
+            mode='bilinear',
+            align_corners=False,
+            antialias=True,
+        )
+    except (TypeError, RuntimeError, NotImplementedError):
+        return False
+    return True
+
+
 class DetectionPredictor(NestedObject):
     """Implements an object able to localize text elements in a document
 
     Args:
-        pre_processor: transform inputs for easier batched model inference
         model: core detection architecture
+        context: device of the model
+        crop_interpolation: interpolation used for cropping boxes, see `extract_quad_crops`
+        crop_num_workers: number of threads used for cropping boxes
+        inference_mode: 'eager', 'channels_last', 'bf16' or 'compiled', see `InferenceRunner`;
+            other modes than 'eager' are checked against the eager outputs, and fall back to 'eager' on mismatch
     """
 
     _children_names: List[str] = ['model']
 
-    def __init__(self, model, *, context='cpu') -> None:
+    def __init__(
+        self,
+        model,
+        *,
+        context='cpu',
+        crop_interpolation: str = 'linear',
+        crop_num_workers: int = 4,
+        inference_mode: str = 'eager',
+    ) -> None:
         self.device = torch.device(context)
         self.model = model
         self.model.eval()
-        self.extract_crops_fn = (
-            extract_rcrops if self.model.rotated_bbox else extract_crops
+        self.crop_interpolation = crop_interpolation
+        self.crop_num_workers = crop_num_workers
+        self._runner = InferenceRunner(
+            self.model,
+            inference_mode,
+            forward=self.model.forward_prob_map,
+            device=self.device,
         )
+        self._runner.check_parity(torch.rand(1, 3, 256, 256, device=self.device))
+
+    @property
+    def inference_mode(self) -> str:
+        return self._runner.inference_mode
 
     @torch.no_grad()
     def __call__(
@@ -167,6 +218,9 @@ class DetectionPredictor(NestedObject):
         preserve_aspect_ratio: bool = True,
         min_box_size: int = 8,
         box_score_thresh: float = 0.5,
+        color_order: str = 'rgb',
+        return_cropped_image: bool = True,
+        return_prob_map: bool = False,
         **kwargs: Any,
     ) -> List[Dict[str, Any]]:
         """
@@ -174,34 +228,99 @@ class DetectionPredictor(NestedObject):
         Args:
             img_list: list, which element's should be one type of Image.Image and np.ndarray.
                 For Image.Image, it should be generated from read_img;
-                For np.ndarray, it should be RGB-style, with shape [H, W, 3], scale [0, 255]
+                For np.ndarray, it should be with shape [H, W, 3], scale [0, 255], and in the order of `color_order`.
+                uint8 arrays are used in place, without any full-size copy
             resized_shape: tuple, [height, width], height and width after resizing original images
             preserve_aspect_ratio: whether or not preserve aspect ratio of original images when resizing them
             min_box_size: minimal size of detected boxes; boxes with smaller height or width will be ignored
             box_score_thresh: score threshold for boxes, boxes with scores lower than this value will be ignored
-            **kwargs:
+            color_order: color order of the np.ndarray images, 'rgb' or 'bgr'
+            return_cropped_image: whether or not extract 'cropped_img' for the boxes;
+                without crops, the original images are not rotated either
+            return_prob_map: whether or not return the quantized probability map of each image as 'prob_map',
+                which can be post-processed again by `postprocess()` with other parameters
+            **kwargs: ignored, kept for compatibility; only the probability map is computed by the model,
+                the arguments of `model.forward()` for training are not used in inference
 
         Returns:
 
         """
         if len(img_list) == 0:
             return []
-        size_transform = Resize(
-            resized_shape, preserve_aspect_ratio=preserve_aspect_ratio
-        )
-        ori_imgs, batch, compress_ratios = self.preprocess(
-            img_list, resized_shape, size_transform, preserve_aspect_ratio
+        color_order = check_color_order(color_order)
+        ori_imgs, bgr_flags, batch, compress_ratios = self.preprocess(
+            img_list, resized_shape, preserve_aspect_ratio, color_order
         )
 
-        out = self.model(batch, return_preds=True, **kwargs)
-        boxes, angles = out['preds']
+        prob_maps = self._runner(batch).squeeze(1).cpu().numpy().astype(np.float32)
+        postprocessed = self.postprocess(
+            self.model.postprocessor,
+            prob_maps,
+            [image.shape[:2] for image in ori_imgs],
+            compress_ratios,
+            box_score_thresh,
+            min_box_size,
+        )
         results = []
-        for image, _boxes, compress_ratio, angle in zip(
-            ori_imgs, boxes, compress_ratios, angles
+        for idx, (image, is_bgr, (quads, scores, angle)) in enumerate(
+            zip(ori_imgs, bgr_flags, postprocessed)
+        ):
+            if not return_cropped_image:
+                one_out = [dict(box=box, score=score) for box, score in zip(quads, scores)]
+            else:
+                rotated_img = rotate_page(image, -angle)  # res: [H, W, 3], uint8
+                crops = extract_quad_crops(
+                    rotated_img,
+                    quads,
+                    interpolation=self.crop_interpolation,
+                    num_workers=self.crop_num_workers,
+                    cvt_code=cv2.COLOR_BGR2RGB if is_bgr else None,
+                )
+                one_out = [
+                    dict(box=box, score=score, cropped_img=crop)
+                    for box, score, crop in zip(quads, scores, crops)
+                ]
+            result = {'rotated_angle': angle, 'detected_texts': one_out}
+            if return_prob_map:
+                result['prob_map'] = self._prob_map_record(
+                    prob_maps[idx],
+                    image.shape[:2],
+                    compress_ratios[idx],
+                    box_score_thresh,
+                    min_box_size,
+                )
+            results.append(result)
+
+        return results
+
+    @classmethod
+    def postprocess(
+        cls,
+        postprocessor: DetectionPostProcessor,
+        prob_maps: np.ndarray,
+        image_shapes: List[Tuple[int, int]],
+        compress_ratios: List[Tuple[float, float]],
+        box_score_thresh: float,
+        min_box_size: int,
+    ) -> List[Tuple[np.ndarray, List[float], float]]:
+        """
+        Get the boxes of the original images from the probability maps of the model.
+
+        Args:
+            postprocessor: the post processor of the model
+            prob_maps: probability maps of shape (N, H, W)
+            image_shapes: (height, width) of the original images
+            compress_ratios: compress ratios of the original images, see `_compress_ratio()`
+            box_score_thresh: boxes with lower scores are ignored
+            min_box_size: boxes with smaller height or width are ignored
+
+        Returns: list of (quads, scores, angle) for each image, where quads is an (K, 4, 2) array of the kept boxes
+        """
+        boxes, angles = postprocessor(prob_maps)
+        outs = []
+        for image_shape, _boxes, compress_ratio, angle in zip(
+            image_shapes, boxes, compress_ratios, angles
         ):
-            # image = restore_img(image.numpy().transpose((1, 2, 0)))  # res: [H, W, 3]
-            image = image.transpose((1, 2, 0)).astype(np.uint8)  # res: [H, W, 3]
-            rotated_img = np.ascontiguousarray(rotate_page(image, -angle))
 
             _scores = _boxes[:, -1].tolist()
             _boxes = _boxes[:, :-1]
@@ -212,61 +331,147 @@ class DetectionPredictor(NestedObject):
             _boxes[:, [1, 3]] = np.clip(_boxes[:, [1, 3]], 0.0, 1.0)
 
             out_boxes = _boxes.copy()
-            out_boxes[:, [0, 2]] *= rotated_img.shape[1]
-            out_boxes[:, [1, 3]] *= rotated_img.shape[0]
-
-            one_out = []
-            for crop, score, box in zip(
-                self.extract_crops_fn(rotated_img, _boxes), _scores, out_boxes
-            ):
-                if score < box_score_thresh:
-                    continue
-                if min(crop.shape[:2]) < min_box_size:
-                    continue
-                if len(box) == 4:  # (xmin, ymin, xmax, ymax)
-                    xmin, ymin, xmax, ymax = box
-                    box = np.array(
-                        [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]]
-                    )
-                else:
-                    box = transform_rbbox_to_bbox(*list(box))
-                one_out.append(dict(box=box, score=score, cropped_img=crop))
-            results.append({'rotated_angle': angle, 'detected_texts': one_out[::-1]})
+            # rotating keeps the image shape
+            out_boxes[:, [0, 2]] *= image_shape[1]
+            out_boxes[:, [1, 3]] *= image_shape[0]
+            quads = cls._to_quads(out_boxes)
 
-        return results
+            keep = (np.asarray(_scores) >= box_score_thresh) & (
+                quad_crop_sizes(quads).min(axis=1) >= min_box_size
+            )
+            keep = np.nonzero(keep)[0][::-1]
+            outs.append((quads[keep], [_scores[idx] for idx in keep], angle))
+        return outs
+
+    def _prob_map_record(
+        self, prob_map, image_shape, compress_ratio, box_score_thresh, min_box_size
+    ) -> Dict[str, Any]:
+        """The quantized probability map, with what is needed to replay `postprocess()` on it."""
+        postprocessor = self.model.postprocessor
+        return dict(
+            map=quantize_prob_map(prob_map),
+            detector='cnstd',
+            image_shape=[int(v) for v in image_shape],
+            compress_ratio=[float(v) for v in compress_ratio],
+            params=dict(
+                box_score_thresh=box_score_thresh,
+                min_box_size=min_box_size,
+                bin_thresh=postprocessor.bin_thresh,
+                box_thresh=postprocessor.box_thresh,
+                unclip_ratio=postprocessor.unclip_ratio,
+                kernel_size=postprocessor.kernel_size,
+                rotated_bbox=postprocessor.rotated_bbox,
+                auto_rotate_whole_image=postprocessor.auto_rotate_whole_image,
+            ),
+        )
+
+    @staticmethod
+    def _to_quads(boxes: np.ndarray) -> np.ndarray:
+        """
+        Convert absolute boxes (xmin, ymin, xmax, ymax) or (x, y, w, h, alpha) to an (N, 4, 2) array,
+        with points ordered as (top-left, top-right, bottom-right, bottom-left).
+        """
+        if boxes.shape[1] == 4:
+            xmin, ymin, xmax, ymax = boxes.T
+            return np.stack(
+                [
+                    np.stack((xmin, ymin), axis=1),
+                    np.stack((xmax, ymin), axis=1),
+                    np.stack((xmax, ymax), axis=1),
+                    np.stack((xmin, ymax), axis=1),
+                ],
+                axis=1,
+            ).astype(np.float32)
+        return sort_polygons_points(rbboxes_to_polygons(boxes))
 
     def preprocess(
         self,
         pil_img_list: List[Union[Image.Image, np.ndarray]],
         resized_shape: Tuple[int, int],
-        size_transform: Callable,
         preserve_aspect_ratio: bool,
-    ) -> Tuple[List[np.ndarray], torch.Tensor, List[Tuple[float, float]]]:
-        ori_img_list = []
+        color_order: str = 'rgb',
+    ) -> Tuple[List[np.ndarray], List[bool], torch.Tensor, List[Tuple[float, float]]]:
+        """
+        Resize the uint8 images directly, so no float copy of the original images is ever made.
+
+        Returns: (original images, whether each original image is BGR-style, batch tensor, compress ratios)
+            * original images: uint8 np.ndarray with shape [H, W, 3], sharing memory with the inputs when possible
+        """
+        ori_img_list, bgr_flags = [], []
         img_list = []
         compress_ratios_list = []
         for img in pil_img_list:
-            if isinstance(img, Image.Image):
-                img = pil_to_numpy(img)  # res: np.ndarray, RGB-style, [3, H, W]
-            elif isinstance(img, np.ndarray) and img.shape[2] == 3:
-                img = img.transpose((2, 0, 1))  # [H, W, 3] to [3, H, W]
-            else:
+            if not isinstance(img, (Image.Image, np.ndarray)):
                 raise ValueError('unsupported image input is found')
+            is_bgr = isinstance(img, np.ndarray) and color_order == 'bgr'
+            img = to_uint8_hwc(img)
 
             ori_img_list.append(img)
+            bgr_flags.append(is_bgr)
             compress_ratio = self._compress_ratio(
-                img.shape[1:], resized_shape, preserve_aspect_ratio
+                img.shape[:2], resized_shape, preserve_aspect_ratio
             )
             compress_ratios_list.append(compress_ratio)
-            img = size_transform(torch.from_numpy(img)).numpy()
+            img = self._resize(img, resized_shape, preserve_aspect_ratio)
+            if is_bgr:
+                img = img[::-1]
             img = normalize_img_array(img)
             img_list.append(torch.from_numpy(img))
         return (
             ori_img_list,
+            bgr_flags,
             torch.stack(img_list, dim=0).to(device=self.device),
             compress_ratios_list,
         )
 
+    @staticmethod
+    def _resize(
+        img: np.ndarray, resized_shape: Tuple[int, int], preserve_aspect_ratio: bool
+    ) -> np.ndarray:
+        """
+        Same as `Resize`, but works on the uint8 [H, W, 3] image viewed as a channels-last tensor.
+
+        Returns: np.ndarray, uint8, with shape [3, *resized_shape]
+        """
+        target_h, target_w = resized_shape
+        ori_h, ori_w = img.shape[:2]
+        tmp_size = (target_h, target_w)
+        if preserve_aspect_ratio:
+            if ori_h / ori_w > target_h / target_w:
+                tmp_size = (target_h, int(target_h * ori_w / ori_h))
+            elif ori_h / ori_w < target_h / target_w:
+                tmp_size = (int(target_w * ori_h / ori_w), target_w)
+
+        with warnings.catch_warnings():
+            # arrays from Image.Image are read-only, but they are never written here
+            warnings.simplefilter('ignore', UserWarning)
+            x = torch.from_numpy(img).permute(2, 0, 1)  # a view, [3, H, W]
+        if tuple(x.shape[1:]) != tmp_size:
+            if _uint8_interpolate_supported():
+                x = torch.nn.functional.interpolate(
+                    x.unsqueeze(0),
+                    size=tmp_size,
+                    mode='bilinear',
+                    align_corners=False,
+                    antialias=True,
+                )[0]
+            else:
+                # older torch releases only resize float tensors (without `antialias` before 1.11)
+                kwargs = dict()
+                if 'antialias' in inspect.signature(torch.nn.functional.interpolate).parameters:
+                    kwargs['antialias'] = True
+                x = torch.nn.functional.interpolate(
+                    x.unsqueeze(0).float(),
+                    size=tmp_size,
+                    mode='bilinear',
+                    align_corners=False,
+                    **kwargs,
+                )[0]
+                x = x.round_().clamp_(0, 255).to(torch.uint8)
+        out = np.zeros((3, target_h, target_w), dtype=np.uint8)
+        out[:, : tmp_size[0], : tmp_size[1]] = x.numpy()
+        return out
+
     def _compress_ratio(self, ori_hw, target_hw, preserve_aspect_ratio):
         if not preserve_aspect_ratio:
             return 1.0, 1.0
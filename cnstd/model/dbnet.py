@@ -117,6 +117,17 @@ class DBNet(_DBNet, nn.Module):
             **kwargs,
         )
 
+    def _extract_features(self, x: torch.Tensor) -> torch.Tensor:
+        # Extract feature maps at different stages
+        feats = self.feat_extractor(x)
+        feats = [feats[str(idx)] for idx in range(len(feats))]
+        # Pass through the FPN
+        return self.fpn(feats)
+
+    def forward_prob_map(self, x: torch.Tensor) -> torch.Tensor:
+        """Only compute the probability map, with shape [N, 1, H, W], for inference."""
+        return torch.sigmoid(self.prob_head(self._extract_features(x)))
+
     def forward(
         self,
         x: torch.Tensor,  # [N, C, H, W]
@@ -148,11 +159,7 @@ class DBNet(_DBNet, nn.Module):
             "loss": scalar tensor
 
         """
-        # Extract feature maps at different stages
-        feats = self.feat_extractor(x)
-        feats = [feats[str(idx)] for idx in range(len(feats))]
-        # Pass through the FPN
-        feat_concat = self.fpn(feats)
+        feat_concat = self._extract_features(x)
         logits = self.prob_head(feat_concat)
 
         out: Dict[str, Any] = {}
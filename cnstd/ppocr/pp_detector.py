@@ -20,7 +20,6 @@
 
 import os
 import time
-from copy import deepcopy
 from typing import Union, Optional, Any, List, Dict, Tuple
 from pathlib import Path
 import logging
@@ -32,17 +31,33 @@ import numpy as np
 
 from .consts import PP_SPACE
 from ..consts import MODEL_VERSION, AVAILABLE_MODELS, DOWNLOAD_SOURCE
-from ..utils import data_dir, get_model_file, sort_boxes, get_resized_shape
+from ..utils import (
+    data_dir,
+    get_model_file,
+    sort_boxes,
+    get_resized_shape,
+    extract_quad_crops,
+    check_color_order,
+    split_image_batch,
+    to_uint8_hwc,
+    quantize_prob_map,
+    dequantize_prob_map,
+)
+from ..utils.geometry import (
+    sort_polygons_points,
+    clip_polygons,
+    polygons_side_lengths,
+)
 from .utility import (
     get_image_file_list,
     check_and_read_gif,
     create_predictor,
     parse_args,
     draw_text_det_res,
-    get_rotate_crop_image,
 )
 from .opt_utils import transform, create_operators
 from .postprocess import build_post_process
+from .postprocess.db_postprocess import DBPostProcess
 from .img_operators import DetResizeForTest
 
 logger = logging.getLogger(__name__)
@@ -61,10 +76,16 @@ class PPDetector(object):
         unclip_ratio=1.5,
         use_dilation=False,
         det_db_score_mode='fast',
+        vectorized_postprocess=True,
+        crop_interpolation='linear',
+        crop_num_workers=4,
+        postprocess_num_workers=1,
         **kwargs,
     ):
         self._model_name = model_name
         self._model_backend = 'onnx'
+        self.crop_interpolation = crop_interpolation
+        self.crop_num_workers = crop_num_workers
 
         self._assert_and_prepare_model_files(model_fp, root)
 
@@ -76,6 +97,8 @@ class PPDetector(object):
             "score_mode": det_db_score_mode,
             "bin_thresh": bin_thresh,
             "box_thresh": box_thresh,
+            "vectorized": vectorized_postprocess,
+            "num_workers": postprocess_num_workers,
         }
         self.postprocess_op = build_post_process(postprocess_params)
         (
@@ -164,19 +187,29 @@ class PPDetector(object):
             points[pno, 1] = int(min(max(points[pno, 1], 0), img_height - 1))
         return points
 
-    def filter_tag_det_res(self, dt_boxes, image_shape, min_box_size):
+    @staticmethod
+    def filter_tag_det_res(dt_boxes, image_shape, min_box_size):
+        """
+        Order, clip and filter all the boxes at once.
+
+        Args:
+            dt_boxes: list of (box, score), box with shape [4, 2]
+            image_shape: shape of the original image
+            min_box_size: boxes with smaller height or width will be ignored
+
+        Returns:
+            list of (box, score), box is a float32 ndarray with shape [4, 2]
+        """
+        if len(dt_boxes) == 0:
+            return []
         img_height, img_width = image_shape[0:2]
-        dt_boxes_new = []
-        for box, score in dt_boxes:
-            box = self.order_points_clockwise(box)
-            box = self.clip_det_res(box, img_height, img_width)
-            rect_width = int(np.linalg.norm(box[0] - box[1]))
-            rect_height = int(np.linalg.norm(box[0] - box[3]))
-            if min(rect_width, rect_height) < min_box_size:
-                continue
-            dt_boxes_new.append((box, score))
-        # dt_boxes = np.array(dt_boxes_new)
-        return dt_boxes_new
+        boxes, scores = zip(*dt_boxes)
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4, 2)
+        boxes = sort_polygons_points(boxes, swap_ties=False)
+        boxes = clip_polygons(boxes, img_height, img_width)
+        sides = polygons_side_lengths(boxes).astype(int)
+        keep = np.nonzero(sides.min(axis=1) >= min_box_size)[0]
+        return [(boxes[idx], scores[idx]) for idx in keep]
 
     def detect(
         self,
@@ -191,11 +224,22 @@ class PPDetector(object):
         preserve_aspect_ratio: bool = True,
         box_score_thresh: float = 0.3,
         min_box_size: int = 4,
+        color_order: str = 'rgb',
+        return_cropped_image: bool = True,
+        return_prob_map: bool = False,
         **kwargs,
     ) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        """
+        检测图片中的文本，参数与返回结果可参考 `Detector.detect()`。
+
+        `return_prob_map==True` 时，每张图片的结果中还包含模型输出的概率图 'prob_map'（量化为 uint8），
+        可用 `PPDetector.postprocess_prob_map()` 以其他后处理参数重新获得文本框，而不需要再次运行模型。
+        """
+        color_order = check_color_order(color_order)
+        img_list, _ = split_image_batch(img_list)
         outs = []
         for img in img_list:
-            img = self._preprocess_images(img)
+            img, img_color_order = self._preprocess_images(img, color_order)
             outs.append(
                 self.detect_one(
                     img,
@@ -203,6 +247,9 @@ class PPDetector(object):
                     preserve_aspect_ratio,
                     box_score_thresh,
                     min_box_size,
+                    color_order=img_color_order,
+                    return_cropped_image=return_cropped_image,
+                    return_prob_map=return_prob_map,
                 )
             )
 
@@ -215,8 +262,21 @@ class PPDetector(object):
         preserve_aspect_ratio: bool,
         box_score_thresh: float = 0.6,
         min_box_size: int = 4,
+        color_order: str = 'bgr',
+        return_cropped_image: bool = True,
+        return_prob_map: bool = False,
     ):
-        ori_im = img.copy()
+        """
+        Detect texts in one image. `img` is never copied or modified;
+        only the resized image is converted to the BGR order required by the model.
+
+        Args:
+            img: uint8 ndarray with shape [H, W, 3]
+            color_order: color order of `img`, 'bgr' or 'rgb'
+            return_cropped_image: whether or not extract 'cropped_img' for the boxes
+            return_prob_map: whether or not return the quantized probability map as 'prob_map'
+        """
+        ori_im = img
         data = {'image': img}
 
         if isinstance(self.preprocess_op[0], DetResizeForTest):
@@ -224,59 +284,157 @@ class PPDetector(object):
             self.preprocess_op[0].image_shape = get_resized_shape(
                 img.shape[:2], resized_shape, preserve_aspect_ratio, divided_by=32
             )
-        data = transform(data, self.preprocess_op)
-        img, shape_list = data
-        if img is None:
+        data = transform(data, self.preprocess_op[:1])
+        if data is None or data['image'] is None:
             return None, 0
-        img = np.expand_dims(img, axis=0)
+        if color_order == 'rgb':
+            data['image'] = data['image'][:, :, ::-1]
+        img, shape_list = transform(data, self.preprocess_op[1:])
+        img = np.ascontiguousarray(np.expand_dims(img, axis=0))
         shape_list = np.expand_dims(shape_list, axis=0)
-        img = img.copy()
 
         input_dict = {}
         input_dict[self.input_tensor.name] = img
         outputs = self.predictor.run(self.output_tensors, input_dict)
 
-        preds = {'maps': outputs[0]}
+        dt_boxes = self.postprocess(
+            self.postprocess_op,
+            outputs[0],
+            shape_list,
+            ori_im.shape,
+            box_score_thresh,
+            min_box_size,
+        )
+        if not return_cropped_image:
+            detected_results = [{'box': box, 'score': score} for box, score in dt_boxes]
+        else:
+            crops = extract_quad_crops(
+                ori_im,
+                np.array([box for box, _ in dt_boxes]),
+                interpolation=self.crop_interpolation,
+                num_workers=self.crop_num_workers,
+                cvt_code=cv2.COLOR_BGR2RGB if color_order == 'bgr' else None,
+            )
+            detected_results = []
+            for (box, score), img_crop in zip(dt_boxes, crops):
+                detected_results.append(
+                    {'box': box, 'score': score, 'cropped_img': img_crop}
+                )
+
+        out = dict(rotated_angle=0.0, detected_texts=detected_results)
+        if return_prob_map:
+            out['prob_map'] = dict(
+                map=quantize_prob_map(outputs[0][0, 0]),
+                detector='ppocr',
+                image_shape=[int(v) for v in ori_im.shape[:2]],
+                shape_list=[float(v) for v in shape_list[0]],
+                params=dict(
+                    box_score_thresh=box_score_thresh,
+                    min_box_size=min_box_size,
+                    bin_thresh=self.postprocess_op.bin_thresh,
+                    unclip_ratio=self.postprocess_op.unclip_ratio,
+                    use_dilation=self.postprocess_op.dilation_kernel is not None,
+                    kernel_size=(
+                        2
+                        if self.postprocess_op.dilation_kernel is None
+                        else int(self.postprocess_op.dilation_kernel.shape[0])
+                    ),
+                    score_mode=self.postprocess_op.score_mode,
+                    max_candidates=self.postprocess_op.max_candidates,
+                ),
+            )
+        return out
+
+    @classmethod
+    def postprocess(
+        cls,
+        postprocess_op: DBPostProcess,
+        prob_map: np.ndarray,
+        shape_list: np.ndarray,
+        image_shape: Tuple[int, ...],
+        box_score_thresh: float,
+        min_box_size: int,
+    ) -> List[Tuple[np.ndarray, float]]:
+        """
+        Get the sorted (box, score) pairs of the original image from the probability map of the model.
 
-        post_result = self.postprocess_op(
-            preds, shape_list, box_thresh=box_score_thresh
+        Args:
+            postprocess_op: the DB post processor
+            prob_map: probability map with shape [1, 1, H, W]
+            shape_list: [[src_h, src_w, ratio_h, ratio_w]] of the resized image
+            image_shape: shape of the original image
+            box_score_thresh: boxes with lower scores are ignored
+            min_box_size: boxes with smaller height or width are ignored
+        """
+        post_result = postprocess_op(
+            {'maps': prob_map}, shape_list, box_thresh=box_score_thresh
         )
         dt_boxes = list(zip(post_result[0]['points'], post_result[0]['scores']))
-        dt_boxes = self.filter_tag_det_res(dt_boxes, ori_im.shape, min_box_size)
-        dt_boxes = sort_boxes(dt_boxes, key=0)
-
-        detected_results = []
-        for bno in range(len(dt_boxes)):
-            box, score = dt_boxes[bno]
-            img_crop = get_rotate_crop_image(ori_im, deepcopy(box))
-            img_crop = cv2.cvtColor(img_crop, cv2.COLOR_BGR2RGB)
-            detected_results.append(
-                {'box': box, 'score': score, 'cropped_img': img_crop.astype('uint8')}
-            )
+        dt_boxes = cls.filter_tag_det_res(dt_boxes, image_shape, min_box_size)
+        return sort_boxes(dt_boxes, key=0)
 
-        return dict(rotated_angle=0.0, detected_texts=detected_results)
+    @classmethod
+    def postprocess_prob_map(cls, prob_map: Dict[str, Any], **params) -> Dict[str, Any]:
+        """
+        只对 `detect(..., return_prob_map=True)` 返回的概率图重新做后处理，不需要再次运行模型。
+
+        Args:
+            prob_map: 检测结果中的 'prob_map'
+            **params: 替换检测时所用的后处理参数，可以是：
+                'box_score_thresh', 'min_box_size': 含义与 `detect()` 中的相同；
+                'bin_thresh'：概率图二值化的阈值；
+                'unclip_ratio'：文本框向外扩张的比例；
+                'use_dilation'：是否对二值图做 dilation；
+                'kernel_size'：dilation 的 kernel 大小。
+
+        Returns:
+            Dict, 与 `detect(..., return_cropped_image=False)` 返回的每张图片的结果格式相同
+        """
+        params = {**prob_map['params'], **params}
+        postprocess_op = DBPostProcess(
+            bin_thresh=params['bin_thresh'],
+            box_thresh=params['box_score_thresh'],
+            max_candidates=params['max_candidates'],
+            unclip_ratio=params['unclip_ratio'],
+            use_dilation=params['use_dilation'],
+            score_mode=params['score_mode'],
+            dilation_kernel_size=params['kernel_size'],
+        )
+        dt_boxes = cls.postprocess(
+            postprocess_op,
+            dequantize_prob_map(prob_map['map'])[None, None],
+            np.asarray([prob_map['shape_list']]),
+            prob_map['image_shape'],
+            params['box_score_thresh'],
+            params['min_box_size'],
+        )
+        detected_texts = [{'box': box, 'score': score} for box, score in dt_boxes]
+        return dict(rotated_angle=0.0, detected_texts=detected_texts)
 
     @classmethod
     def _preprocess_images(
-        cls, img: Union[str, Path, Image.Image, np.ndarray]
-    ) -> np.ndarray:
+        cls, img: Union[str, Path, Image.Image, np.ndarray], color_order: str = 'rgb'
+    ) -> Tuple[np.ndarray, str]:
         """
+        No color conversion is done here, the full-size image is kept as it is.
 
         Args:
-            img ():
+            img (): image file path, Image.Image, or ndarray with shape [H, W, 3]
+            color_order (): color order of the ndarray `img`, 'rgb' or 'bgr'
 
-        Returns:
-            BGR format ndarray: [H, W, 3]
+        Returns: (img, color_order)
+            * img: uint8 ndarray: [H, W, 3]
+            * color_order: color order of the returned `img`
 
         """
         if isinstance(img, (str, Path)):
             if not os.path.isfile(img):
                 raise FileNotFoundError(img)
-            return cv2.imread(img, cv2.IMREAD_COLOR)
+            return cv2.imread(str(img), cv2.IMREAD_COLOR), 'bgr'
         elif isinstance(img, Image.Image):
-            img = np.asarray(img.convert('RGB'), dtype='float32')
-        if isinstance(img, np.ndarray):
-            return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            return to_uint8_hwc(img), 'rgb'
+        elif isinstance(img, np.ndarray):
+            return to_uint8_hwc(img), color_order
         else:
             raise TypeError('type %s is not supported now' % str(type(img)))
 
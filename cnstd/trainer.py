@@ -18,6 +18,7 @@
 # under the License.
 # Credits: adapted from https://github.com/mindee/doctr
 
+import os
 import logging
 from pathlib import Path
 from typing import Any, Optional, Union, List
@@ -237,4 +238,7 @@ def resave_model(module_fp, output_model_fp, map_location=None):
     state_dict = {}
     for k, v in checkpoint['state_dict'].items():
         state_dict[k.split('.', maxsplit=1)[1]] = v
-    torch.save({'state_dict': state_dict}, output_model_fp)
+    # replace, not overwrite: the file may be memory-mapped by running predictors
+    tmp_fp = '%s.tmp%d' % (output_model_fp, os.getpid())
+    torch.save({'state_dict': state_dict}, tmp_fp)
+    os.replace(tmp_fp, output_model_fp)
@@ -23,3 +23,31 @@ from .common_types import *
 from .metrics import *
 from .utils import *
 from ._utils import *
+from .stream import *
+from .multiscale import *
+from .jobs import *
+from .export import *
+from .prob_map import *
+from .evaluation import *
+from .sweep import *
+
+# names of the modules importing torch, which is only imported when one of them is used
+_LAZY_ATTRS = {
+    name: '.inference'
+    for name in (
+        'INFERENCE_MODES',
+        'check_inference_mode',
+        'bf16_supported',
+        'InferenceRunner',
+    )
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    import importlib
+
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -18,13 +18,32 @@
 # under the License.
 # Credits: adapted from https://github.com/mindee/doctr
 
-import numpy as np
-import cv2
+from concurrent.futures import ThreadPoolExecutor
 from math import floor
-from typing import List
+from typing import List, Optional, Tuple
 from statistics import median_low
 
-__all__ = ['estimate_orientation', 'extract_crops', 'extract_rcrops', 'rotate_page', 'get_bitmap_angle']
+import numpy as np
+import cv2
+
+__all__ = [
+    'estimate_orientation',
+    'extract_crops',
+    'extract_rcrops',
+    'extract_quad_crops',
+    'quad_crop_sizes',
+    'pack_crops',
+    'rotate_page',
+    'get_bitmap_angle',
+]
+
+INTERPOLATIONS = {
+    'nearest': cv2.INTER_NEAREST,
+    'linear': cv2.INTER_LINEAR,
+    'cubic': cv2.INTER_CUBIC,
+    'area': cv2.INTER_AREA,
+    'lanczos': cv2.INTER_LANCZOS4,
+}
 
 
 def extract_crops(img: np.ndarray, boxes: np.ndarray) -> List[np.ndarray]:
@@ -159,6 +178,204 @@ def _process_vertical_box(img, box, dtype):
     return crop
 
 
+def quad_crop_sizes(quads: np.ndarray) -> np.ndarray:
+    """Sizes of the crops of quadrilateral boxes.
+
+    Args:
+        quads: (N, 4, 2) array, points ordered as (top-left, top-right, bottom-right, bottom-left)
+
+    Returns:
+        (N, 2) int array, with columns (width, height)
+    """
+    quads = np.asarray(quads, dtype=np.float32).reshape(-1, 4, 2)
+    widths = np.maximum(
+        np.linalg.norm(quads[:, 0] - quads[:, 1], axis=-1),
+        np.linalg.norm(quads[:, 2] - quads[:, 3], axis=-1),
+    )
+    heights = np.maximum(
+        np.linalg.norm(quads[:, 0] - quads[:, 3], axis=-1),
+        np.linalg.norm(quads[:, 1] - quads[:, 2], axis=-1),
+    )
+    return np.stack((widths, heights), axis=1).astype(np.int64)
+
+
+def _perspective_transforms(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """Batched version of `cv2.getPerspectiveTransform`.
+
+    Args:
+        src: (N, 4, 2) source points
+        dst: (N, 4, 2) destination points
+
+    Returns:
+        (N, 3, 3) float64 array of transforms
+    """
+    num = src.shape[0]
+    x, y = src[:, :, 0].astype(np.float64), src[:, :, 1].astype(np.float64)
+    u, v = dst[:, :, 0].astype(np.float64), dst[:, :, 1].astype(np.float64)
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    a_u = np.stack((x, y, ones, zeros, zeros, zeros, -x * u, -y * u), axis=-1)
+    a_v = np.stack((zeros, zeros, zeros, x, y, ones, -x * v, -y * v), axis=-1)
+    a = np.concatenate((a_u, a_v), axis=1)  # (N, 8, 8)
+    b = np.concatenate((u, v), axis=1)  # (N, 8)
+
+    mats = np.zeros((num, 9), dtype=np.float64)
+    valid = np.abs(np.linalg.det(a)) > 1e-9
+    if valid.any():
+        mats[valid, :8] = np.linalg.solve(a[valid], b[valid][:, :, None])[:, :, 0]
+    mats[:, 8] = 1.0
+    for idx in np.nonzero(~valid)[0]:  # degenerated boxes
+        mats[idx] = cv2.getPerspectiveTransform(
+            src[idx].astype(np.float32), dst[idx].astype(np.float32)
+        ).reshape(-1)
+    return mats.reshape(num, 3, 3)
+
+
+def extract_quad_crops(
+    img: np.ndarray,
+    quads: np.ndarray,
+    *,
+    interpolation: str = 'linear',
+    num_workers: int = 4,
+    cvt_code: Optional[int] = None,
+    rotate_vertical: bool = True,
+) -> List[np.ndarray]:
+    """Crop quadrilateral (rotated or perspective) boxes from an image, and warp them to be horizontal.
+
+    All the transforms are computed in one vectorized step. Each box is warped from a small ROI of the image
+    instead of the whole image, and the warps run in a thread pool since OpenCV releases the GIL.
+    Axis-aligned boxes with integer coordinates are sliced directly.
+
+    Args:
+        img: [H, W, C] or [H, W] uint8 image
+        quads: (N, 4, 2) array of absolute coordinates, points ordered as
+            (top-left, top-right, bottom-right, bottom-left)
+        interpolation: one of 'nearest', 'linear', 'cubic', 'area' and 'lanczos'. Default: 'linear'
+        num_workers: number of threads used for warping. Default: 4
+        cvt_code: if not None, each crop is converted by `cv2.cvtColor(crop, cvt_code)`,
+            e.g. `cv2.COLOR_BGR2RGB`
+        rotate_vertical: rotate crops with `height / width >= 1.5` by 90 degrees. Default: True
+
+    Returns:
+        list of N cropped images, with the same dtype as `img`
+    """
+    quads = np.asarray(quads, dtype=np.float32).reshape(-1, 4, 2)
+    num = quads.shape[0]
+    if num == 0:
+        return []
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(
+            'interpolation should be one of %s, but got %s'
+            % (list(INTERPOLATIONS.keys()), interpolation)
+        )
+    flags = INTERPOLATIONS[interpolation]
+    img_h, img_w = img.shape[:2]
+
+    sizes = np.maximum(quad_crop_sizes(quads), 1)
+    # ROIs containing all the pixels possibly sampled by the interpolation
+    pad = 3
+    x0 = np.clip(np.floor(quads[:, :, 0].min(axis=1)) - pad, 0, img_w - 1).astype(np.int64)
+    y0 = np.clip(np.floor(quads[:, :, 1].min(axis=1)) - pad, 0, img_h - 1).astype(np.int64)
+    x1 = np.clip(np.ceil(quads[:, :, 0].max(axis=1)) + pad + 1, 1, img_w).astype(np.int64)
+    y1 = np.clip(np.ceil(quads[:, :, 1].max(axis=1)) + pad + 1, 1, img_h).astype(np.int64)
+
+    dst = np.zeros((num, 4, 2), dtype=np.float64)
+    dst[:, 1, 0] = dst[:, 2, 0] = sizes[:, 0]
+    dst[:, 2, 1] = dst[:, 3, 1] = sizes[:, 1]
+    src = quads.astype(np.float64) - np.stack((x0, y0), axis=1)[:, None, :]
+    mats = _perspective_transforms(src, dst)
+
+    # boxes which are just a slice of the image
+    int_quads = np.round(quads)
+    axis_aligned = (
+        np.all(np.abs(quads - int_quads) < 1e-3, axis=(1, 2))
+        & (int_quads[:, 0, 1] == int_quads[:, 1, 1])
+        & (int_quads[:, 2, 1] == int_quads[:, 3, 1])
+        & (int_quads[:, 0, 0] == int_quads[:, 3, 0])
+        & (int_quads[:, 1, 0] == int_quads[:, 2, 0])
+        & (int_quads[:, 0, 0] >= 0)
+        & (int_quads[:, 0, 1] >= 0)
+        & (int_quads[:, 0, 0] + sizes[:, 0] <= img_w)
+        & (int_quads[:, 0, 1] + sizes[:, 1] <= img_h)
+    )
+
+    def _crop(idx):
+        w, h = int(sizes[idx, 0]), int(sizes[idx, 1])
+        if axis_aligned[idx]:
+            left, top = int(int_quads[idx, 0, 0]), int(int_quads[idx, 0, 1])
+            crop = img[top : top + h, left : left + w].copy()
+        else:
+            roi = img[y0[idx] : y1[idx], x0[idx] : x1[idx]]
+            crop = cv2.warpPerspective(
+                roi, mats[idx], (w, h), flags=flags, borderMode=cv2.BORDER_REPLICATE,
+            )
+        if cvt_code is not None:
+            crop = cv2.cvtColor(crop, cvt_code)
+        if rotate_vertical and h * 1.0 / w >= 1.5:
+            crop = np.ascontiguousarray(np.rot90(crop))
+        return crop
+
+    if num_workers > 1 and num > 1:
+        with ThreadPoolExecutor(max_workers=min(num_workers, num)) as executor:
+            return list(executor.map(_crop, range(num)))
+    return [_crop(idx) for idx in range(num)]
+
+
+def pack_crops(
+    crops: List[np.ndarray],
+    height: int,
+    *,
+    dtype: str = 'uint8',
+    width_align: int = 8,
+    pad_value: int = 0,
+    interpolation: str = 'linear',
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Resize crops to the same height, keeping their aspect ratios, and pack them side by side
+    into one contiguous buffer of the target dtype. Each crop is resized into its slot of the buffer.
+
+    Args:
+        crops: list of [h, w, C] or [h, w] uint8 images, all with the same number of channels
+        height: height of the resized crops
+        dtype: 'uint8' or 'float32'; values are kept in [0, 255]
+        width_align: the slot of each crop starts at a multiple of this value
+        pad_value: value of the padded pixels
+        interpolation: interpolation used for resizing, see `extract_quad_crops`
+
+    Returns:
+        (buffer, offsets, widths):
+            * buffer: [height, total_width, C] or [height, total_width] array;
+            * offsets: (N,) int array, the first column of each crop in the buffer;
+            * widths: (N,) int array, the width of each resized crop.
+    """
+    if dtype not in ('uint8', 'float32'):
+        raise ValueError('dtype should be uint8 or float32, but got %s' % dtype)
+    flags = INTERPOLATIONS[interpolation]
+    width_align = max(1, width_align)
+    widths = np.array(
+        [max(1, int(round(crop.shape[1] * height / max(1, crop.shape[0])))) for crop in crops],
+        dtype=np.int64,
+    )
+    slots = (widths + width_align - 1) // width_align * width_align
+    offsets = np.cumsum(slots) - slots
+    total_width = int(slots.sum())
+    extra_dims = crops[0].shape[2:] if len(crops) > 0 else (3,)
+    buffer = np.full((height, total_width) + tuple(extra_dims), pad_value, dtype=dtype)
+    for crop, offset, width in zip(crops, offsets, widths):
+        if dtype == 'uint8':
+            cv2.resize(
+                crop,
+                (int(width), height),
+                dst=buffer[:, offset : offset + width],
+                interpolation=flags,
+            )
+        else:
+            # `cv2.resize` only writes into a `dst` of the same dtype as the crop,
+            # so only the resized crop is converted, into its slot
+            buffer[:, offset : offset + width] = cv2.resize(
+                crop, (int(width), height), interpolation=flags
+            )
+    return buffer, offsets, widths
+
+
 def rotate_page(
         image: np.ndarray,
         angle: float = 0.,
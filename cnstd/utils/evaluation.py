@@ -0,0 +1,232 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import cv2
+import numpy as np
+
+from .geometry import fit_rbbox, rbbox_to_polygon
+from .metrics import box_overlap_pairs, match_boxes
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'read_eval_index',
+    'load_gt_polygons',
+    'params_fingerprint',
+    'read_prediction_cache',
+    'evaluate_image',
+    'summarize_evaluation',
+]
+
+# text of the ground truths to ignore ("don't care" regions), as in training
+IGNORE_TEXT = '###'
+
+
+def read_eval_index(
+    index_fp: Union[str, Path], data_root_dir: Optional[Union[str, Path]] = None
+) -> List[Tuple[str, str, str]]:
+    """
+    Read an index file of the training format: one `<image path>\t<label path>` pair per line.
+    Relative paths are relative to `data_root_dir`, default to the directory of the index file.
+
+    Returns:
+        list of (key, image file path, label file path), where the key is the image path in the index file
+    """
+    if data_root_dir is None:
+        data_root_dir = os.path.dirname(os.path.abspath(index_fp))
+    entries = []
+    with open(index_fp, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            img_fp, gt_fp = line.split('\t')
+            entries.append(
+                (img_fp, os.path.join(data_root_dir, img_fp), os.path.join(data_root_dir, gt_fp))
+            )
+    return entries
+
+
+def load_gt_polygons(gt_fp: Union[str, Path]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load a label file: one `x1,y1,x2,y2,x3,y3,x4,y4,text` box per line.
+
+    Returns:
+        the polygons of shape (N, 4, 2), and whether each of them is ignored (its text is '###')
+    """
+    polys, ignores = [], []
+    with open(gt_fp, encoding='utf-8') as f:
+        for line in f:
+            parts = [p.strip('﻿').strip('\xef\xbb\xbf') for p in line.strip().split(',')]
+            if len(parts) < 9:
+                continue
+            polys.append(np.array(list(map(float, parts[:8])), dtype=np.float32).reshape(4, 2))
+            ignores.append(','.join(parts[8:]).strip() == IGNORE_TEXT)
+    return (
+        np.asarray(polys, dtype=np.float32).reshape(-1, 4, 2),
+        np.asarray(ignores, dtype=bool),
+    )
+
+
+def params_fingerprint(params: Dict[str, Any]) -> str:
+    """
+    Short fingerprint of the model and the inference parameters, naming a prediction cache.
+    A model file given by path is fingerprinted by its size and modification time.
+    """
+    params = dict(params)
+    model_fp = params.get('model_fp')
+    if model_fp is not None:
+        stat = os.stat(model_fp)
+        params['model_fp'] = [os.path.abspath(model_fp), stat.st_size, stat.st_mtime_ns]
+    content = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+def read_prediction_cache(
+    fp: Union[str, Path], keys: Optional[Set[str]] = None, key: str = 'image_hash'
+) -> Dict[str, Dict[str, Any]]:
+    """Records of a prediction cache (a `JobLog` file), by their key; only the `keys` ones if given."""
+    records = dict()
+    if not os.path.exists(fp):
+        return records
+    with open(fp, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            record = json.loads(line)
+            if keys is None or record[key] in keys:
+                records[record[key]] = record
+    return records
+
+
+def _to_convex(polys: np.ndarray) -> np.ndarray:
+    """Replace the non-convex quadrilaterals by their min-area rotated boxes, for the convex polygon IoU."""
+    polys = polys.copy()
+    for idx, poly in enumerate(polys):
+        if not cv2.isContourConvex(poly):
+            polys[idx] = rbbox_to_polygon(fit_rbbox(poly))
+    return polys
+
+
+def _dont_care_preds(
+    pred_polys: np.ndarray, ignore_polys: np.ndarray, area_thresh: float = 0.5
+) -> np.ndarray:
+    """Whether each prediction falls (by more than `area_thresh` of its area) into an ignored ground truth."""
+    dont_care = np.zeros((pred_polys.shape[0],), dtype=bool)
+    if pred_polys.shape[0] == 0 or ignore_polys.shape[0] == 0:
+        return dont_care
+    extents = lambda polys: np.concatenate((polys.min(axis=1), polys.max(axis=1)), axis=1)
+    idx_1, idx_2 = box_overlap_pairs(extents(pred_polys), extents(ignore_polys))
+    for i, j in zip(idx_1, idx_2):
+        if dont_care[i]:
+            continue
+        inter, _ = cv2.intersectConvexConvex(pred_polys[i], ignore_polys[j])
+        dont_care[i] = inter > area_thresh * max(cv2.contourArea(pred_polys[i]), 1e-6)
+    return dont_care
+
+
+def evaluate_image(
+    gt_polys: np.ndarray,
+    ignore_tags: np.ndarray,
+    pred_polys: np.ndarray,
+    iou_thresh: float = 0.5,
+) -> Dict[str, Any]:
+    """
+    ICDAR-style evaluation of the predictions of one image: the ignored ground truths are left out, and so are
+    the predictions falling into them; the others are matched one to one by `match_boxes()`.
+
+    Args:
+        gt_polys: ground truth polygons of shape (N, 4, 2)
+        ignore_tags: whether each ground truth is ignored, of shape (N,)
+        pred_polys: predicted boxes of shape (M, 4, 2)
+        iou_thresh: minimum IoU to consider a pair of prediction and ground truth as a match
+
+    Returns:
+        dict with the counts 'num_gts', 'num_preds', 'num_matches', and the sum of the largest IoU
+        of each ground truth 'iou_sum'
+    """
+    gt_polys = _to_convex(np.asarray(gt_polys, dtype=np.float32).reshape(-1, 4, 2))
+    pred_polys = _to_convex(np.asarray(pred_polys, dtype=np.float32).reshape(-1, 4, 2))
+    ignore_tags = np.asarray(ignore_tags, dtype=bool)
+    pred_polys = pred_polys[~_dont_care_preds(pred_polys, gt_polys[ignore_tags])]
+    gt_polys = gt_polys[~ignore_tags]
+
+    res = match_boxes(gt_polys, pred_polys, iou_thresh, rotated_bbox=True)
+    return {
+        'num_gts': int(gt_polys.shape[0]),
+        'num_preds': int(pred_polys.shape[0]),
+        'num_matches': int(len(res['ious'])),
+        'iou_sum': float(res['gt_best_ious'].sum()),
+    }
+
+
+def _prf(num_matches: int, num_gts: int, num_preds: int, iou_sum: float) -> Dict[str, float]:
+    # an image without any ground truth or prediction is perfectly detected
+    recall = num_matches / num_gts if num_gts > 0 else float(num_preds == 0)
+    precision = num_matches / num_preds if num_preds > 0 else float(num_gts == 0)
+    hmean = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    mean_iou = iou_sum / num_gts if num_gts > 0 else float(num_preds == 0)
+    return {'precision': precision, 'recall': recall, 'hmean': hmean, 'mean_iou': mean_iou}
+
+
+def _latency_stats(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return dict()
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+def summarize_evaluation(image_results: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Aggregate the per-image results: each one has the counts of `evaluate_image()`, and optionally
+    'timings' with the 'read' and 'detect' latencies in seconds. The per-image 'precision', 'recall',
+    'hmean' and 'mean_iou' are added into each result.
+
+    Returns:
+        the overall 'precision', 'recall', 'hmean' and 'mean_iou' (over all the boxes of the dataset),
+        'num_images', the box counts, and the statistics of the latencies 'latency'
+    """
+    totals = {'num_gts': 0, 'num_preds': 0, 'num_matches': 0, 'iou_sum': 0.0}
+    timings: Dict[str, List[float]] = dict()
+    num_images = 0
+    for res in image_results:
+        res.update(_prf(res['num_matches'], res['num_gts'], res['num_preds'], res['iou_sum']))
+        for name in totals:
+            totals[name] += res[name]
+        for name, val in res.get('timings', dict()).items():
+            timings.setdefault(name, []).append(val)
+        num_images += 1
+
+    summary = _prf(totals['num_matches'], totals['num_gts'], totals['num_preds'], totals['iou_sum'])
+    summary.update(num_images=num_images, **{k: v for k, v in totals.items() if k != 'iou_sum'})
+    summary['latency'] = {name: _latency_stats(vals) for name, vals in timings.items()}
+    return summary
@@ -0,0 +1,406 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import mmap
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'CROP_FORMATS',
+    'encode_crop',
+    'decode_crop',
+    'CropBlobWriter',
+    'CropBlobReader',
+    'ResultExporter',
+    'ResultReader',
+]
+
+CROP_FORMATS = ('png', 'webp', 'raw')
+
+# keys of the schema metadata of the exported tables
+_META_CROP_FORMAT = b'cnstd.crop_format'
+_META_CROP_BLOB = b'cnstd.crop_blob'
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            'pyarrow is needed to export results in Parquet or Arrow, '
+            'please install it by `pip install pyarrow` or `pip install cnstd[export]`'
+        ) from e
+    return pyarrow
+
+
+def _check_crop_format(crop_format: str) -> str:
+    crop_format = crop_format.lower()
+    if crop_format not in CROP_FORMATS:
+        raise ValueError(
+            'crop_format should be one of %s, but got %s' % (CROP_FORMATS, crop_format)
+        )
+    return crop_format
+
+
+def encode_crop(crop: np.ndarray, crop_format: str = 'png', quality: int = 90) -> bytes:
+    """
+    Encode an RGB-style [H, W, 3] (or a gray [H, W]) uint8 crop. 'raw' is the bytes of the array,
+    whose shape has to be stored elsewhere; `quality` is only used by 'webp'.
+    """
+    crop = np.ascontiguousarray(crop, dtype=np.uint8)
+    if crop_format == 'raw':
+        return crop.tobytes()
+    if crop.ndim == 3:
+        crop = crop[:, :, ::-1]  # RGB -> BGR
+    params = [cv2.IMWRITE_WEBP_QUALITY, quality] if crop_format == 'webp' else []
+    ok, buf = cv2.imencode('.' + crop_format, crop, params)
+    if not ok:
+        raise RuntimeError('failed to encode a crop of shape %s' % (crop.shape,))
+    return buf.tobytes()
+
+
+def decode_crop(
+    buf: Union[bytes, memoryview, np.ndarray],
+    crop_format: str = 'png',
+    shape: Optional[Sequence[int]] = None,
+) -> np.ndarray:
+    """
+    Decode a crop encoded by `encode_crop()`. A 'raw' crop needs its `shape`, and is returned as
+    a read-only view of `buf` without any copy.
+    """
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    if crop_format == 'raw':
+        return buf.reshape(tuple(shape))
+    crop = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+    if crop is None:
+        raise ValueError('failed to decode a %s crop' % crop_format)
+    if crop.ndim == 3:
+        crop = np.ascontiguousarray(crop[:, :, 2::-1])  # BGR(A) -> RGB
+    return crop
+
+
+class CropBlobWriter(object):
+    """
+    Append-only file of encoded crops. Each crop is referenced by its (offset, length) in the file.
+
+    Args:
+        fp: file path of the blob; an existing file is appended to
+        crop_format: one of `CROP_FORMATS`
+    """
+
+    def __init__(self, fp: Union[str, Path], crop_format: str = 'png'):
+        self.fp = str(fp)
+        self.crop_format = _check_crop_format(crop_format)
+        self._file = open(self.fp, 'ab')
+        self.size = self._file.tell()
+
+    def write(self, buf: bytes) -> Tuple[int, int]:
+        """Append one encoded crop, and return its (offset, length)."""
+        offset = self.size
+        self._file.write(buf)
+        self.size += len(buf)
+        return offset, len(buf)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self) -> 'CropBlobWriter':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CropBlobReader(object):
+    """
+    Memory-mapped reader of a crop blob file: fetching one crop only touches its own bytes.
+
+    Args:
+        fp: file path of the blob
+        crop_format: format of the crops in the blob, one of `CROP_FORMATS`
+    """
+
+    def __init__(self, fp: Union[str, Path], crop_format: str = 'png'):
+        self.fp = str(fp)
+        self.crop_format = _check_crop_format(crop_format)
+        self._file = open(self.fp, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        )
+
+    def read(self, offset: int, length: int) -> memoryview:
+        """The encoded bytes of a crop, without copy."""
+        if self._mmap is None or offset + length > len(self._mmap):
+            raise IndexError('bytes [%d, %d) are out of the blob' % (offset, offset + length))
+        return memoryview(self._mmap)[offset : offset + length]
+
+    def get(
+        self, offset: int, length: int, shape: Optional[Sequence[int]] = None
+    ) -> np.ndarray:
+        """Decode the crop at (offset, length); a 'raw' crop needs its `shape`."""
+        return decode_crop(self.read(offset, length), self.crop_format, shape)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:  # views of the raw crops are still alive
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self) -> 'CropBlobReader':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultExporter(object):
+    """
+    Export the results of `CnStd.detect()` (or `Detector.detect()`) in a columnar table, written batch by batch
+    into a Parquet file ('.parquet') or an Arrow IPC file ('.arrow'), with one row per box:
+
+      * 'image_id' (string), 'rotated_angle' (float32): the image and the angle of its result;
+      * 'box_idx' (int32), 'box' (8 x float32), 'score' (float32): the box, in the order of the result;
+      * 'crop_offset', 'crop_length' (int64), 'crop_height', 'crop_width', 'crop_channels' (int32):
+        where the crop of the box is in the crop blob, if the result has 'cropped_img'.
+
+    An image without any box has one row, with nulls in the box columns. Crops are encoded in a thread pool
+    as soon as a result is added, and appended to the crop blob (see `CropBlobWriter`) when a batch is written.
+    The format and the path (relative to the table) of the blob are saved in the schema metadata.
+
+    Requires `pyarrow`.
+
+    Args:
+        output_fp: file path of the table, ending with '.parquet' or '.arrow'
+        crop_blob_fp: file path of the crop blob; default to `output_fp` with the suffix '.crops'
+        crop_format: one of `CROP_FORMATS`. Default: 'png'
+        batch_size: number of images per written batch. Default: 64
+        num_workers: number of threads encoding the crops. Default: 4
+        quality: quality of the 'webp' crops. Default: 90
+    """
+
+    def __init__(
+        self,
+        output_fp: Union[str, Path],
+        crop_blob_fp: Optional[Union[str, Path]] = None,
+        *,
+        crop_format: str = 'png',
+        batch_size: int = 64,
+        num_workers: int = 4,
+        quality: int = 90,
+    ):
+        self._pa = _import_pyarrow()
+        self.output_fp = str(output_fp)
+        self.file_format = os.path.splitext(self.output_fp)[1].lower().lstrip('.')
+        if self.file_format not in ('parquet', 'arrow'):
+            raise ValueError(
+                'output_fp should end with ".parquet" or ".arrow", but got %s' % self.output_fp
+            )
+        if crop_blob_fp is None:
+            crop_blob_fp = os.path.splitext(self.output_fp)[0] + '.crops'
+        self.crop_format = _check_crop_format(crop_format)
+        self.batch_size = batch_size
+        self.quality = quality
+
+        self._blob = CropBlobWriter(crop_blob_fp, self.crop_format)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._pending: List[Tuple[str, Dict[str, Any], List[Future]]] = []
+        self.schema = self._build_schema(crop_blob_fp)
+        if self.file_format == 'parquet':
+            self._writer = self._pa.parquet.ParquetWriter(self.output_fp, self.schema)
+        else:
+            self._writer = self._pa.ipc.new_file(self.output_fp, self.schema)
+        self.num_images = 0
+        self.num_rows = 0
+
+    def _build_schema(self, crop_blob_fp):
+        pa = self._pa
+        blob_rel_fp = os.path.relpath(
+            os.path.abspath(crop_blob_fp), os.path.dirname(os.path.abspath(self.output_fp))
+        )
+        return pa.schema(
+            [
+                ('image_id', pa.string()),
+                ('rotated_angle', pa.float32()),
+                ('box_idx', pa.int32()),
+                ('box', pa.list_(pa.float32(), 8)),
+                ('score', pa.float32()),
+                ('crop_offset', pa.int64()),
+                ('crop_length', pa.int64()),
+                ('crop_height', pa.int32()),
+                ('crop_width', pa.int32()),
+                ('crop_channels', pa.int32()),
+            ],
+            metadata={
+                _META_CROP_FORMAT: self.crop_format.encode(),
+                _META_CROP_BLOB: blob_rel_fp.encode('utf-8'),
+            },
+        )
+
+    def add(self, image_id: str, result: Dict[str, Any]):
+        """
+        Add the result of one image.
+
+        Args:
+            image_id: id of the image, such as its file path
+            result: dict with keys 'rotated_angle' and 'detected_texts', as returned by `CnStd.detect()`
+        """
+        futures = [
+            self._executor.submit(encode_crop, info['cropped_img'], self.crop_format, self.quality)
+            if info.get('cropped_img') is not None
+            else None
+            for info in result['detected_texts']
+        ]
+        self._pending.append((str(image_id), result, futures))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the added results into the table and the crop blob."""
+        if not self._pending:
+            return
+        columns: Dict[str, List[Any]] = {name: [] for name in self.schema.names}
+        for image_id, result, futures in self._pending:
+            box_infos = result['detected_texts']
+            angle = float(result.get('rotated_angle', 0.0))
+            if len(box_infos) == 0:
+                for name in self.schema.names:
+                    columns[name].append(None)
+                columns['image_id'][-1] = image_id
+                columns['rotated_angle'][-1] = angle
+                continue
+            for idx, (info, future) in enumerate(zip(box_infos, futures)):
+                columns['image_id'].append(image_id)
+                columns['rotated_angle'].append(angle)
+                columns['box_idx'].append(idx)
+                columns['box'].append(
+                    np.asarray(info['box'], dtype=np.float32).reshape(-1).tolist()
+                )
+                columns['score'].append(float(info['score']))
+                if future is None:
+                    crop_info = [None] * 5
+                else:
+                    offset, length = self._blob.write(future.result())
+                    shape = info['cropped_img'].shape
+                    crop_info = [
+                        offset,
+                        length,
+                        shape[0],
+                        shape[1],
+                        shape[2] if len(shape) > 2 else 1,
+                    ]
+                for name, value in zip(
+                    ('crop_offset', 'crop_length', 'crop_height', 'crop_width', 'crop_channels'),
+                    crop_info,
+                ):
+                    columns[name].append(value)
+
+        self._blob.flush()
+        batch = self._pa.RecordBatch.from_pydict(columns, schema=self.schema)
+        self._writer.write_batch(batch)
+        self.num_images += len(self._pending)
+        self.num_rows += batch.num_rows
+        self._pending = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._writer.close()
+            self._blob.close()
+
+    def __enter__(self) -> 'ResultExporter':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultReader(object):
+    """
+    Read a table exported by `ResultExporter`, memory-mapping the table and its crop blob.
+
+    Requires `pyarrow`.
+
+    Args:
+        fp: file path of the table, ending with '.parquet' or '.arrow'
+    """
+
+    def __init__(self, fp: Union[str, Path]):
+        pa = _import_pyarrow()
+        self.fp = str(fp)
+        if self.fp.lower().endswith('.parquet'):
+            self.table = pa.parquet.read_table(self.fp, memory_map=True)
+        else:
+            with pa.memory_map(self.fp) as source:
+                self.table = pa.ipc.open_file(source).read_all()
+        metadata = self.table.schema.metadata
+        crop_blob_fp = os.path.join(
+            os.path.dirname(os.path.abspath(self.fp)), metadata[_META_CROP_BLOB].decode('utf-8')
+        )
+        self.crops = CropBlobReader(crop_blob_fp, metadata[_META_CROP_FORMAT].decode())
+        self._crop_columns = None
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def crop(self, row: int) -> Optional[np.ndarray]:
+        """The crop of the box in the `row`-th row, or None if the row has no crop."""
+        if self._crop_columns is None:
+            self._crop_columns = [
+                self.table.column(name).to_numpy(zero_copy_only=False)
+                for name in (
+                    'crop_offset',
+                    'crop_length',
+                    'crop_height',
+                    'crop_width',
+                    'crop_channels',
+                )
+            ]
+        offset, length, height, width, channels = (col[row] for col in self._crop_columns)
+        if np.isnan(offset):
+            return None
+        shape = (int(height), int(width)) if channels == 1 else (int(height), int(width), int(channels))
+        return self.crops.get(int(offset), int(length), shape)
+
+    def close(self):
+        self.crops.close()
+
+    def __enter__(self) -> 'ResultReader':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
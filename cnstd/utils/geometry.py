@@ -24,7 +24,9 @@ import cv2
 from .common_types import BoundingBox, Polygon4P, RotatedBbox
 
 __all__ = ['rbbox_to_polygon', 'bbox_to_polygon', 'polygon_to_bbox', 'polygon_to_rbbox',
-           'resolve_enclosing_bbox', 'resolve_enclosing_bbox', 'fit_rbbox', 'rotate_boxes']
+           'resolve_enclosing_bbox', 'resolve_enclosing_bbox', 'fit_rbbox', 'rotate_boxes',
+           'rbboxes_to_polygons', 'sort_polygons_points', 'clip_polygons',
+           'polygons_side_lengths', 'polygons_mean_score']
 
 
 def bbox_to_polygon(bbox: BoundingBox) -> Polygon4P:
@@ -109,3 +111,144 @@ def rotate_boxes(
     # Compute rotated boxes
     rotated_boxes = np.stack((x_center, y_center, width, height, angle * np.ones_like(boxes[:, 0])), axis=1)
     return rotated_boxes
+
+
+def rbboxes_to_polygons(rbboxes: np.ndarray) -> np.ndarray:
+    """Vectorized version of `cv2.boxPoints`.
+
+    Args:
+        rbboxes: (N, 5) array of rotated boxes (x, y, w, h, alpha), alpha in degrees
+
+    Returns:
+        (N, 4, 2) float32 array, points are in the same order as `cv2.boxPoints`
+    """
+    rbboxes = np.asarray(rbboxes, dtype=np.float32).reshape(-1, 5)
+    cx, cy, w, h, alpha = rbboxes.T
+    angle = alpha * np.pi / 180.0
+    b = np.cos(angle) * 0.5
+    a = np.sin(angle) * 0.5
+    polygons = np.empty((rbboxes.shape[0], 4, 2), dtype=np.float32)
+    polygons[:, 0, 0] = cx - a * h - b * w
+    polygons[:, 0, 1] = cy + b * h - a * w
+    polygons[:, 1, 0] = cx + a * h - b * w
+    polygons[:, 1, 1] = cy - b * h - a * w
+    polygons[:, 2, 0] = 2 * cx - polygons[:, 0, 0]
+    polygons[:, 2, 1] = 2 * cy - polygons[:, 0, 1]
+    polygons[:, 3, 0] = 2 * cx - polygons[:, 1, 0]
+    polygons[:, 3, 1] = 2 * cy - polygons[:, 1, 1]
+    return polygons
+
+
+def sort_polygons_points(polygons: np.ndarray, swap_ties: bool = True) -> np.ndarray:
+    """Vectorized version of `sort_box_points`: (top-left, top-right, bottom-right, bottom-left)
+    for each box. The two left-most points are the left side, each side is then sorted by y.
+
+    Args:
+        polygons: (N, 4, 2) array
+        swap_ties: which point of a side with the same y values is on top. `True` for the later one
+            after sorting by x, as `sort_box_points`; `False` for the earlier one,
+            as `PPDetector.order_points_clockwise`
+
+    Returns:
+        (N, 4, 2) array with re-ordered points
+    """
+    polygons = np.asarray(polygons)
+    if polygons.shape[0] == 0:
+        return polygons.reshape(0, 4, 2)
+    idx = np.argsort(polygons[:, :, 0], axis=1, kind='stable')
+    pts = np.take_along_axis(polygons, idx[:, :, None], axis=1)
+    less = np.less_equal if swap_ties else np.less
+    left_swap = less(pts[:, 1, 1], pts[:, 0, 1])
+    right_swap = less(pts[:, 3, 1], pts[:, 2, 1])
+    out = np.empty_like(pts)
+    out[:, 0] = np.where(left_swap[:, None], pts[:, 1], pts[:, 0])
+    out[:, 3] = np.where(left_swap[:, None], pts[:, 0], pts[:, 1])
+    out[:, 1] = np.where(right_swap[:, None], pts[:, 3], pts[:, 2])
+    out[:, 2] = np.where(right_swap[:, None], pts[:, 2], pts[:, 3])
+    return out
+
+
+def clip_polygons(polygons: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Clip the points of all boxes into the image, and truncate them to integer values.
+
+    Args:
+        polygons: (N, 4, 2) array
+        height: image height
+        width: image width
+
+    Returns:
+        (N, 4, 2) array with the same dtype as `polygons`
+    """
+    out = np.empty_like(polygons)
+    out[..., 0] = np.floor(np.clip(polygons[..., 0], 0, width - 1))
+    out[..., 1] = np.floor(np.clip(polygons[..., 1], 0, height - 1))
+    return out
+
+
+def polygons_side_lengths(polygons: np.ndarray) -> np.ndarray:
+    """Widths and heights of boxes ordered as (top-left, top-right, bottom-right, bottom-left).
+
+    Args:
+        polygons: (N, 4, 2) array
+
+    Returns:
+        (N, 2) array, with columns (width, height)
+    """
+    widths = np.linalg.norm(polygons[:, 0] - polygons[:, 1], axis=-1)
+    heights = np.linalg.norm(polygons[:, 0] - polygons[:, 3], axis=-1)
+    return np.stack((widths, heights), axis=1)
+
+
+def polygons_mean_score(integral: np.ndarray, polygons: np.ndarray) -> np.ndarray:
+    """Mean value of a map inside each convex polygon, computed from the integral image of the map.
+    Each polygon is scanned row by row, and the sum of every row span is read from the integral image,
+    so no mask is rasterized per polygon.
+
+    Args:
+        integral: (H + 1, W + 1) integral image of the map, e.g. the output of `cv2.integral(pred)`
+        polygons: (N, P, 2) array of convex polygons, in pixel coordinates of the map
+
+    Returns:
+        (N,) float array; 0 for polygons that are totally out of the map
+    """
+    num = polygons.shape[0]
+    if num == 0:
+        return np.zeros((0,), dtype=np.float64)
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    # same rounding as `cv2.fillPoly(..., polygons.astype(np.int32))`
+    pts = polygons.astype(np.int32).astype(np.float64)
+    ymin = np.clip(pts[:, :, 1].min(axis=1), 0, h - 1).astype(np.int64)
+    ymax = np.clip(pts[:, :, 1].max(axis=1), 0, h - 1).astype(np.int64)
+    num_rows = ymax - ymin + 1
+
+    # one entry per (polygon, row)
+    poly_idx = np.repeat(np.arange(num), num_rows)
+    row_starts = np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+    ys = ymin[poly_idx] + np.arange(poly_idx.shape[0]) - row_starts
+
+    p0 = pts[poly_idx]  # (R, P, 2)
+    p1 = np.roll(p0, -1, axis=1)
+    y0, y1 = p0[:, :, 1], p1[:, :, 1]
+    _ys = ys[:, None].astype(np.float64)
+    crossing = (_ys >= np.minimum(y0, y1)) & (_ys <= np.maximum(y0, y1))
+    dy = y1 - y0
+    flat = dy == 0
+    ratio = np.where(flat, 0.0, (_ys - y0) / np.where(flat, 1.0, dy))
+    xs = p0[:, :, 0] + ratio * (p1[:, :, 0] - p0[:, :, 0])
+    # flat edges contribute both of their end points
+    x_left = np.where(crossing, np.where(flat, np.minimum(p0[:, :, 0], p1[:, :, 0]), xs), np.inf)
+    x_right = np.where(crossing, np.where(flat, np.maximum(p0[:, :, 0], p1[:, :, 0]), xs), -np.inf)
+    x_left = np.clip(np.round(x_left.min(axis=1)), 0, w - 1).astype(np.int64)
+    x_right = np.clip(np.round(x_right.max(axis=1)), 0, w - 1).astype(np.int64)
+    valid = x_right >= x_left
+    x_left, x_right, ys, poly_idx = x_left[valid], x_right[valid], ys[valid], poly_idx[valid]
+
+    span_sums = (
+        integral[ys + 1, x_right + 1]
+        - integral[ys, x_right + 1]
+        - integral[ys + 1, x_left]
+        + integral[ys, x_left]
+    )
+    sums = np.bincount(poly_idx, weights=span_sums, minlength=num)
+    counts = np.bincount(poly_idx, weights=x_right - x_left + 1, minlength=num)
+    return np.where(counts > 0, sums / np.maximum(counts, 1), 0.0)
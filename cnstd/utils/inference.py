@@ -0,0 +1,220 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+from typing import Any, Callable, Optional, Set, Tuple
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'INFERENCE_MODES',
+    'check_inference_mode',
+    'bf16_supported',
+    'InferenceRunner',
+]
+
+INFERENCE_MODES = ('eager', 'channels_last', 'bf16', 'compiled')
+
+# (rtol, atol) of the parity check against the eager outputs
+PARITY_TOLERANCES = {
+    'channels_last': (1e-3, 1e-3),
+    'bf16': (5e-2, 5e-2),
+    'compiled': (1e-3, 1e-3),
+}
+
+
+def check_inference_mode(inference_mode: str) -> str:
+    inference_mode = inference_mode.lower()
+    if inference_mode not in INFERENCE_MODES:
+        raise ValueError(
+            'inference_mode should be one of %s, but got %s'
+            % (INFERENCE_MODES, inference_mode)
+        )
+    return inference_mode
+
+
+def bf16_supported(device: torch.device) -> bool:
+    """Whether bfloat16 autocast runs natively (not emulated) on the device."""
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    if device.type == 'cpu':
+        is_supported = getattr(torch.cpu, '_is_avx512_bf16_supported', None)
+        return bool(is_supported is not None and is_supported())
+    return False
+
+
+def _map_tensors(fn: Callable[[torch.Tensor], Any], obj: Any) -> Any:
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_tensors(fn, o) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _map_tensors(fn, v) for k, v in obj.items()}
+    return obj
+
+
+def _batch_bucket(batch_size: int) -> int:
+    """The smallest power of 2 not less than `batch_size`."""
+    return 1 << max(batch_size - 1, 0).bit_length()
+
+
+def _flatten_tensors(obj: Any) -> list:
+    tensors = []
+    _map_tensors(tensors.append, obj)
+    return tensors
+
+
+class InferenceRunner(object):
+    """
+    Run the forward pass of a model in one of the inference modes, always under `torch.inference_mode()`:
+
+      * 'eager': the model as it is;
+      * 'channels_last': the model and the inputs are converted to the channels-last memory format;
+      * 'bf16': 'channels_last' with bfloat16 autocast, outputs are cast back to float32;
+        falls back to 'channels_last' on devices without native bfloat16 support;
+      * 'compiled': 'channels_last' with `torch.compile()`. Every new input shape triggers a compilation,
+        so the batch size is padded (with zeros) up to a power of 2, and the outputs are sliced back;
+        only the first `max_shape_buckets` of these shape buckets are compiled, the others run in eager mode.
+        The recompile limit of dynamo is only raised during the calls of the compiled model.
+
+    Args:
+        module: the model, which is modified in place for the memory format
+        inference_mode: one of `INFERENCE_MODES`
+        forward: the function to run, default to `module` itself
+        device: device of the model
+        max_shape_buckets: the largest number of input shape buckets compiled for the 'compiled' mode
+    """
+
+    def __init__(
+        self,
+        module: nn.Module,
+        inference_mode: str = 'eager',
+        *,
+        forward: Optional[Callable[[torch.Tensor], Any]] = None,
+        device: torch.device = torch.device('cpu'),
+        max_shape_buckets: int = 8,
+    ):
+        self.module = module
+        self.device = torch.device(device)
+        self._eager_forward = forward if forward is not None else module
+        self.max_shape_buckets = max_shape_buckets
+        self._compiled_shapes: Set[Tuple[int, ...]] = set()
+        self._compiled_forward = None
+        self.inference_mode = 'eager'
+        self._set_mode(check_inference_mode(inference_mode))
+
+    def _set_mode(self, inference_mode: str):
+        if inference_mode == 'bf16' and not bf16_supported(self.device):
+            logger.warning(
+                'bfloat16 is not supported natively on device %s, use channels_last instead'
+                % self.device
+            )
+            inference_mode = 'channels_last'
+        memory_format = (
+            torch.contiguous_format
+            if inference_mode == 'eager'
+            else torch.channels_last
+        )
+        self.module.to(memory_format=memory_format)
+        if inference_mode == 'compiled' and self._compiled_forward is None:
+            self._compiled_forward = torch.compile(self._eager_forward, dynamic=False)
+        self.inference_mode = inference_mode
+
+    def _forward(self, x: torch.Tensor) -> Any:
+        mode = self.inference_mode
+        if mode == 'eager':
+            return self._eager_forward(x)
+
+        x = x.contiguous(memory_format=torch.channels_last)
+        if mode == 'channels_last':
+            return self._eager_forward(x)
+        if mode == 'bf16':
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                out = self._eager_forward(x)
+            return _map_tensors(
+                lambda t: t.float() if t.is_floating_point() else t, out
+            )
+
+        batch_size = x.shape[0]
+        bucket_size = _batch_bucket(batch_size)
+        shape = (bucket_size,) + tuple(x.shape[1:])
+        if shape not in self._compiled_shapes:
+            if len(self._compiled_shapes) >= self.max_shape_buckets:
+                return self._eager_forward(x)
+            self._compiled_shapes.add(shape)
+        if bucket_size > batch_size:
+            padding = x.new_zeros((bucket_size - batch_size,) + tuple(x.shape[1:]))
+            x = torch.cat([x, padding]).contiguous(memory_format=torch.channels_last)
+
+        dynamo_config = torch._dynamo.config
+        limit_name = (
+            'recompile_limit'
+            if hasattr(dynamo_config, 'recompile_limit')
+            else 'cache_size_limit'
+        )
+        limit = max(getattr(dynamo_config, limit_name), self.max_shape_buckets)
+        with dynamo_config.patch(**{limit_name: limit}):
+            out = self._compiled_forward(x)
+        if bucket_size > batch_size:
+            out = _map_tensors(
+                lambda t: t[:batch_size]
+                if t.dim() > 0 and t.shape[0] == bucket_size
+                else t,
+                out,
+            )
+        return out
+
+    def __call__(self, x: torch.Tensor) -> Any:
+        with torch.inference_mode():
+            return self._forward(x)
+
+    def check_parity(self, example_input: torch.Tensor) -> bool:
+        """
+        Compare the outputs with the eager ones on `example_input`. On mismatch or any error,
+        fall back to the 'eager' mode, and return False.
+        """
+        if self.inference_mode == 'eager':
+            return True
+        mode = self.inference_mode
+        rtol, atol = PARITY_TOLERANCES[mode]
+        try:
+            outs = _flatten_tensors(self(example_input))
+            self.module.to(memory_format=torch.contiguous_format)
+            with torch.inference_mode():
+                expected = _flatten_tensors(self._eager_forward(example_input))
+            self.module.to(memory_format=torch.channels_last)
+            ok = len(outs) == len(expected) and all(
+                out.shape == exp.shape
+                and torch.allclose(out.float(), exp.float(), rtol=rtol, atol=atol)
+                for out, exp in zip(outs, expected)
+            )
+        except Exception as e:
+            logger.warning('inference_mode %s failed: %s' % (mode, e))
+            ok = False
+
+        if not ok:
+            logger.warning(
+                'outputs of inference_mode %s mismatch the eager ones, fall back to eager'
+                % mode
+            )
+            self._set_mode('eager')
+        return ok
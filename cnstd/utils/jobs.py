@@ -0,0 +1,411 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+import time
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+from .utils import file_lock
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'IMG_EXTENSIONS',
+    'iter_image_files',
+    'iter_job_entries',
+    'shard_index_of',
+    'shard_output_path',
+    'job_header_path',
+    'read_job_header',
+    'JobLog',
+    'merge_job_logs',
+    'imap_workers',
+    'ThroughputMeter',
+]
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def iter_image_files(
+    path: Union[str, Path], extensions: Sequence[str] = IMG_EXTENSIONS
+) -> Iterator[str]:
+    """
+    Walk a directory recursively, and yield its image files in a stable (sorted) order,
+    one directory after another, without listing the whole tree first.
+
+    Args:
+        path: a directory, or one image file which is yielded whatever its extension is
+        extensions: extensions (case-insensitive, with the leading dot) of the image files
+    """
+    path = str(path)
+    if os.path.isfile(path):
+        yield path
+        return
+    if not os.path.isdir(path):
+        raise FileNotFoundError(path)
+
+    extensions = tuple(ext.lower() for ext in extensions)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            if fname.lower().endswith(extensions):
+                yield os.path.join(root, fname)
+
+
+def iter_job_entries(
+    img_file_or_dir: Optional[Union[str, Path]] = None,
+    manifest_fp: Optional[Union[str, Path]] = None,
+    extensions: Sequence[str] = IMG_EXTENSIONS,
+) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the inputs of a batch job as (key, file path) pairs. The key identifies an input independently of
+    where the data is mounted, and decides its shard:
+
+      * for a manifest (a text file with one image path per line, and `#` for comments), the key is the line
+        itself, and relative paths are relative to the directory of the manifest;
+      * for a directory, the key is the path relative to the directory, with '/' as the separator;
+      * for one file, the key is its file name.
+    """
+    if manifest_fp is not None:
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_fp))
+        with open(manifest_fp, encoding='utf-8') as f:
+            for line in f:
+                entry = line.strip()
+                if not entry or entry.startswith('#'):
+                    continue
+                yield entry, os.path.join(manifest_dir, entry)
+        return
+
+    img_file_or_dir = str(img_file_or_dir)
+    if os.path.isfile(img_file_or_dir):
+        yield os.path.basename(img_file_or_dir), img_file_or_dir
+        return
+    for fp in iter_image_files(img_file_or_dir, extensions=extensions):
+        yield os.path.relpath(fp, img_file_or_dir).replace(os.sep, '/'), fp
+
+
+def shard_index_of(key: str, num_shards: int) -> int:
+    """Deterministic shard of a job key, stable across runs, machines and Python versions."""
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+def shard_output_path(
+    output_dir: Union[str, Path], name: str, num_shards: int = 1, shard_index: int = 0
+) -> str:
+    """`<output_dir>/<name>.jsonl`, or `<output_dir>/<name>.shard-00001-of-00004.jsonl` for sharded jobs."""
+    if num_shards <= 1:
+        return os.path.join(str(output_dir), '%s.jsonl' % name)
+    return os.path.join(
+        str(output_dir), '%s.shard-%05d-of-%05d.jsonl' % (name, shard_index, num_shards)
+    )
+
+
+def job_header_path(fp: Union[str, Path]) -> str:
+    """File storing the header of the job writing the log `fp`."""
+    return '%s.job.json' % fp
+
+
+def read_job_header(fp: Union[str, Path]) -> Optional[Dict[str, Any]]:
+    """Header of the job writing the log `fp`, or None if it is unknown."""
+    header_fp = job_header_path(fp)
+    if not os.path.isfile(header_fp):
+        return None
+    with open(header_fp, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class JobLog(object):
+    """
+    JSONL output of a batch job, which is also its append-only progress log: each record is written and
+    flushed as soon as its input is done. Opening an existing log resumes the job: the inputs of its records
+    are done already, and a partial last line left by a killed job is truncated. Since the output is the
+    progress log, a resumed job never redoes or duplicates a record. The failed records (with an 'error')
+    are dropped when resuming, so that their inputs are retried.
+
+    The `header` describes the job, e.g. its inputs and a fingerprint of its parameters; it is stored in
+    `job_header_path(fp)`, next to the log, which stays one record per line. Resuming a log written by
+    a job with another (or without a) header is refused, instead of mixing the results of different jobs.
+
+    A lock file next to the log keeps two processes from writing the same log; the second one waits.
+
+    Args:
+        fp: file path of the log
+        key: name of the record field identifying its input, i.e. the key from `iter_job_entries()`
+        resume: whether to resume an existing log; if False, the existing log is emptied
+        header: JSON-serializable description of the job; None means no check
+        retry_failed: whether to drop the failed records when resuming
+    """
+
+    def __init__(
+        self,
+        fp: Union[str, Path],
+        key: str = 'key',
+        resume: bool = True,
+        *,
+        header: Optional[Dict[str, Any]] = None,
+        retry_failed: bool = True,
+    ):
+        self.fp = str(fp)
+        self.key = key
+        self.resume = resume
+        self.header = None if header is None else json.loads(json.dumps(header))
+        self.retry_failed = retry_failed
+        self.done: Set[str] = set()
+        self._lock = None
+        self._file = None
+
+    def _iter_records(self) -> Iterator[Tuple[bytes, Dict[str, Any]]]:
+        """The complete lines of the log, with their records."""
+        with open(self.fp, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                yield line, record
+
+    def _is_failed(self, record: Dict[str, Any]) -> bool:
+        return self.retry_failed and 'error' in record
+
+    def _scan(self) -> int:
+        """
+        Collect the keys of the complete records, and return the size of the complete part.
+        The failed records are removed from the log first.
+        """
+        if not os.path.exists(self.fp):
+            return 0
+        num_failed = sum(self._is_failed(record) for _, record in self._iter_records())
+        if num_failed > 0:
+            logger.info('retry the %d failed records of %s' % (num_failed, self.fp))
+            tmp_fp = '%s.tmp%d' % (self.fp, os.getpid())
+            with open(tmp_fp, 'wb') as out_f:
+                for line, record in self._iter_records():
+                    if not self._is_failed(record):
+                        out_f.write(line)
+            os.replace(tmp_fp, self.fp)
+
+        valid_size = 0
+        for line, record in self._iter_records():
+            self.done.add(record[self.key])
+            valid_size += len(line)
+        return valid_size
+
+    def _check_header(self):
+        old_header = read_job_header(self.fp)
+        if old_header != self.header:
+            raise ValueError(
+                'the log %s was written by another job, refuse to resume it: '
+                'its header is %s, but the one of the current job is %s. '
+                'Start it again (e.g. `--overwrite`) or use another output file'
+                % (self.fp, old_header, self.header)
+            )
+
+    def _write_header(self):
+        header_fp = job_header_path(self.fp)
+        tmp_fp = '%s.tmp%d' % (header_fp, os.getpid())
+        with open(tmp_fp, 'w', encoding='utf-8') as f:
+            json.dump(self.header, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_fp, header_fp)
+
+    def open(self) -> 'JobLog':
+        os.makedirs(os.path.dirname(os.path.abspath(self.fp)), exist_ok=True)
+        self._lock = file_lock(self.fp + '.lock')
+        if self._lock.__enter__():
+            logger.warning('waited for another process writing %s' % self.fp)
+        try:
+            # the header is written before any record, so a non-empty log has the header of its job
+            if (
+                self.resume
+                and self.header is not None
+                and os.path.isfile(self.fp)
+                and os.path.getsize(self.fp) > 0
+            ):
+                self._check_header()
+            valid_size = self._scan() if self.resume else 0
+            if self.header is not None and valid_size == 0:
+                self._write_header()
+        except Exception:
+            self.close()
+            raise
+        self._file = open(self.fp, 'ab')
+        if self._file.tell() > valid_size:
+            if self.resume:
+                logger.warning('truncate the partial last record of %s' % self.fp)
+            self._file.truncate(valid_size)
+        if self.done:
+            logger.info('resume %s with %d records done' % (self.fp, len(self.done)))
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock is not None:
+            self._lock.__exit__(None, None, None)
+            self._lock = None
+
+    def __enter__(self) -> 'JobLog':
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_done(self, key: str) -> bool:
+        return key in self.done
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        self._file.write(line.encode('utf-8'))
+        self._file.flush()
+        self.done.add(record[self.key])
+
+
+def merge_job_logs(
+    fps: List[Union[str, Path]], output_fp: Union[str, Path], key: str = 'key'
+) -> int:
+    """
+    Merge the (shard) logs of a job into one JSONL file, keeping the first record of each input,
+    and skipping the partial last lines of unfinished logs. Returns the number of merged records.
+    Logs written by jobs with different headers are refused.
+    """
+    headers = {fp: read_job_header(fp) for fp in fps}
+    if len({json.dumps(header, sort_keys=True) for header in headers.values()}) > 1:
+        raise ValueError('the logs are written by different jobs: %s' % headers)
+    seen = set()
+    tmp_fp = '%s.tmp%d' % (output_fp, os.getpid())
+    with open(tmp_fp, 'wb') as out_f:
+        for fp in fps:
+            with open(fp, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record_key = json.loads(line)[key]
+                    except ValueError:
+                        break
+                    if record_key not in seen:
+                        seen.add(record_key)
+                        out_f.write(line)
+    os.replace(tmp_fp, output_fp)
+    return len(seen)
+
+
+def _init_worker(initializer, initargs, finalizer):
+    if initializer is not None:
+        initializer(*initargs)
+    if finalizer is not None:
+        # run when the worker exits after `Pool.close()`, before the pool is joined
+        Finalize(None, finalizer, exitpriority=10)
+
+
+def imap_workers(
+    fn: Callable[[Any], Any],
+    items: Iterable[Any],
+    *,
+    num_workers: int = 1,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: tuple = (),
+    finalizer: Optional[Callable[[], None]] = None,
+    chunksize: int = 1,
+    mp_context: str = 'spawn',
+) -> Iterator[Any]:
+    """
+    `map(fn, items)` in `num_workers` worker processes, yielding each result as soon as it is ready,
+    so the results are unordered. `items` is consumed lazily, in a background thread.
+
+    Workers are spawned instead of forked by default, since forking a process which has started the
+    thread pools of PyTorch or OpenMP may deadlock.
+
+    Args:
+        fn: function run on each item; it and its results must be picklable
+        items: the inputs
+        num_workers: number of worker processes; with `num_workers <= 1`, everything runs in this process, in order
+        initializer: run once in each worker before any item, e.g. to load a model
+        initargs: arguments of `initializer`
+        finalizer: run once in each worker after the last item, e.g. to flush background writers
+        chunksize: number of items sent to a worker at once
+        mp_context: start method of the worker processes
+    """
+    if num_workers <= 1:
+        _init_worker(initializer, initargs, None)
+        try:
+            for item in items:
+                yield fn(item)
+        finally:
+            if finalizer is not None:
+                finalizer()
+        return
+
+    ctx = multiprocessing.get_context(mp_context)
+    pool = ctx.Pool(
+        num_workers, initializer=_init_worker, initargs=(initializer, initargs, finalizer)
+    )
+    try:
+        yield from pool.imap_unordered(fn, items, chunksize=chunksize)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class ThroughputMeter(object):
+    """
+    Count the processed items, and log the running throughput at most once every `log_interval` seconds.
+    """
+
+    def __init__(self, log_interval: float = 10.0, unit: str = 'images'):
+        self.log_interval = log_interval
+        self.unit = unit
+        self.count = 0
+        self.failed = 0
+        self.start_time = time.perf_counter()
+        self._last_log_time = self.start_time
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    @property
+    def throughput(self) -> float:
+        return self.count / max(self.elapsed, 1e-6)
+
+    def update(self, num: int = 1, failed: int = 0):
+        self.count += num
+        self.failed += failed
+        now = time.perf_counter()
+        if now - self._last_log_time >= self.log_interval:
+            self._last_log_time = now
+            self.log()
+
+    def log(self):
+        logger.info(
+            '%d %s processed (%d failed) in %.1fs, %.2f %s/s'
+            % (self.count, self.unit, self.failed, self.elapsed, self.throughput, self.unit)
+        )
@@ -21,8 +21,6 @@
 import numpy as np
 import cv2
 from typing import List, Tuple, Dict, Optional
-from unidecode import unidecode
-from scipy.optimize import linear_sum_assignment
 from .geometry import rbbox_to_polygon, fit_rbbox
 
 __all__ = [
@@ -32,6 +30,10 @@ __all__ = [
     'mask_iou',
     'rbox_to_mask',
     'nms',
+    'box_overlap_pairs',
+    'polygon_iou',
+    'assign_pairs',
+    'match_boxes',
     'LocalizationConfusion',
 ]
 
@@ -49,6 +51,8 @@ def string_match(word1: str, word2: str) -> Tuple[bool, bool, bool, bool]:
     """
     raw_match = word1 == word2
     caseless_match = word1.lower() == word2.lower()
+    from unidecode import unidecode
+
     unidecode_match = unidecode(word1) == unidecode(word2)
 
     # Warning: the order is important here otherwise the pair ("EUR", "€") cannot be matched
@@ -304,36 +308,240 @@ def nms(boxes: np.ndarray, thresh: float = 0.5) -> List[int]:
     return keep
 
 
-class LocalizationConfusion:
-    """Implements common confusion metrics and mean IoU for localization evaluation.
+def _box_cells(
+    boxes: np.ndarray, origin: np.ndarray, cell_size: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The grid cells covered by each (xmin, ymin, xmax, ymax) box, as (cell_x, cell_y, box_idx) triplets."""
+    lo = np.floor((boxes[:, :2] - origin) / cell_size).astype(np.int64)
+    hi = np.floor((boxes[:, 2:] - origin) / cell_size).astype(np.int64)
+    num_x, num_y = (hi - lo + 1).T
+    counts = num_x * num_y
+    box_idx = np.repeat(np.arange(boxes.shape[0]), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_x = lo[box_idx, 0] + offsets % num_x[box_idx]
+    cell_y = lo[box_idx, 1] + offsets // num_x[box_idx]
+    return cell_x, cell_y, box_idx
+
+
+def box_overlap_pairs(
+    boxes_1: np.ndarray, boxes_2: np.ndarray, cell_size: Optional[float] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the pairs of boxes whose extents overlap, using a uniform grid as the spatial index,
+    so only boxes sharing a grid cell are compared instead of all the N x M pairs.
 
-    The aggregated metrics are computed as follows:
+    Args:
+        boxes_1: bounding boxes of shape (N, 4) in format (xmin, ymin, xmax, ymax)
+        boxes_2: bounding boxes of shape (M, 4) in format (xmin, ymin, xmax, ymax)
+        cell_size: side of the grid cells, default to the median of the longer sides of all the boxes
 
-    .. math::
-        \\forall Y \\in \\mathcal{B}^N, \\forall X \\in \\mathcal{B}^M, \\\\
-        Recall(X, Y) = \\frac{1}{N} \\sum\\limits_{i=1}^N g_{X}(Y_i) \\\\
-        Precision(X, Y) = \\frac{1}{M} \\sum\\limits_{i=1}^N g_{X}(Y_i) \\\\
-        meanIoU(X, Y) = \\frac{1}{M} \\sum\\limits_{i=1}^M \\max\\limits_{j \\in [1, N]}  IoU(X_i, Y_j)
+    Returns:
+        the indices in `boxes_1` and in `boxes_2` of the overlapping pairs, sorted
+    """
+    empty = np.zeros((0,), dtype=np.int64)
+    if boxes_1.shape[0] == 0 or boxes_2.shape[0] == 0:
+        return empty, empty
+
+    boxes_1 = np.asarray(boxes_1, dtype=np.float64)
+    boxes_2 = np.asarray(boxes_2, dtype=np.float64)
+    all_boxes = np.concatenate((boxes_1, boxes_2))
+    if cell_size is None:
+        sizes = np.maximum(all_boxes[:, 2] - all_boxes[:, 0], all_boxes[:, 3] - all_boxes[:, 1])
+        cell_size = float(np.median(sizes))
+    cell_size = max(cell_size, 1e-6)
+    origin = all_boxes[:, :2].min(axis=0)
+
+    cx1, cy1, idx_1 = _box_cells(boxes_1, origin, cell_size)
+    cx2, cy2, idx_2 = _box_cells(boxes_2, origin, cell_size)
+    num_cols = int(max(cx1.max(), cx2.max())) + 1
+    keys_1 = cy1 * num_cols + cx1
+    keys_2 = cy2 * num_cols + cx2
+
+    # join the cells of `boxes_1` with the sorted cells of `boxes_2`
+    order = np.argsort(keys_2, kind='stable')
+    sorted_keys_2, sorted_idx_2 = keys_2[order], idx_2[order]
+    left = np.searchsorted(sorted_keys_2, keys_1, side='left')
+    right = np.searchsorted(sorted_keys_2, keys_1, side='right')
+    counts = right - left
+    if counts.sum() == 0:
+        return empty, empty
+    cand_1 = np.repeat(idx_1, counts)
+    positions = (
+        np.arange(counts.sum())
+        - np.repeat(np.cumsum(counts) - counts, counts)
+        + np.repeat(left, counts)
+    )
+    cand_2 = sorted_idx_2[positions]
+
+    # dedup the pairs sharing several cells, and keep the ones really overlapping
+    codes = np.unique(cand_1 * boxes_2.shape[0] + cand_2)
+    cand_1, cand_2 = codes // boxes_2.shape[0], codes % boxes_2.shape[0]
+    b1, b2 = boxes_1[cand_1], boxes_2[cand_2]
+    overlap = (
+        (b1[:, 0] < b2[:, 2])
+        & (b2[:, 0] < b1[:, 2])
+        & (b1[:, 1] < b2[:, 3])
+        & (b2[:, 1] < b1[:, 3])
+    )
+    return cand_1[overlap], cand_2[overlap]
+
+
+def polygon_iou(
+    polys_1: np.ndarray, polys_2: np.ndarray, idx_1: np.ndarray, idx_2: np.ndarray
+) -> np.ndarray:
+    """Compute the IoU between pairs of convex polygons, such as rotated boxes
 
-    with the function :math:`IoU(x, y)` being the Intersection over Union between bounding boxes :math:`x` and
-    :math:`y`, and the function :math:`g_{X}` defined as:
+    Args:
+        polys_1: polygons of shape (N, K, 2)
+        polys_2: polygons of shape (M, K, 2)
+        idx_1: indices in `polys_1` of the pairs
+        idx_2: indices in `polys_2` of the pairs
 
-    .. math::
-        \\forall y \\in \\mathcal{B},
-        g_X(y) = \\left\\{
-            \\begin{array}{ll}
-                1 & \\mbox{if } y\\mbox{ has been assigned to any }(X_i)_i\\mbox{ with an }IoU \\geq 0.5 \\\\
-                0 & \\mbox{otherwise.}
-            \\end{array}
-        \\right.
+    Returns:
+        the IoU vector of the pairs
+    """
+    polys_1 = np.asarray(polys_1, dtype=np.float32)
+    polys_2 = np.asarray(polys_2, dtype=np.float32)
+    areas_1 = np.array([cv2.contourArea(poly) for poly in polys_1], dtype=np.float32)
+    areas_2 = np.array([cv2.contourArea(poly) for poly in polys_2], dtype=np.float32)
+    ious = np.zeros((len(idx_1),), dtype=np.float32)
+    for k, (i, j) in enumerate(zip(idx_1, idx_2)):
+        inter, _ = cv2.intersectConvexConvex(polys_1[i], polys_2[j])
+        if inter > 0:
+            ious[k] = inter / (areas_1[i] + areas_2[j] - inter + 1e-6)
+    return ious
+
+
+def _pair_box_iou(boxes_1: np.ndarray, boxes_2: np.ndarray) -> np.ndarray:
+    """IoU between the aligned rows of two (K, 4) arrays of (xmin, ymin, xmax, ymax) boxes."""
+    w = np.clip(np.minimum(boxes_1[:, 2], boxes_2[:, 2]) - np.maximum(boxes_1[:, 0], boxes_2[:, 0]), 0, None)
+    h = np.clip(np.minimum(boxes_1[:, 3], boxes_2[:, 3]) - np.maximum(boxes_1[:, 1], boxes_2[:, 1]), 0, None)
+    intersection = w * h
+    area_1 = (boxes_1[:, 2] - boxes_1[:, 0]) * (boxes_1[:, 3] - boxes_1[:, 1])
+    area_2 = (boxes_2[:, 2] - boxes_2[:, 0]) * (boxes_2[:, 3] - boxes_2[:, 1])
+    return (intersection / (area_1 + area_2 - intersection + 1e-6)).astype(np.float32)
+
+
+def assign_pairs(
+    idx_1: np.ndarray, idx_2: np.ndarray, ious: np.ndarray, iou_thresh: float = 0.5
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """One-to-one assignment maximizing the total IoU over the pairs with an IoU >= `iou_thresh`.
+    The pairs make a sparse bipartite graph, and the assignment is solved independently in each of
+    its connected components, which are tiny on text pages, instead of on the dense N x M matrix.
 
-    where :math:`\\mathcal{B}` is the set of possible bounding boxes,
-    :math:`N` (number of ground truths) and :math:`M` (number of predictions) are strictly positive integers.
+    Args:
+        idx_1: indices of the first boxes of the pairs
+        idx_2: indices of the second boxes of the pairs
+        ious: IoU of the pairs
+        iou_thresh: minimum IoU of a matched pair
 
-    Example::
+    Returns:
+        the indices of the first and second boxes of the matched pairs, and their IoU
+    """
+    keep = ious >= iou_thresh
+    idx_1, idx_2, ious = idx_1[keep], idx_2[keep], ious[keep]
+    if len(ious) == 0:
+        return idx_1, idx_2, ious
+
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.optimize import linear_sum_assignment
+
+    nodes_1, local_1 = np.unique(idx_1, return_inverse=True)
+    nodes_2, local_2 = np.unique(idx_2, return_inverse=True)
+    num_nodes = len(nodes_1) + len(nodes_2)
+    graph = coo_matrix(
+        (np.ones_like(ious), (local_1, len(nodes_1) + local_2)), shape=(num_nodes, num_nodes)
+    )
+    _, labels = connected_components(graph, directed=False)
+    edge_comps = labels[local_1]
+
+    # components of a single pair are matched directly
+    comp_sizes = np.bincount(edge_comps)
+    single = comp_sizes[edge_comps] == 1
+    matched = [(idx_1[single], idx_2[single], ious[single])]
+
+    order = np.argsort(edge_comps[~single], kind='stable')
+    multi_edges = np.flatnonzero(~single)[order]
+    bounds = np.flatnonzero(np.diff(edge_comps[multi_edges])) + 1
+    for edges in np.split(multi_edges, bounds):
+        if len(edges) == 0:
+            continue
+        rows, row_idx = np.unique(idx_1[edges], return_inverse=True)
+        cols, col_idx = np.unique(idx_2[edges], return_inverse=True)
+        iou_mat = np.zeros((len(rows), len(cols)), dtype=np.float32)
+        iou_mat[row_idx, col_idx] = ious[edges]
+        row_ind, col_ind = linear_sum_assignment(-iou_mat)
+        valid = iou_mat[row_ind, col_ind] >= iou_thresh
+        row_ind, col_ind = row_ind[valid], col_ind[valid]
+        matched.append((rows[row_ind], cols[col_ind], iou_mat[row_ind, col_ind]))
+
+    return tuple(np.concatenate(arrays) for arrays in zip(*matched))
+
+
+def match_boxes(
+    gt_polys: np.ndarray,
+    pred_polys: np.ndarray,
+    iou_thresh: float = 0.5,
+    rotated_bbox: bool = True,
+) -> Dict[str, np.ndarray]:
+    """Match the predicted boxes of an image with its ground truths, one to one.
+    Candidate pairs come from `box_overlap_pairs()` on the extents of the boxes, and only their IoU is
+    computed: exact polygon IoU with `rotated_bbox`, or else the IoU of the extents.
 
     Args:
+        gt_polys: ground truth boxes of shape (N, K, 2)
+        pred_polys: predicted boxes of shape (M, K, 2)
         iou_thresh: minimum IoU to consider a pair of prediction and ground truth as a match
+        rotated_bbox: whether the boxes are rotated polygons, instead of axis-aligned boxes
+
+    Returns:
+        dict with keys:
+            'gt_indices', 'pred_indices', 'ious': the matched pairs and their IoU;
+            'gt_best_ious': the largest IoU of each ground truth with any prediction, of shape (N,)
+    """
+    gt_polys = np.asarray(gt_polys, dtype=np.float32).reshape(-1, 4, 2)
+    pred_polys = np.asarray(pred_polys, dtype=np.float32).reshape(-1, 4, 2)
+    gt_boxes = np.concatenate((gt_polys.min(axis=1), gt_polys.max(axis=1)), axis=1)
+    pred_boxes = np.concatenate((pred_polys.min(axis=1), pred_polys.max(axis=1)), axis=1)
+
+    idx_1, idx_2 = box_overlap_pairs(gt_boxes, pred_boxes)
+    if rotated_bbox:
+        ious = polygon_iou(gt_polys, pred_polys, idx_1, idx_2)
+    else:
+        ious = _pair_box_iou(gt_boxes[idx_1], pred_boxes[idx_2])
+
+    gt_best_ious = np.zeros((gt_polys.shape[0],), dtype=np.float32)
+    np.maximum.at(gt_best_ious, idx_1, ious)
+    gt_indices, pred_indices, matched_ious = assign_pairs(idx_1, idx_2, ious, iou_thresh)
+    return {
+        'gt_indices': gt_indices,
+        'pred_indices': pred_indices,
+        'ious': matched_ious,
+        'gt_best_ious': gt_best_ious,
+    }
+
+
+class LocalizationConfusion:
+    """Implements the ICDAR-style detection metrics and the mean IoU for localization evaluation.
+
+    In each image, predictions and ground truths are matched one to one by `match_boxes()`, and the
+    aggregated metrics are computed as follows:
+
+    .. math::
+        Recall = \\frac{\\sum matches}{\\sum N} \\\\
+        Precision = \\frac{\\sum matches}{\\sum M} \\\\
+        Hmean = \\frac{2 \\cdot Precision \\cdot Recall}{Precision + Recall} \\\\
+        meanIoU = \\frac{1}{\\sum N} \\sum\\limits_{i} \\max\\limits_{j} IoU(Y_i, X_j)
+
+    where a match is a pair of prediction and ground truth with an IoU >= `iou_thresh`,
+    :math:`N` is the number of ground truths and :math:`M` the number of predictions of an image,
+    and :math:`IoU(x, y)` is the IoU between the rotated polygons (with `rotated_bbox`)
+    or the axis-aligned boxes :math:`x` and :math:`y`.
+
+    Args:
+        iou_thresh: minimum IoU to consider a pair of prediction and ground truth as a match
+        rotated_bbox: whether the boxes are rotated boxes in format (x, y, w, h, alpha)
+        mask_shape: (height, width) of the images, to scale the normalized predictions
     """
 
     def __init__(
@@ -354,87 +562,81 @@ class LocalizationConfusion:
 
         Args:
             gt_boxes: 这里面的值是未归一化到 [0, 1] 的
-            norm_preds: 这里面的值是归一化到 [0, 1] 的
+            norm_preds: 这里面的值是归一化到 [0, 1] 的；旋转框的格式为 (x, y, w, h, alpha)，
+                否则为 (xmin, ymin, xmax, ymax)
 
-        Returns:
+        Returns: 这个 batch 的指标，包括 'iou', 'precision', 'recall' 和 'hmean'
 
         """
-        gts = self._transform_gt_polygons(gt_boxes)
-        preds = []
-        for n_pred in norm_preds:
-            pred = n_pred.copy()
-            pred[:, [0, 2]] *= self.mask_shape[1]
-            pred[:, [1, 3]] *= self.mask_shape[0]
-            preds.append(pred)
-
-        cur_iou, cur_matches = 0.0, 0.0
-        batch_size = len(preds)
-        if batch_size > 0:
-            # Compute IoU
-            if self.rotated_bbox:
-                mask_gts = rbox_to_mask(gts, shape=self.mask_shape)
-                mask_preds = rbox_to_mask(preds, shape=self.mask_shape)
-                iou_vec, prec_vec, recall_vec = mask_iou(mask_gts, mask_preds)
-                cur_iou = iou_vec.sum()
-                cur_prec = prec_vec.sum()
-                cur_recall = recall_vec.sum()
-                cur_matches = int((iou_vec >= self.iou_thresh).sum())
-            else:
-                iou_mat, prec_mat, recall_mat = box_iou(np.concatenate(gts), np.concatenate(preds))
-                cur_iou = float(iou_mat.max(axis=1).sum())
-                cur_prec = float(prec_mat.max(axis=1).sum())
-                cur_recall = float(recall_mat.max(axis=1).sum())
-
-                # Assign pairs
-                gt_indices, pred_indices = linear_sum_assignment(-iou_mat)
-                cur_matches = int(
-                    (iou_mat[gt_indices, pred_indices] >= self.iou_thresh).sum()
-                )
-
-        batch_res = {'iou': cur_iou, 'match': cur_matches, 'precision': cur_prec, 'recall': cur_recall}
-        cur_res = dict()
+        batch_res = {'iou': 0.0, 'match': 0, 'num_gts': 0, 'num_preds': 0}
+        for gts, n_pred in zip(gt_boxes, norm_preds):
+            gt_polys = self._transform_gt_polygons(gts)
+            pred_polys = self._transform_pred_polygons(n_pred)
+            res = match_boxes(
+                gt_polys, pred_polys, self.iou_thresh, rotated_bbox=self.rotated_bbox
+            )
+            batch_res['iou'] += float(res['gt_best_ious'].sum())
+            batch_res['match'] += len(res['ious'])
+            batch_res['num_gts'] += len(gt_polys)
+            batch_res['num_preds'] += len(pred_polys)
+
         for name, val in batch_res.items():
             self.total_res[name] += val
-            cur_res[name] = val / (1e-6 + batch_size)
-        # Update counts
-        self.num_gts += batch_size
-
-        return cur_res
-
-    def _transform_gt_polygons(
-        self, polgons: List[List[np.ndarray]]
-    ) -> List[np.ndarray]:
+        return self._compute_metrics(batch_res)
+
+    @staticmethod
+    def _compute_metrics(res: Dict[str, float]) -> Dict[str, float]:
+        recall = res['match'] / (1e-6 + res['num_gts'])
+        precision = res['match'] / (1e-6 + res['num_preds'])
+        return {
+            'iou': res['iou'] / (1e-6 + res['num_gts']),
+            'precision': precision,
+            'recall': recall,
+            'hmean': 2 * precision * recall / (precision + recall + 1e-6),
+        }
+
+    def _transform_gt_polygons(self, polygons: List[np.ndarray]) -> np.ndarray:
         """
 
         Args:
-            polgons: 最里层每个 np.ndarray 是个 [4, 2] 的矩阵，表示一个box的4个点的坐标。
+            polygons: 每个 np.ndarray 是个 [4, 2] 的矩阵，表示一个box的4个点的坐标。
 
         Returns:
-            list of rotated bounding boxes of shape (M, 5) in format (x, y, w, h, alpha)
+            polygons of shape (N, 4, 2): the min-area rotated boxes of the polygons with `rotated_bbox`,
+            or else their axis-aligned bounding boxes
 
         """
         out = []
-        for boxes in polgons:
-            new_boxes = []
-            for box in boxes:
-                box = box.astype(np.uint)
-                new_boxes.append(
-                    fit_rbbox(box) if self.rotated_bbox else cv2.boundingRect(box)
-                )
-            out.append(np.asarray(new_boxes))
-        return out
-
-    def summary(self) -> Tuple[Optional[float], Optional[float]]:
+        for box in polygons:
+            box = np.asarray(box, dtype=np.float32).reshape(-1, 2)
+            if self.rotated_bbox:
+                out.append(rbbox_to_polygon(fit_rbbox(box)))
+            else:
+                (xmin, ymin), (xmax, ymax) = box.min(axis=0), box.max(axis=0)
+                out.append([[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]])
+        return np.asarray(out, dtype=np.float32).reshape(-1, 4, 2)
+
+    def _transform_pred_polygons(self, norm_pred: np.ndarray) -> np.ndarray:
+        """Scale the normalized predictions to `mask_shape`, and convert them into polygons of shape (M, 4, 2)."""
+        pred = np.asarray(norm_pred, dtype=np.float32).copy()
+        pred[:, [0, 2]] *= self.mask_shape[1]
+        pred[:, [1, 3]] *= self.mask_shape[0]
+        if self.rotated_bbox:
+            out = [rbbox_to_polygon(box[:5]) for box in pred]
+        else:
+            out = [
+                [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]]
+                for xmin, ymin, xmax, ymax in pred[:, :4]
+            ]
+        return np.asarray(out, dtype=np.float32).reshape(-1, 4, 2)
+
+    def summary(self) -> Dict[str, float]:
         """Computes the aggregated metrics
 
         Returns:
-            a tuple with the recall, precision and meanIoU scores
+            a dict with the meanIoU, precision, recall and hmean scores
         """
-        num_gts = 1e-6 + self.num_gts
-        out_res = {name: val / num_gts for name, val in self.total_res.items()}
-
-        return out_res
+        return self._compute_metrics(self.total_res)
 
     def reset(self) -> None:
-        self.num_gts = 0
-        self.total_res = {'iou': 0.0, 'match': 0.0, 'precision': 0.0, 'recall': 0.0}
+        self.total_res = {'iou': 0.0, 'match': 0, 'num_gts': 0, 'num_preds': 0}
@@ -0,0 +1,257 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from ._utils import quad_crop_sizes
+
+__all__ = ['split_refine_tiles', 'prob_map_text_regions', 'select_refine_tiles', 'merge_refined_boxes']
+
+Tile = Tuple[int, int, int, int]  # (xmin, ymin, xmax, ymax)
+
+
+def _boxes_array(box_infos: List[Dict[str, Any]]) -> np.ndarray:
+    if len(box_infos) == 0:
+        return np.zeros((0, 4, 2), dtype=np.float32)
+    return np.stack(
+        [np.asarray(info['box'], dtype=np.float32).reshape(4, 2) for info in box_infos]
+    )
+
+
+def _bboxes(quads: np.ndarray) -> np.ndarray:
+    """(N, 4, 2) quads to (N, 4) axis-aligned boxes (xmin, ymin, xmax, ymax)."""
+    return np.concatenate((quads.min(axis=1), quads.max(axis=1)), axis=1)
+
+
+def _partial_overlaps(bboxes1: np.ndarray, bboxes2: np.ndarray) -> np.ndarray:
+    """(N, M) intersection areas divided by the areas of `bboxes1`."""
+    lt = np.maximum(bboxes1[:, None, :2], bboxes2[None, :, :2])
+    rb = np.minimum(bboxes1[:, None, 2:], bboxes2[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    areas = np.maximum((bboxes1[:, 2:] - bboxes1[:, :2]).prod(axis=1), 1e-6)
+    return inter / areas[:, None]
+
+
+def split_refine_tiles(
+    img_hw: Tuple[int, int], refine_scale: float, overlap: float = 0.1
+) -> List[Tile]:
+    """
+    Split an image into a grid of `ceil(refine_scale) x ceil(refine_scale)` overlapping tiles.
+    Detecting a tile at the same `resized_shape` as the whole image multiplies the resolution by about `refine_scale`.
+    """
+    height, width = img_hw
+    num = max(1, int(math.ceil(refine_scale)))
+    if num == 1:
+        return [(0, 0, width, height)]
+    tile_h = min(height, int(math.ceil(height / num * (1 + overlap))))
+    tile_w = min(width, int(math.ceil(width / num * (1 + overlap))))
+    ys = np.linspace(0, height - tile_h, num).round().astype(int)
+    xs = np.linspace(0, width - tile_w, num).round().astype(int)
+    return [(int(x), int(y), int(x) + tile_w, int(y) + tile_h) for y in ys for x in xs]
+
+
+def prob_map_text_regions(
+    prob_map: np.ndarray,
+    scale: Tuple[float, float],
+    *,
+    bin_thresh: float = 0.3,
+    unclip_ratio: float = 1.5,
+    min_area: int = 3,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Estimate the text height of each text region of a probability map, including the regions too small
+    to give a box. The regions are the connected components of the binarized map; as in the post-processing,
+    they are shrunk text areas, so their sizes are expanded by `unclip_ratio`.
+
+    Args:
+        prob_map: [H, W] probability map, with values in [0, 1]
+        scale: (x, y) scales from the coordinates of the map to those of the original image
+        bin_thresh: threshold binarizing the map
+        unclip_ratio: ratio expanding the regions, as the boxes are
+        min_area: regions with fewer pixels are ignored
+
+    Returns: (centers, heights) of the regions, with shapes (N, 2) and (N,), in the original image
+    """
+    mask = (prob_map >= bin_thresh).astype(np.uint8)
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    stats, centroids = stats[1:], centroids[1:]  # the first component is the background
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    stats, centroids = stats[keep], centroids[keep]
+    widths = stats[:, cv2.CC_STAT_WIDTH].astype(np.float32)
+    heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float32)
+    short, long = np.minimum(widths, heights), np.maximum(widths, heights)
+    # the distance of `unclip()`: area * unclip_ratio / perimeter
+    distances = short * long * unclip_ratio / np.maximum(2 * (short + long), 1e-6)
+    scale_x, scale_y = scale
+    text_heights = (short + 2 * distances) * np.where(heights <= widths, scale_y, scale_x)
+    centers = (centroids * np.array([scale_x, scale_y])).astype(np.float32)
+    return centers, text_heights.astype(np.float32)
+
+
+def select_refine_tiles(
+    box_infos: List[Dict[str, Any]],
+    tiles: List[Tile],
+    resize_ratio: float,
+    *,
+    min_text_height: float,
+    box_score_thresh: float,
+    text_regions: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+) -> Tuple[List[int], np.ndarray]:
+    """
+    Find the boxes of the coarse pass which need a finer resolution, and the tiles containing them
+    or the small text regions of the coarse probability map.
+
+    Args:
+        box_infos: boxes detected by the coarse pass, dicts with keys 'box' and 'score'
+        tiles: candidate tiles, from `split_refine_tiles()`
+        resize_ratio: ratio of the coarse resizing, i.e. (resized height) / (original height)
+        min_text_height: boxes whose text height in the resized image is lower than this value are too small
+        box_score_thresh: boxes with scores lower than this value are borderline
+        text_regions: (centers, heights) of the text regions of the coarse probability map,
+            from `prob_map_text_regions()`; the regions lower than `min_text_height` are too small as well
+
+    Returns: (indices of the tiles to refine, boolean flags of the boxes which need refining)
+    """
+    quads = _boxes_array(box_infos)
+    text_heights = quad_crop_sizes(quads).min(axis=1) * resize_ratio
+    scores = np.asarray([info['score'] for info in box_infos], dtype=np.float32)
+    flags = (text_heights < min_text_height) | (scores < box_score_thresh)
+
+    centers = quads[flags].mean(axis=1)
+    if text_regions is not None:
+        region_centers, region_heights = text_regions
+        small = region_heights * resize_ratio < min_text_height
+        centers = np.concatenate((centers, region_centers[small].reshape(-1, 2)))
+    selected = []
+    for idx, (xmin, ymin, xmax, ymax) in enumerate(tiles):
+        inside = (
+            (centers[:, 0] >= xmin)
+            & (centers[:, 0] < xmax)
+            & (centers[:, 1] >= ymin)
+            & (centers[:, 1] < ymax)
+        )
+        if inside.any():
+            selected.append(idx)
+    return selected, flags
+
+
+def merge_refined_boxes(
+    box_infos: List[Dict[str, Any]],
+    flags: np.ndarray,
+    refined_infos: List[List[Dict[str, Any]]],
+    tiles: List[Tile],
+    *,
+    box_score_thresh: float,
+    overlap_thresh: float = 0.5,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Merge the boxes of the coarse pass with the boxes detected on tiles at a finer resolution.
+
+      * Coarse boxes which do not need refining are kept, and fine boxes mostly covered by them are dropped;
+      * coarse borderline boxes (scores lower than `box_score_thresh`) are dropped;
+      * coarse small boxes are kept only if no fine box covers them;
+      * fine boxes from overlapping tiles which are on the same text line and overlap each other are
+        merged into their enclosing horizontal box.
+
+    Args:
+        box_infos: boxes detected by the coarse pass, dicts with keys 'box' and 'score'
+        flags: flags of the coarse boxes which need refining, from `select_refine_tiles()`
+        refined_infos: boxes detected on each tile, with coordinates relative to the tile
+        tiles: the refined tiles, with the same length as `refined_infos`
+        box_score_thresh: score threshold of the final boxes
+        overlap_thresh: a box is covered by another one if this ratio of its area is inside the other one
+
+    Returns: (kept box dicts, new box dicts); new boxes are merged from several fine boxes,
+        their 'cropped_img' should be extracted again
+    """
+    fine = []
+    for infos, (xmin, ymin, _, _) in zip(refined_infos, tiles):
+        for info in infos:
+            if info['score'] < box_score_thresh:
+                continue
+            info = dict(info)
+            info['box'] = np.asarray(info['box'], dtype=np.float32) + np.array(
+                [xmin, ymin], dtype=np.float32
+            )
+            fine.append(info)
+
+    coarse_bboxes = _bboxes(_boxes_array(box_infos))
+    fine_bboxes = _bboxes(_boxes_array(fine))
+    kept = [info for info, flag in zip(box_infos, flags) if not flag]
+    if len(fine) > 0 and len(kept) > 0:
+        covered = _partial_overlaps(fine_bboxes, coarse_bboxes[~flags]).max(axis=1)
+        keep = covered < overlap_thresh
+        fine = [info for info, k in zip(fine, keep) if k]
+        fine_bboxes = fine_bboxes[keep]
+
+    # coarse small boxes are only replaced when the fine pass finds them again
+    small = [
+        idx
+        for idx, (info, flag) in enumerate(zip(box_infos, flags))
+        if flag and info['score'] >= box_score_thresh
+    ]
+    if len(small) > 0:
+        if len(fine) > 0:
+            covered = _partial_overlaps(coarse_bboxes[small], fine_bboxes).max(axis=1)
+        else:
+            covered = np.zeros(len(small))
+        kept.extend(box_infos[idx] for idx, c in zip(small, covered) if c < overlap_thresh)
+
+    # group fine boxes overlapping each other on the same line, by union-find
+    parents = list(range(len(fine)))
+
+    def _find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    if len(fine) > 1:
+        lt = np.maximum(fine_bboxes[:, None, :2], fine_bboxes[None, :, :2])
+        rb = np.minimum(fine_bboxes[:, None, 2:], fine_bboxes[None, :, 2:])
+        inter_w, inter_h = (rb - lt)[..., 0], (rb - lt)[..., 1]
+        heights = fine_bboxes[:, 3] - fine_bboxes[:, 1]
+        union_h = (
+            np.maximum(fine_bboxes[:, None, 3], fine_bboxes[None, :, 3])
+            - np.minimum(fine_bboxes[:, None, 1], fine_bboxes[None, :, 1])
+        )
+        same_line = (inter_w > 0) & (inter_h > 0.6 * np.maximum(union_h, 1e-6))
+        same_line &= inter_h > 0.6 * np.minimum(heights[:, None], heights[None, :])
+        for i, j in zip(*np.nonzero(np.triu(same_line, k=1))):
+            parents[_find(i)] = _find(j)
+
+    groups: Dict[int, List[int]] = {}
+    for idx in range(len(fine)):
+        groups.setdefault(_find(idx), []).append(idx)
+    new = []
+    for members in groups.values():
+        if len(members) == 1:
+            kept.append(fine[members[0]])
+            continue
+        xmin, ymin = fine_bboxes[members, :2].min(axis=0)
+        xmax, ymax = fine_bboxes[members, 2:].max(axis=0)
+        box = np.array(
+            [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]], dtype=np.float32
+        )
+        new.append({'box': box, 'score': max(fine[idx]['score'] for idx in members)})
+    return kept, new
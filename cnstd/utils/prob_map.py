@@ -0,0 +1,65 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+from pathlib import Path
+from typing import Any, Dict, Union
+
+import numpy as np
+
+__all__ = [
+    'quantize_prob_map',
+    'dequantize_prob_map',
+    'save_prob_map',
+    'load_prob_map',
+]
+
+
+def quantize_prob_map(prob_map: np.ndarray) -> np.ndarray:
+    """Quantize a probability map with values in [0, 1] to uint8, with a step of 1/255."""
+    return np.round(np.clip(prob_map, 0.0, 1.0) * 255).astype(np.uint8)
+
+
+def dequantize_prob_map(prob_map: np.ndarray) -> np.ndarray:
+    """Float32 probability map from a map quantized by `quantize_prob_map()`."""
+    return prob_map.astype(np.float32) * np.float32(1 / 255)
+
+
+def save_prob_map(fp: Union[str, Path], prob_map: Dict[str, Any]):
+    """
+    Save a probability map returned by `detect(..., return_prob_map=True)` into a compressed '.npz' file:
+    the quantized map as an array, and the other (JSON-serializable) values of the dict as metadata.
+    The file is written atomically, so a killed job never leaves a partial file.
+    """
+    fp = str(fp)
+    meta = {k: v for k, v in prob_map.items() if k != 'map'}
+    os.makedirs(os.path.dirname(os.path.abspath(fp)), exist_ok=True)
+    tmp_fp = '%s.tmp%d' % (fp, os.getpid())
+    with open(tmp_fp, 'wb') as f:
+        np.savez_compressed(f, map=prob_map['map'], meta=np.array(json.dumps(meta)))
+    os.replace(tmp_fp, fp)
+
+
+def load_prob_map(fp: Union[str, Path]) -> Dict[str, Any]:
+    """Load a probability map saved by `save_prob_map()`."""
+    with np.load(str(fp)) as data:
+        prob_map = json.loads(str(data['meta']))
+        prob_map['map'] = data['map']
+    return prob_map
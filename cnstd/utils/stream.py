@@ -0,0 +1,450 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import queue
+import threading
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .utils import is_tensor, to_uint8_hwc, sort_boxes
+
+if TYPE_CHECKING:
+    import torch
+
+__all__ = [
+    'FrameChangeEstimator',
+    'iter_video_frames',
+    'iter_frames',
+    'prefetch',
+    'reuse_detections',
+]
+
+
+class FrameChangeEstimator(object):
+    """Measure the change between two frames cheaply, on downsampled grayscale signatures.
+
+    Args:
+        signature_width: width of the signatures; the height follows the aspect ratio of the frames
+        pixel_thresh: a signature pixel is changed if its absolute difference is larger than this value
+        static_ratio: frames with a ratio of changed signature pixels not larger than this value are static
+        region_ratio: a changed region covering more than this ratio of the frame triggers a full detection
+        region_margin: margin in pixels added around a changed region
+        max_shift_ratio: the largest global motion (relative to the frame size) tried before giving up
+        patch_size: size of the full-resolution patch used to refine the global motion
+        shift_error_ratio: the largest ratio of changed pixels on the overlapping area of two frames
+            accepted for a global motion; it is larger than `static_ratio` since compression noise
+            is stronger at full resolution
+    """
+
+    def __init__(
+        self,
+        *,
+        signature_width: int = 128,
+        pixel_thresh: float = 8.0,
+        static_ratio: float = 0.002,
+        region_ratio: float = 0.5,
+        region_margin: int = 16,
+        max_shift_ratio: float = 0.25,
+        patch_size: int = 256,
+        shift_error_ratio: float = 0.02,
+    ) -> None:
+        self.signature_width = signature_width
+        self.pixel_thresh = pixel_thresh
+        self.static_ratio = static_ratio
+        self.region_ratio = region_ratio
+        self.region_margin = region_margin
+        self.max_shift_ratio = max_shift_ratio
+        self.patch_size = patch_size
+        self.shift_error_ratio = shift_error_ratio
+
+    def signature(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            frame: [H, W, 3] or [H, W] uint8 image, in any color order
+
+        Returns: float32 grayscale signature with shape [h, signature_width]
+        """
+        height, width = frame.shape[:2]
+        sig_w = min(self.signature_width, width)
+        sig_h = max(1, int(round(height * sig_w / width)))
+        sig = cv2.resize(frame, (sig_w, sig_h), interpolation=cv2.INTER_AREA)
+        if sig.ndim == 3:
+            sig = sig.mean(axis=2)
+        return sig.astype(np.float32)
+
+    def compare(
+        self,
+        ref_frame: np.ndarray,
+        frame: np.ndarray,
+        ref_sig: Optional[np.ndarray] = None,
+        sig: Optional[np.ndarray] = None,
+    ) -> Tuple[str, Optional[Tuple[int, ...]]]:
+        """
+        Compare the current frame with the reference frame.
+
+        Args:
+            ref_frame: the reference frame
+            frame: the current frame
+            ref_sig: signature of the reference frame; computed if it is None
+            sig: signature of the current frame; computed if it is None
+
+        Returns: (status, info)
+            * ('static', None): nothing changes;
+            * ('shifted', (dx, dy)): the whole content moves by (dx, dy) pixels;
+            * ('region', (xmin, ymin, xmax, ymax)): only the content inside this box changes;
+            * ('changed', None): too much changes.
+        """
+        ref_sig = self.signature(ref_frame) if ref_sig is None else ref_sig
+        sig = self.signature(frame) if sig is None else sig
+        if ref_frame.shape != frame.shape or ref_sig.shape != sig.shape:
+            return 'changed', None
+        changed = np.abs(sig - ref_sig) > self.pixel_thresh
+        if changed.mean() <= self.static_ratio:
+            return 'static', None
+
+        shift = self._estimate_shift(ref_frame, frame, ref_sig, sig)
+        if shift is not None:
+            return 'shifted', shift
+
+        height, width = frame.shape[:2]
+        scale_x, scale_y = width / sig.shape[1], height / sig.shape[0]
+        ys, xs = np.nonzero(changed)
+        xmin = max(0, int(xs.min() * scale_x) - self.region_margin)
+        ymin = max(0, int(ys.min() * scale_y) - self.region_margin)
+        xmax = min(width, int(np.ceil((xs.max() + 1) * scale_x)) + self.region_margin)
+        ymax = min(height, int(np.ceil((ys.max() + 1) * scale_y)) + self.region_margin)
+        if (xmax - xmin) * (ymax - ymin) > self.region_ratio * height * width:
+            return 'changed', None
+        return 'region', (xmin, ymin, xmax, ymax)
+
+    def _estimate_shift(
+        self, ref_frame: np.ndarray, frame: np.ndarray, ref_sig: np.ndarray, sig: np.ndarray
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Estimate a global translation by phase correlation on the signatures, refine it to whole pixels
+        on a full-resolution patch, and verify it on the overlapping area of the two frames.
+        """
+        (sig_dx, sig_dy), _ = cv2.phaseCorrelate(ref_sig, sig)
+        sig_h, sig_w = sig.shape
+        if abs(sig_dx) < 0.5 and abs(sig_dy) < 0.5:
+            return None
+        if abs(sig_dx) > self.max_shift_ratio * sig_w or abs(sig_dy) > self.max_shift_ratio * sig_h:
+            return None
+
+        height, width = frame.shape[:2]
+        scale_x, scale_y = width / sig_w, height / sig_h
+        dx, dy = int(round(sig_dx * scale_x)), int(round(sig_dy * scale_y))
+
+        # refine on a patch at the center of the overlapping area
+        patch_w = min(self.patch_size, width - abs(dx))
+        patch_h = min(self.patch_size, height - abs(dy))
+        x0 = max(0, -dx) + (width - abs(dx) - patch_w) // 2
+        y0 = max(0, -dy) + (height - abs(dy) - patch_h) // 2
+        (res_dx, res_dy), _ = cv2.phaseCorrelate(
+            _to_gray(ref_frame[y0 : y0 + patch_h, x0 : x0 + patch_w]),
+            _to_gray(frame[y0 + dy : y0 + dy + patch_h, x0 + dx : x0 + dx + patch_w]),
+        )
+        dx, dy = dx + int(round(res_dx)), dy + int(round(res_dy))
+        if (dx == 0 and dy == 0) or abs(dx) >= width or abs(dy) >= height:
+            return None
+
+        # compare area-averaged overlaps, which are robust to compression noise
+        step = max(2, int(min(scale_x, scale_y)) // 2)
+        ref_overlap = ref_frame[
+            max(0, -dy) : height - max(0, dy), max(0, -dx) : width - max(0, dx)
+        ]
+        overlap = frame[max(0, dy) : height - max(0, -dy), max(0, dx) : width - max(0, -dx)]
+        size = (max(1, overlap.shape[1] // step), max(1, overlap.shape[0] // step))
+        ref_overlap = cv2.resize(ref_overlap, size, interpolation=cv2.INTER_AREA)
+        overlap = cv2.resize(overlap, size, interpolation=cv2.INTER_AREA)
+        changed = np.abs(_to_gray(overlap) - _to_gray(ref_overlap)) > self.pixel_thresh
+        if changed.mean() > self.shift_error_ratio:
+            return None
+        return dx, dy
+
+
+def _to_gray(img: np.ndarray) -> np.ndarray:
+    img = img.astype(np.float32)
+    return img.mean(axis=2) if img.ndim == 3 else img
+
+
+def iter_video_frames(video_fp: Union[str, Path]) -> Iterator[np.ndarray]:
+    """Read the frames of a video file one by one. The frames are BGR-style, as `cv2.VideoCapture` returns."""
+    cap = cv2.VideoCapture(str(video_fp))
+    if not cap.isOpened():
+        raise FileNotFoundError('can not open video %s' % video_fp)
+    try:
+        while True:
+            ret_val, frame = cap.read()
+            if not ret_val:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+
+def iter_frames(
+    frames: Union[str, Path, np.ndarray, 'torch.Tensor', Iterable[Any]], color_order: str
+) -> Tuple[Iterator[np.ndarray], str]:
+    """
+    Turn a stream into an iterator of [H, W, 3] uint8 frames.
+
+    Args:
+        frames: a video file path, a [N, H, W, 3] np.ndarray / torch.Tensor, or an iterable of
+            Image.Image / [H, W, 3] np.ndarray / torch.Tensor
+        color_order: color order of the np.ndarray / torch.Tensor frames, 'rgb' or 'bgr'
+
+    Returns: (iterator of frames, color order of the np.ndarray frames)
+        Frames read from a video file are BGR-style.
+    """
+    if isinstance(frames, (str, Path)):
+        return iter_video_frames(frames), 'bgr'
+    if is_tensor(frames):
+        frames = frames.detach().cpu().numpy()
+
+    def _iter():
+        for frame in frames:
+            if is_tensor(frame):
+                frame = frame.detach().cpu().numpy()
+            elif isinstance(frame, Image.Image):
+                frame = to_uint8_hwc(frame)  # RGB-style
+                if color_order == 'bgr':
+                    frame = np.ascontiguousarray(frame[:, :, ::-1])
+            yield to_uint8_hwc(frame)
+
+    return _iter(), color_order
+
+
+class _PrefetchEnd(object):
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+def prefetch(iterable: Iterable[Any], num_prefetch: int = 1) -> Iterator[Any]:
+    """
+    Iterate `iterable` in a background thread, e.g. to decode page i+1 while page i is inferred.
+    At most `num_prefetch` items are produced ahead of the consumer.
+    Exceptions raised by `iterable` are raised again by the consumer.
+    """
+    items = queue.Queue(maxsize=max(1, num_prefetch))
+    stopped = threading.Event()
+
+    def _put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    return
+        except BaseException as e:
+            _put(_PrefetchEnd(e))
+        else:
+            _put(_PrefetchEnd())
+
+    worker = threading.Thread(target=_produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = items.get()
+            if isinstance(item, _PrefetchEnd):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def _offset_box_infos(
+    box_infos: List[Dict[str, Any]], dx: float, dy: float
+) -> List[Dict[str, Any]]:
+    out = []
+    for info in box_infos:
+        info = dict(info)
+        info['box'] = np.asarray(info['box']) + np.array([dx, dy], dtype=np.float32)
+        out.append(info)
+    return out
+
+
+def _box_infos_overlapping(
+    box_infos: List[Dict[str, Any]], region: Tuple[int, int, int, int]
+) -> np.ndarray:
+    if len(box_infos) == 0:
+        return np.zeros(0, dtype=bool)
+    boxes = np.stack([np.asarray(info['box']).reshape(-1, 2) for info in box_infos])
+    mins, maxs = boxes.min(axis=1), boxes.max(axis=1)
+    xmin, ymin, xmax, ymax = region
+    return (
+        (mins[:, 0] < xmax) & (maxs[:, 0] > xmin) & (mins[:, 1] < ymax) & (maxs[:, 1] > ymin)
+    )
+
+
+def _redetect_region(
+    frame: np.ndarray,
+    box_infos: List[Dict[str, Any]],
+    region: Tuple[int, int, int, int],
+    detect_fn: Callable[[np.ndarray], List[Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    """Run `detect_fn` on a region of `frame`, and replace the boxes overlapping the region by the new ones."""
+    # grow the region to cover the old boxes it cuts through, so they are detected again as a whole;
+    # the grown region may cut through other boxes, so grow it until it covers all of them
+    height, width = frame.shape[:2]
+    while True:
+        xmin, ymin, xmax, ymax = region
+        for box_info, over in zip(box_infos, _box_infos_overlapping(box_infos, region)):
+            if over:
+                pts = np.asarray(box_info['box']).reshape(-1, 2)
+                xmin, ymin = min(xmin, pts[:, 0].min()), min(ymin, pts[:, 1].min())
+                xmax, ymax = max(xmax, pts[:, 0].max()), max(ymax, pts[:, 1].max())
+        xmin, ymin = max(0, int(np.floor(xmin))), max(0, int(np.floor(ymin)))
+        xmax, ymax = min(width, int(np.ceil(xmax))), min(height, int(np.ceil(ymax)))
+        if (xmin, ymin, xmax, ymax) == tuple(region):
+            break
+        region = (xmin, ymin, xmax, ymax)
+
+    kept = [
+        info
+        for info, over in zip(box_infos, _box_infos_overlapping(box_infos, region))
+        if not over
+    ]
+    new_boxes = _offset_box_infos(detect_fn(frame[ymin:ymax, xmin:xmax]), xmin, ymin)
+    return sort_boxes(kept + new_boxes, key='box')
+
+
+def _clip_shifted_box_infos(
+    frame: np.ndarray,
+    box_infos: List[Dict[str, Any]],
+    detect_fn: Callable[[np.ndarray], List[Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    """Drop the shifted boxes which are moved out of `frame`, and detect again the ones cut by its borders."""
+    height, width = frame.shape[:2]
+    inside = _box_infos_overlapping(box_infos, (0, 0, width, height))
+    box_infos = [info for info, keep in zip(box_infos, inside) if keep]
+    if len(box_infos) == 0:
+        return box_infos
+    boxes = np.stack([np.asarray(info['box']).reshape(-1, 2) for info in box_infos])
+    mins, maxs = boxes.min(axis=1), boxes.max(axis=1)
+    regions = []
+    # the boxes cut by each border, which are re-detected at once
+    for cut in (mins[:, 0] < 0, mins[:, 1] < 0, maxs[:, 0] > width, maxs[:, 1] > height):
+        if cut.any():
+            regions.append(
+                (mins[cut, 0].min(), mins[cut, 1].min(), maxs[cut, 0].max(), maxs[cut, 1].max())
+            )
+    for region in regions:
+        box_infos = _redetect_region(frame, box_infos, region, detect_fn)
+    return box_infos
+
+
+def _revealed_regions(
+    shape: Tuple[int, ...], dx: int, dy: int, margin: int
+) -> List[Tuple[int, int, int, int]]:
+    """Regions of the current frame which are not covered by the reference frame after shifting it by (dx, dy)."""
+    height, width = shape[:2]
+    regions = []
+    if dx > 0:
+        regions.append((0, 0, dx + margin, height))
+    elif dx < 0:
+        regions.append((width + dx - margin, 0, width, height))
+    if dy > 0:
+        regions.append((0, 0, width, dy + margin))
+    elif dy < 0:
+        regions.append((0, height + dy - margin, width, height))
+    return [(max(0, x0), max(0, y0), min(width, x1), min(height, y1)) for x0, y0, x1, y1 in regions]
+
+
+def reuse_detections(
+    frames: Iterable[np.ndarray],
+    detect_fn: Callable[[np.ndarray], List[Dict[str, Any]]],
+    *,
+    estimator: Optional[FrameChangeEstimator] = None,
+    keyframe_interval: int = 50,
+) -> Iterator[Tuple[int, str, List[Dict[str, Any]]]]:
+    """
+    Run `detect_fn` on a stream of frames, and reuse the previous results when frames do not change much.
+
+    Each frame is compared with the reference frame, which is the latest non-static frame:
+      * static frames reuse its boxes;
+      * when the whole content only moves, its boxes are shifted by the estimated global motion,
+        and detection is run on the newly revealed border areas only; shifted boxes moved out of the frame
+        are dropped, and the ones cut by its borders are detected again;
+      * when only a region changes, detection is run on that region only, and boxes overlapping the region
+        are replaced by the new ones;
+      * otherwise, and at least every `keyframe_interval` frames, detection is run on the whole frame.
+
+    Args:
+        frames: [H, W, 3] uint8 frames. The reference frame is kept without copying it,
+            so a frame should not be modified after it is yielded
+        detect_fn: function detecting one frame (or a region of it); it returns a list of dicts,
+            each of which has a key 'box' with absolute (x, y) points of shape (4, 2).
+            Other keys are reused as they are
+        estimator: the `FrameChangeEstimator` to use; a default one is used if it is None
+        keyframe_interval: detection is run on the whole frame at least once every this many frames
+
+    Returns: an iterator of (frame index, status, list of box dicts),
+        status is one of 'keyframe', 'static', 'shifted' and 'region'
+    """
+    estimator = estimator or FrameChangeEstimator()
+    ref_frame, ref_sig, ref_boxes = None, None, []
+    since_keyframe = 0
+    for idx, frame in enumerate(frames):
+        sig = estimator.signature(frame)
+        status, info = 'changed', None
+        if ref_frame is not None and since_keyframe < keyframe_interval:
+            status, info = estimator.compare(ref_frame, frame, ref_sig, sig)
+
+        if status == 'static':
+            box_infos = ref_boxes
+        elif status == 'shifted':
+            box_infos = _offset_box_infos(ref_boxes, *info)
+            box_infos = _clip_shifted_box_infos(frame, box_infos, detect_fn)
+            for region in _revealed_regions(frame.shape, *info, estimator.region_margin):
+                box_infos = _redetect_region(frame, box_infos, region, detect_fn)
+        elif status == 'region':
+            box_infos = _redetect_region(frame, ref_boxes, info, detect_fn)
+        else:
+            status = 'keyframe'
+            box_infos = detect_fn(frame)
+            since_keyframe = 0
+        if status != 'static':
+            ref_frame, ref_sig, ref_boxes = frame, sig, box_infos
+        since_keyframe += 1
+        yield idx, status, box_infos
@@ -0,0 +1,140 @@
+# coding: utf-8
+# Copyright (C) 2021-2023, [Breezedeus](https://github.com/breezedeus).
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import time
+import itertools
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+from .evaluation import evaluate_image, summarize_evaluation
+
+__all__ = [
+    'SWEEP_PARAMS',
+    'parse_param_grid',
+    'replay_prob_map',
+    'sweep_image',
+    'summarize_sweep',
+]
+
+# post-processing parameters which can be swept, for the 'cnstd' and the 'ppocr' probability maps
+SWEEP_PARAMS = {
+    'cnstd': (
+        'box_score_thresh',
+        'min_box_size',
+        'bin_thresh',
+        'box_thresh',
+        'unclip_ratio',
+        'kernel_size',
+    ),
+    'ppocr': (
+        'box_score_thresh',
+        'min_box_size',
+        'bin_thresh',
+        'unclip_ratio',
+        'use_dilation',
+        'kernel_size',
+    ),
+}
+
+
+def parse_param_grid(spec: str) -> List[Dict[str, Any]]:
+    """
+    Parse a grid of parameters like 'bin_thresh=0.2,0.3;unclip_ratio=1.5,2.0' (values are parsed as JSON,
+    such as `true` or `null`), and return all its points, i.e. the cartesian product of the values.
+    """
+    names, values = [], []
+    for item in spec.split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, vals = item.partition('=')
+        if not vals:
+            raise ValueError('bad parameter grid %r: no value for %r' % (spec, name))
+        names.append(name.strip())
+        values.append([json.loads(v.strip()) for v in vals.split(',')])
+    return [dict(zip(names, point)) for point in itertools.product(*values)]
+
+
+def replay_prob_map(prob_map: Dict[str, Any], **params) -> Dict[str, Any]:
+    """
+    Post-process a probability map returned by `detect(..., return_prob_map=True)` again, with the `params`
+    replacing the parameters used at detection time. Only the post-processing runs, not the model.
+    """
+    unknown = set(params) - set(SWEEP_PARAMS[prob_map['detector']])
+    if unknown:
+        raise ValueError(
+            'unknown parameters %s for %s probability maps'
+            % (sorted(unknown), prob_map['detector'])
+        )
+    if prob_map['detector'] == 'ppocr':
+        from ..ppocr.pp_detector import PPDetector
+
+        return PPDetector.postprocess_prob_map(prob_map, **params)
+
+    from ..detector import Detector  # imports torch
+
+    return Detector.postprocess_prob_map(prob_map, **params)
+
+
+def sweep_image(
+    prob_map: Dict[str, Any],
+    gt_polys: np.ndarray,
+    ignore_tags: np.ndarray,
+    grid: Sequence[Dict[str, Any]],
+    iou_thresh: float = 0.5,
+) -> List[Dict[str, Any]]:
+    """
+    Replay the post-processing of one image for each point of the `grid`, and evaluate the boxes by
+    `evaluate_image()`. Each result also has the time of the replay in seconds as 'replay_time'.
+    """
+    results = []
+    for params in grid:
+        start_time = time.perf_counter()
+        out = replay_prob_map(prob_map, **params)
+        replay_time = time.perf_counter() - start_time
+        pred_polys = [info['box'] for info in out['detected_texts']]
+        res = evaluate_image(gt_polys, ignore_tags, pred_polys, iou_thresh)
+        res['replay_time'] = replay_time
+        results.append(res)
+    return results
+
+
+def summarize_sweep(
+    grid: Sequence[Dict[str, Any]], image_results: Sequence[List[Dict[str, Any]]]
+) -> List[Dict[str, Any]]:
+    """
+    Aggregate the results of `sweep_image()` on all the images into the metrics of each point of the grid.
+
+    Returns:
+        one dict per point, with its 'params', the metrics of `summarize_evaluation()`, and the mean replay time
+        per image 'replay_time', sorted by decreasing 'hmean'
+    """
+    points = []
+    for idx, params in enumerate(grid):
+        results = [res[idx] for res in image_results]
+        summary = summarize_evaluation(results)
+        summary.pop('latency')
+        summary['replay_time'] = (
+            float(np.mean([res['replay_time'] for res in results])) if results else 0.0
+        )
+        points.append(dict(params=params, **summary))
+    points.sort(key=lambda point: -point['hmean'])
+    return points
@@ -18,26 +18,35 @@
 # under the License.
 
 import os
+import sys
 import hashlib
-import requests
+import time
 from pathlib import Path
-from typing import Tuple, Union, List, Dict, Any
+from typing import Tuple, Union, List, Dict, Any, Iterator
 import logging
 import platform
 import zipfile
 from functools import cmp_to_key
 import shutil
 import tempfile
+from contextlib import contextmanager
 
 from tqdm import tqdm
 import cv2
 import numpy as np
-from PIL import Image, ImageOps
-import torch
-from huggingface_hub import hf_hub_download
+from PIL import Image, ImageOps, ImageSequence
 
 from ..consts import MODEL_VERSION, MODEL_CONFIGS, HF_ENDPOINT_LIST
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# a local directory or an HTTP server hosting the model zip files, e.g. `http://mirror.local/cnstd/1.2/`
+MODEL_MIRROR_ENV = 'CNSTD_MODEL_MIRROR'
+
 fmt = '[%(levelname)s %(asctime)s %(funcName)s:%(lineno)d] %(' 'message)s '
 logging.basicConfig(format=fmt)
 logging.captureWarnings(True)
@@ -71,7 +80,15 @@ def model_fn_prefix(backbone, epoch):
     return 'cnstd-v%s-%s-%04d.params' % (MODEL_VERSION, backbone, epoch)
 
 
+def is_tensor(obj) -> bool:
+    """`isinstance(obj, torch.Tensor)`, without importing torch: no tensor exists before torch is imported."""
+    torch = sys.modules.get('torch')
+    return torch is not None and isinstance(obj, torch.Tensor)
+
+
 def check_context(context):
+    import torch
+
     if isinstance(context, str):
         return any([ctx in context.lower() for ctx in ('gpu', 'cpu', 'cuda')])
     if isinstance(context, list):
@@ -105,6 +122,8 @@ def select_device(device) -> str:
     if device is not None:
         return device
 
+    import torch
+
     device = 'mps' if torch.backends.mps.is_available() else 'cpu'
     if torch.cuda.is_available():
         device = 'cuda'
@@ -129,6 +148,13 @@ def check_sha1(filename, sha1_hash):
     bool
         Whether the file content matches the expected hash.
     """
+    sha1_file = file_sha1(filename)
+    l = min(len(sha1_file), len(sha1_hash))
+    return sha1_file[0:l] == sha1_hash[0:l]
+
+
+def file_sha1(filename):
+    """Sha1 hash of the file content, in hexadecimal digits."""
     sha1 = hashlib.sha1()
     with open(filename, 'rb') as f:
         while True:
@@ -136,10 +162,98 @@ def check_sha1(filename, sha1_hash):
             if not data:
                 break
             sha1.update(data)
+    return sha1.hexdigest()
 
-    sha1_file = sha1.hexdigest()
-    l = min(len(sha1_file), len(sha1_hash))
-    return sha1.hexdigest()[0:l] == sha1_hash[0:l]
+
+@contextmanager
+def file_lock(lock_fp: Union[str, Path]):
+    """
+    Exclusive lock between processes (and threads), blocking until it is acquired.
+    The lock file is kept after releasing the lock.
+
+    Returns: whether it had to wait for another holder of the lock
+    """
+    lock_fp = os.path.abspath(os.path.expanduser(lock_fp))
+    os.makedirs(os.path.dirname(lock_fp), exist_ok=True)
+    with open(lock_fp, 'a+b') as f:
+        waited = False
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                waited = True
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    waited = True
+                    time.sleep(0.1)
+        try:
+            yield waited
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _http_download(url, fname, max_retries=3, chunk_size=1 << 20):
+    """
+    Download `url` to `fname`. An existing `fname` is taken as a partial download,
+    and is resumed with an HTTP range request; interrupted downloads are resumed up to `max_retries` times.
+    """
+    import requests
+
+    for attempt in range(max_retries + 1):
+        offset = os.path.getsize(fname) if os.path.exists(fname) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+        try:
+            with requests.get(url, stream=True, headers=headers, timeout=60) as r:
+                if r.status_code == 416:  # the partial file is complete already
+                    return
+                if r.status_code not in (200, 206):
+                    raise RuntimeError("Failed downloading url %s" % url)
+                if r.status_code == 200:  # no support of range requests
+                    offset = 0
+                total_length = r.headers.get('content-length')
+                total_length = int(total_length) + offset if total_length else None
+                with open(fname, 'ab' if offset > 0 else 'wb') as f, tqdm(
+                    total=total_length,
+                    initial=offset,
+                    unit='B',
+                    unit_scale=True,
+                    dynamic_ncols=True,
+                ) as pbar:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        pbar.update(len(chunk))
+            if total_length is not None and os.path.getsize(fname) < total_length:
+                raise requests.ConnectionError('connection closed before the end')
+            return
+        except requests.RequestException as e:
+            if attempt == max_retries:
+                raise
+            logger.warning('Downloading %s is interrupted: %s, resuming...' % (url, e))
+
+
+def _download_from_mirror(mirror, filename, fname):
+    if mirror.startswith(('http://', 'https://')):
+        mirror_url = mirror.rstrip('/') + '/' + filename
+        logger.info('Downloading %s from mirror %s...' % (filename, mirror_url))
+        _http_download(mirror_url, fname)
+        return
+    if mirror.startswith('file://'):
+        mirror = mirror[len('file://') :]
+    src_fp = os.path.join(os.path.expanduser(mirror), filename)
+    if not os.path.isfile(src_fp):
+        raise FileNotFoundError('can not find %s in mirror %s' % (filename, mirror))
+    logger.info('Copying %s from mirror %s...' % (filename, mirror))
+    shutil.copyfile(src_fp, fname)
 
 
 def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=None):
@@ -147,20 +261,26 @@ def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=No
     Parameters
     ----------
     url : dict, url for downloading the model, with keys:
-            repo_id, subfolder, filename
+            repo_id, subfolder, filename, and optional sha1
     path : str, optional
         Destination path to store downloaded file. By default, stores to the
         current directory with same name as in url.
-    download_source: which OSS source will be used, 'CN' or 'HF'
+    download_source: which OSS source will be used, 'CN' or 'HF';
+        ignored when the environment variable `CNSTD_MODEL_MIRROR` is set, which is
+        a local directory (or `file://` URL) or an HTTP server hosting the files
     overwrite : bool, optional
         Whether to overwrite destination file if already exists.
     sha1_hash : str, optional
-        Expected sha1 hash in hexadecimal digits. Will ignore existing file when hash is specified
+        Expected sha1 hash in hexadecimal digits, default to `url['sha1']`. Will ignore existing file when hash is specified
         but doesn't match.
     Returns
     -------
     str
         The file path of the downloaded file.
+
+    The file is downloaded to `<path>.part`, which is resumed by later calls if the download is interrupted,
+    and renamed to `path` only after its hash is verified. Concurrent calls (from several processes) for the
+    same path are serialized by a file lock, so the file is downloaded only once.
     """
     if path is None:
         fname = url['filename']
@@ -170,39 +290,34 @@ def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=No
             fname = os.path.join(path, url['filename'])
         else:
             fname = path
-
-    if (
-        overwrite
-        or not os.path.exists(fname)
-        or (sha1_hash and not check_sha1(fname, sha1_hash))
-    ):
-        dirname = os.path.dirname(os.path.abspath(os.path.expanduser(fname)))
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-
-        if download_source == 'CN' and 'cn_oss' in url:
+    if sha1_hash is None:
+        sha1_hash = url.get('sha1')
+
+    def _is_valid():
+        return os.path.exists(fname) and not (
+            sha1_hash and not check_sha1(fname, sha1_hash)
+        )
+
+    if not overwrite and _is_valid():
+        return fname
+
+    dirname = os.path.dirname(os.path.abspath(os.path.expanduser(fname)))
+    os.makedirs(dirname, exist_ok=True)
+    with file_lock(fname + '.lock') as waited:
+        if waited and _is_valid():  # downloaded by another process meanwhile
+            return fname
+
+        part_fname = fname + '.part'
+        mirror = os.getenv(MODEL_MIRROR_ENV)
+        if mirror:
+            _download_from_mirror(mirror, url['filename'], part_fname)
+        elif download_source == 'CN' and 'cn_oss' in url:
             oss_url = url['cn_oss'] + url['filename']
             logger.info('Downloading %s from %s...' % (fname, oss_url))
-            r = requests.get(oss_url, stream=True)
-            if r.status_code != 200:
-                raise RuntimeError("Failed downloading url %s" % oss_url)
-            total_length = r.headers.get('content-length')
-            with open(fname, 'wb') as f:
-                if total_length is None:  # no content length header
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:  # filter out keep-alive new chunks
-                            f.write(chunk)
-                else:
-                    total_length = int(total_length)
-                    for chunk in tqdm(
-                        r.iter_content(chunk_size=1024),
-                        total=int(total_length / 1024.0 + 0.5),
-                        unit='KB',
-                        unit_scale=False,
-                        dynamic_ncols=True,
-                    ):
-                        f.write(chunk)
+            _http_download(oss_url, part_fname)
         else:
+            from huggingface_hub import hf_hub_download
+
             HF_TOKEN = os.environ.get('HF_TOKEN')
             for hf_endpoint in HF_ENDPOINT_LIST:
                 try:
@@ -220,21 +335,25 @@ def download(url, path=None, download_source='CN', overwrite=False, sha1_hash=No
                             token=HF_TOKEN,
                             endpoint=hf_endpoint,
                         )
-                        shutil.copy2(local_path, fname)
+                        shutil.copy2(local_path, part_fname)
                         break
                 except:
                     logger.warning(
                         'Failed to download %s from HF Repo %s/%s.'
                         % (fname, hf_endpoint, url["repo_id"])
                     )
+            if not os.path.exists(part_fname):
+                raise RuntimeError('Failed downloading %s' % url['filename'])
 
-        if sha1_hash and not check_sha1(fname, sha1_hash):
+        if sha1_hash and not check_sha1(part_fname, sha1_hash):
+            os.remove(part_fname)
             raise UserWarning(
                 'File {} is downloaded but the content hash does not match. '
                 'The repo may be outdated or download may be incomplete. '
                 'If the "repo_url" is overridden, consider switching to '
                 'the default repo.'.format(fname)
             )
+        os.replace(part_fname, fname)
     return fname
 
 
@@ -242,16 +361,39 @@ class ModelDownloadingError(Exception):
     pass
 
 
+def _extract_zip(zip_file_path, target_dir):
+    """
+    Extract the zip file into a temporary directory first, then move the files to `target_dir` one by one,
+    so no partially written file ever shows up in `target_dir`.
+    """
+    with zipfile.ZipFile(zip_file_path) as zf:
+        bad_file = zf.testzip()
+        if bad_file is not None:
+            raise zipfile.BadZipFile('bad CRC of %s in %s' % (bad_file, zip_file_path))
+        tmp_dir = tempfile.mkdtemp(dir=target_dir, prefix='.unzip-')
+        try:
+            zf.extractall(tmp_dir)
+            for root, _, files in os.walk(tmp_dir):
+                out_dir = os.path.join(target_dir, os.path.relpath(root, tmp_dir))
+                os.makedirs(out_dir, exist_ok=True)
+                for fn in files:
+                    os.replace(os.path.join(root, fn), os.path.join(out_dir, fn))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
 def get_model_file(url, model_dir, download_source='CN'):
     r"""Return location for the downloaded models on local file system.
 
     This function will download from online model zoo when model cannot be found or has mismatch.
     The root directory will be created if it doesn't exist.
+    Concurrent calls (from several processes) for the same model are serialized by a file lock,
+    and only the first one downloads and extracts the model.
 
     Parameters
     ----------
     url : dict, url for downloading the model, with keys:
-            repo_id, subfolder, filename
+            repo_id, subfolder, filename, and optional sha1
     model_dir : str, default $CNSTD_HOME
         Location for keeping the model parameters.
     download_source : which OSS source will be used, 'CN' or 'HF'
@@ -266,23 +408,31 @@ def get_model_file(url, model_dir, download_source='CN'):
     os.makedirs(par_dir, exist_ok=True)
 
     zip_file_path = os.path.join(par_dir, url['filename'])
-    if not os.path.exists(zip_file_path):
-        try:
-            download(
-                url, path=zip_file_path, download_source=download_source, overwrite=True
-            )
-        except Exception as e:
-            logger.error(e)
-            message = f'Failed to download model: {url["filename"]}.'
-            message += (
-                '\n\tPlease open your VPN and try again. \n\t'
-                'If this error persists, please follow the instruction at '
-                '[CnSTD/CnOCR Doc](https://www.breezedeus.com/cnocr) to manually download the model files.'
-            )
-            raise ModelDownloadingError(message)
-    with zipfile.ZipFile(zip_file_path) as zf:
-        zf.extractall(par_dir)
-    os.remove(zip_file_path)
+    with file_lock(model_dir + '.lock') as waited:
+        if waited and os.path.isdir(model_dir) and os.listdir(model_dir):
+            # downloaded and extracted by another process meanwhile
+            return model_dir
+        for attempt in range(2):
+            try:
+                download(url, path=zip_file_path, download_source=download_source)
+                _extract_zip(zip_file_path, par_dir)
+                break
+            except zipfile.BadZipFile as e:
+                # e.g. a truncated file left by an old version, download it again
+                logger.warning('%s, removing it' % e)
+                os.remove(zip_file_path)
+                if attempt > 0:
+                    raise ModelDownloadingError(str(e))
+            except Exception as e:
+                logger.error(e)
+                message = f'Failed to download model: {url["filename"]}.'
+                message += (
+                    '\n\tPlease open your VPN and try again. \n\t'
+                    'If this error persists, please follow the instruction at '
+                    '[CnSTD/CnOCR Doc](https://www.breezedeus.com/cnocr) to manually download the model files.'
+                )
+                raise ModelDownloadingError(message)
+        os.remove(zip_file_path)
 
     return model_dir
 
@@ -340,6 +490,29 @@ def read_img(img_fp) -> Image.Image:
     return img
 
 
+def iter_img_pages(
+    img_fps: Union[str, Path, List[Union[str, Path]]]
+) -> Iterator[Tuple[str, int, Image.Image]]:
+    """
+    Read all the pages (frames) of multi-page images, such as TIFF or GIF files, one page after another.
+    Each page is only decoded when it is requested, so the pages are never held in memory together.
+
+    Args:
+        img_fps: one image file path, or a list of image file paths (an image sequence)
+
+    Returns: an iterator of (image file path, page index in this file, RGB-style Image.Image)
+
+    """
+    if isinstance(img_fps, (str, Path)):
+        img_fps = [img_fps]
+    for img_fp in img_fps:
+        if not os.path.isfile(img_fp):
+            raise FileNotFoundError(img_fp)
+        with Image.open(img_fp) as img:
+            for page_idx, page in enumerate(ImageSequence.Iterator(img)):
+                yield str(img_fp), page_idx, ImageOps.exif_transpose(page).convert('RGB')
+
+
 def pil_to_numpy(img: Image.Image) -> np.ndarray:
     """
 
@@ -352,6 +525,69 @@ def pil_to_numpy(img: Image.Image) -> np.ndarray:
     return np.asarray(img.convert('RGB'), dtype='float32').transpose((2, 0, 1))
 
 
+COLOR_ORDERS = ('rgb', 'bgr')
+
+
+def check_color_order(color_order: str) -> str:
+    color_order = color_order.lower()
+    if color_order not in COLOR_ORDERS:
+        raise ValueError(
+            'color_order should be one of %s, but got %s' % (COLOR_ORDERS, color_order)
+        )
+    return color_order
+
+
+def split_image_batch(img_list) -> Tuple[List[Any], bool]:
+    """
+    Turn the input of `detect()` into a list of images, without copying any pixels.
+
+    Args:
+        img_list: one image (a file path, an Image.Image, or a [H, W, 3] np.ndarray / torch.Tensor),
+            a list of images, or a [N, H, W, 3] np.ndarray / torch.Tensor batch.
+            Tensors on CPU share their memory with the resulting np.ndarray views.
+
+    Returns: (list of images, whether `img_list` is one single image)
+
+    """
+    if is_tensor(img_list):
+        img_list = img_list.detach().cpu().numpy()
+    if isinstance(img_list, np.ndarray):
+        if img_list.ndim == 4:
+            return list(img_list), False
+        return [img_list], True
+    if isinstance(img_list, (str, Path, Image.Image)):
+        return [img_list], True
+    if isinstance(img_list, (list, tuple)):
+        return (
+            [
+                img.detach().cpu().numpy() if is_tensor(img) else img
+                for img in img_list
+            ],
+            False,
+        )
+    raise TypeError('type %s is not supported now' % str(type(img_list)))
+
+
+def to_uint8_hwc(img: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    """
+    Get a contiguous [H, W, 3] uint8 array of `img`.
+    A contiguous uint8 np.ndarray is returned as it is, without any copy.
+
+    Args:
+        img: an Image.Image, or a np.ndarray with shape [H, W, 3] and scale [0, 255]
+
+    Returns: np.ndarray, with shape: [H, W, 3], dtype: uint8; the color order is unchanged
+
+    """
+    if isinstance(img, Image.Image):
+        return np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+    if img.ndim != 3 or img.shape[2] != 3:
+        raise ValueError('unsupported image input is found')
+    if img.dtype != np.uint8:
+        img = np.clip(img, 0, 255).astype(np.uint8)
+    return np.ascontiguousarray(img)
+
+
 def transform_rbbox_to_bbox(x, y, w, h, alpha):
     points = cv2.boxPoints(((x, y), (w, h), alpha))
     return np.array(sort_box_points(points))
@@ -423,20 +659,35 @@ def sort_boxes(
 
 
 def dedup_boxes(one_out, threshold):
-    def _to_iou_box(ori):
-        return torch.tensor([ori[0][0], ori[0][1], ori[2][0], ori[2][1]]).unsqueeze(0)
+    """
+    Drop the boxes mostly covered by another box; of two boxes covering each other,
+    the one with the lower coverage ratio is kept.
+    The overlaps of all the pairs of boxes are computed at once.
+    """
+    if len(one_out) < 2:
+        return list(one_out)
+    boxes = np.array(
+        [
+            [info['box'][0][0], info['box'][0][1], info['box'][2][0], info['box'][2][1]]
+            for info in one_out
+        ],
+        dtype=np.float32,
+    )
+    lt = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    rb = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    # overlaps[i, j]: intersection / area(box j)
+    overlaps = (inter / (areas[None, :] + 1e-6)).tolist()
 
     keep = [True] * len(one_out)
-    for idx, info in enumerate(one_out):
-        box = _to_iou_box(info['box'])
+    for idx in range(len(one_out)):
         if not keep[idx]:
             continue
         for l in range(idx + 1, len(one_out)):
             if not keep[l]:
                 continue
-            box2 = _to_iou_box(one_out[l]['box'])
-            v1 = float(box_partial_overlap(box, box2).squeeze())
-            v2 = float(box_partial_overlap(box2, box).squeeze())
+            v1, v2 = overlaps[idx][l], overlaps[l][idx]
             if v1 >= v2:
                 if v1 >= threshold:
                     keep[l] = False
@@ -546,15 +797,45 @@ def get_resized_shape(
     return calibrate(new_hw[0]), calibrate(new_hw[1])
 
 
-def load_model_params(model, param_fp, device='cpu'):
-    checkpoint = torch.load(param_fp, map_location=device)
+def load_checkpoint(fp, map_location='cpu', mmap=False):
+    """
+    `torch.load()`, optionally with the tensors memory-mapped from the file when possible, so that the processes
+    loading the same file share its pages in the page cache instead of each holding a private copy.
+    Files in the legacy (non-zip) format, or torch versions without `mmap`, fall back to a normal load.
+    A memory-mapped file must be replaced (`os.replace()`), not overwritten in place, while it is in use,
+    so `mmap` is only used by the inference entry points, not for training or resaving.
+    """
+    import torch
+
+    if mmap:
+        try:
+            return torch.load(fp, map_location=map_location, mmap=True)
+        except (RuntimeError, TypeError) as e:
+            logger.debug('failed to load %s with mmap: %s' % (fp, e))
+    return torch.load(fp, map_location=map_location)
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Load `state_dict` into `model`, using its tensors as the parameters directly (no copy),
+    so memory-mapped tensors from `load_checkpoint()` stay shared.
+    """
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:  # torch < 2.1
+        model.load_state_dict(state_dict)
+    return model
+
+
+def load_model_params(model, param_fp, device='cpu', mmap=False):
+    checkpoint = load_checkpoint(param_fp, map_location=device, mmap=mmap)
     state_dict = checkpoint['state_dict']
     if all([param_name.startswith('model.') for param_name in state_dict.keys()]):
         # 表示导入的模型是通过 PlTrainer 训练出的 WrapperLightningModule，对其进行转化
         state_dict = {}
         for k, v in checkpoint['state_dict'].items():
             state_dict[k.split('.', maxsplit=1)[1]] = v
-    model.load_state_dict(state_dict)
+    assign_state_dict(model, state_dict)
     return model
 
 
@@ -603,7 +884,8 @@ def plot_for_debugging(rotated_img, one_out, box_score_thresh, prefix_fp):
             break
         axi.imshow(crops[i])
     crop_fp = '%s-crops.png' % prefix_fp
-    plt.savefig(crop_fp)
+    fig.savefig(crop_fp)
+    plt.close(fig)
     logger.info('cropped results are save to file %s' % crop_fp)
 
     for info in one_out:
@@ -627,6 +909,8 @@ def box_partial_overlap(box1, cond_box):
     # area1 = box_area(box1.T)
     area2 = box_area(cond_box.T)
 
+    import torch
+
     # inter(N,M) = (rb(N,M,2) - lt(N,M,2)).clamp(0).prod(2)
     inter = (torch.min(box1[:, None, 2:], cond_box[:, 2:]) - torch.max(box1[:, None, :2], cond_box[:, :2])).clamp(0).prod(2)
     return inter / (area2[:, None] + 1e-6)  # iou = inter / area2
@@ -634,7 +918,7 @@ def box_partial_overlap(box1, cond_box):
 
 def xyxy2xywh(x):
     # Convert nx4 boxes from [x1, y1, x2, y2] to [x, y, w, h] where xy1=top-left, xy2=bottom-right
-    y = x.clone() if isinstance(x, torch.Tensor) else np.copy(x)
+    y = x.clone() if is_tensor(x) else np.copy(x)
     y[:, 0] = (x[:, 0] + x[:, 2]) / 2  # x center
     y[:, 1] = (x[:, 1] + x[:, 3]) / 2  # y center
     y[:, 2] = x[:, 2] - x[:, 0]  # width
@@ -644,7 +928,7 @@ def xyxy2xywh(x):
 
 def xywh2xyxy(x):
     # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
-    y = x.clone() if isinstance(x, torch.Tensor) else np.copy(x)
+    y = x.clone() if is_tensor(x) else np.copy(x)
     y[:, 0] = x[:, 0] - x[:, 2] / 2  # top left x
     y[:, 1] = x[:, 1] - x[:, 3] / 2  # top left y
     y[:, 2] = x[:, 0] + x[:, 2] / 2  # bottom right x
@@ -654,7 +938,7 @@ def xywh2xyxy(x):
 
 def xywhn2xyxy(x, w=640, h=640, padw=0, padh=0):
     # Convert nx4 boxes from [x, y, w, h] normalized to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
-    y = x.clone() if isinstance(x, torch.Tensor) else np.copy(x)
+    y = x.clone() if is_tensor(x) else np.copy(x)
     y[:, 0] = w * (x[:, 0] - x[:, 2] / 2) + padw  # top left x
     y[:, 1] = h * (x[:, 1] - x[:, 3] / 2) + padh  # top left y
     y[:, 2] = w * (x[:, 0] + x[:, 2] / 2) + padw  # bottom right x
@@ -664,15 +948,19 @@ def xywhn2xyxy(x, w=640, h=640, padw=0, padh=0):
 
 def xyn2xy(x, w=640, h=640, padw=0, padh=0):
     # Convert normalized segments into pixel segments, shape (n,2)
-    y = x.clone() if isinstance(x, torch.Tensor) else np.copy(x)
+    y = x.clone() if is_tensor(x) else np.copy(x)
     y[:, 0] = w * x[:, 0] + padw  # top left x
     y[:, 1] = h * x[:, 1] + padh  # top left y
     return y
 
 
-def xyxy24p(x, ret_type=torch.Tensor):
+def xyxy24p(x, ret_type='tensor'):
     xmin, ymin, xmax, ymax = [float(_x) for _x in x]
     out = [xmin, ymin, xmax, ymin, xmax, ymax, xmin, ymax]
+    if ret_type == 'tensor':
+        import torch
+
+        ret_type = torch.Tensor
     if ret_type is not None:
         return ret_type(out).reshape((4, 2))
     return out
@@ -18,18 +18,118 @@
 # under the License.
 # YOLO Detector based on Ultralytics.
 
+import os
+import shutil
+import tempfile
 from pathlib import Path
-from typing import Union, Optional, Any, List, Dict, Tuple
+from typing import Union, Optional, Any, List, Dict, Tuple, Iterable, Iterator
 import logging
 
 from PIL import Image
 import numpy as np
+import torch
 from ultralytics import YOLO
 
-from .utils import sort_boxes, dedup_boxes, xyxy24p, select_device, expand_box_by_margin
+from .utils import sort_boxes, dedup_boxes, select_device, file_sha1
 
 logger = logging.getLogger(__name__)
 
+# runtime -> (Ultralytics export format, suffix of the exported file or directory)
+RUNTIMES = {
+    'torch': (None, None),
+    'onnx': ('onnx', '.onnx'),
+    'openvino': ('openvino', '_openvino_model'),
+}
+
+
+def _static_hw(shape: Union[int, Tuple[int, int]]) -> Tuple[int, int]:
+    if isinstance(shape, int):
+        return shape, shape
+    return int(shape[0]), int(shape[1])
+
+
+def runtime_artifact_path(
+    model_path: Union[str, Path], runtime: str, static_resized_shape: Tuple[int, int]
+) -> Path:
+    """
+    Path of the cached artifact exported from the PyTorch weights `model_path`, next to the weights,
+    keyed by the hash of the weights and the static input shape,
+    e.g. `yolov8n-<sha1>-768x768.onnx` or `yolov8n-<sha1>-768x768_openvino_model/`.
+    """
+    model_path = Path(model_path)
+    height, width = _static_hw(static_resized_shape)
+    key = '%s-%dx%d' % (file_sha1(model_path)[:16], height, width)
+    return model_path.with_name('%s-%s%s' % (model_path.stem, key, RUNTIMES[runtime][1]))
+
+
+def check_runtime_parity(
+    model_path: Union[str, Path],
+    artifact_path: Union[str, Path],
+    static_resized_shape: Tuple[int, int],
+    rtol: float = 1e-3,
+    atol: float = 1e-2,
+) -> bool:
+    """Compare the raw outputs of the exported artifact with the ones of the PyTorch weights."""
+    from ultralytics.nn.autobackend import AutoBackend
+
+    def _first(out):
+        return out[0] if isinstance(out, (list, tuple)) else out
+
+    height, width = _static_hw(static_resized_shape)
+    generator = torch.Generator().manual_seed(0)
+    x = torch.rand(1, 3, height, width, generator=generator)
+    device = torch.device('cpu')
+    with torch.inference_mode():
+        expected = _first(AutoBackend(str(model_path), device=device, verbose=False)(x))
+        out = _first(AutoBackend(str(artifact_path), device=device, verbose=False)(x))
+    out = torch.as_tensor(np.asarray(out)) if not isinstance(out, torch.Tensor) else out
+    return out.shape == expected.shape and torch.allclose(
+        out.float(), expected.float(), rtol=rtol, atol=atol
+    )
+
+
+def prepare_runtime_model(
+    model_path: Union[str, Path], runtime: str, static_resized_shape: Tuple[int, int]
+) -> Optional[Path]:
+    """
+    Get the artifact of `runtime` for the PyTorch weights `model_path`.
+    On a cache miss the weights are exported with Ultralytics, checked against the PyTorch outputs,
+    and cached next to the weights. Returns None when the export fails or mismatches.
+    """
+    artifact_path = runtime_artifact_path(model_path, runtime, static_resized_shape)
+    if artifact_path.exists():
+        return artifact_path
+
+    model_path = Path(model_path)
+    export_format = RUNTIMES[runtime][0]
+    # export a copy in a temporary directory, so no file of the user is overwritten
+    tmp_dir = tempfile.mkdtemp(dir=model_path.parent, prefix='.export-')
+    try:
+        tmp_model_path = Path(tmp_dir) / model_path.name
+        shutil.copyfile(model_path, tmp_model_path)
+        exported = YOLO(str(tmp_model_path), task='detect').export(
+            format=export_format,
+            imgsz=list(_static_hw(static_resized_shape)),
+            dynamic=False,
+            device='cpu',
+            verbose=False,
+        )
+        if not check_runtime_parity(tmp_model_path, exported, static_resized_shape):
+            logger.warning(
+                'outputs of the %s model mismatch the PyTorch ones, use PyTorch instead'
+                % runtime
+            )
+            return None
+        if not artifact_path.exists():
+            os.replace(exported, artifact_path)
+    except Exception as e:
+        logger.warning('failed to export %s to %s: %s' % (model_path, runtime, e))
+        return None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    logger.info('%s model is cached in %s' % (runtime, artifact_path))
+    return artifact_path
+
 
 class YoloDetector(object):
     def __init__(
@@ -38,6 +138,7 @@ class YoloDetector(object):
         model_path: Optional[str] = None,
         device: Optional[str] = None,
         static_resized_shape: Optional[Union[int, Tuple[int, int]]] = None,
+        runtime: str = 'torch',
         **kwargs,
     ):
         """
@@ -49,10 +150,35 @@ class YoloDetector(object):
                 When it is not None, the input image will be resized to this shape before detection,
                 ignoring the input parameter `resized_shape` if .detect() is called.
                 Some format of models may require a fixed input size, such as CoreML.
+            runtime (str): 'torch', 'onnx' or 'openvino', default is 'torch'.
+                For 'onnx' and 'openvino', PyTorch weights (.pt) are exported to the format at
+                `static_resized_shape` (768 if it is None) on first use, checked against the PyTorch outputs,
+                and cached next to the weights, keyed by the weights hash and the shape; later starts load
+                the cached artifact directly. Falls back to 'torch' if the export fails or mismatches.
+                Models which are not PyTorch weights are loaded as they are.
             **kwargs (): other parameters.
         """
+        if runtime not in RUNTIMES:
+            raise ValueError(
+                'runtime should be one of %s, but got %s' % (list(RUNTIMES), runtime)
+            )
         self.device = select_device(device)
         self.static_resized_shape = static_resized_shape
+        self.runtime = 'torch'
+        if (
+            runtime != 'torch'
+            and model_path is not None
+            and Path(model_path).suffix == '.pt'
+        ):
+            if static_resized_shape is None:
+                static_resized_shape = 768
+            artifact_path = prepare_runtime_model(
+                model_path, runtime, _static_hw(static_resized_shape)
+            )
+            if artifact_path is not None:
+                model_path = str(artifact_path)
+                self.runtime = runtime
+                self.static_resized_shape = _static_hw(static_resized_shape)
         self.model = YOLO(model_path, task='detect')
 
     def __call__(self, *args, **kwargs):
@@ -67,20 +193,29 @@ class YoloDetector(object):
             Image.Image,
             np.ndarray,
             List[Union[str, Path, Image.Image, np.ndarray]],
+            Iterable[Union[str, Path, Image.Image, np.ndarray]],
         ],
         resized_shape: int = 768,
         box_margin: int = 0,
         conf: float = 0.25,
+        batch_size: int = 16,
+        stream: bool = False,
         **kwargs,
-    ) -> Union[List[Dict[str, Any]], List[List[Dict[str, Any]]]]:
+    ) -> Union[
+        List[Dict[str, Any]], List[List[Dict[str, Any]]], Iterator[List[Dict[str, Any]]]
+    ]:
         """
         对指定图片（列表）进行目标检测。
 
         Args:
-            img_list (str or list): 待识别图片或图片列表；如果是 `np.ndarray`，则应该是shape为 `[H, W, 3]` 的 RGB 格式数组
+            img_list (str or list): 待识别图片或图片列表；如果是 `np.ndarray`，则应该是shape为 `[H, W, 3]` 的 RGB 格式数组；
+                `stream==True` 时也可以是任意可迭代的图片序列（如生成器）
             resized_shape (int or tuple): (H, W); 把图片resize到此大小再做分析；默认值为 `700`
             box_margin (int): 对识别出的内容框往外扩展的像素大小；默认值为 `2`
             conf (float): 分数阈值；默认值为 `0.25`
+            batch_size (int): 每批同时检测的图片数；每批的结果转换完后即被释放，所以内存占用只与此值有关，
+                与图片总数无关；默认值为 `16`
+            stream (bool): 是否返回迭代器，逐张图片地返回结果；默认值为 `False`
             **kwargs (): 其他预测使用的参数，以及以下值
                 - dedup_thrsh: 去重时使用的阈值；默认值为 `0.1`
 
@@ -88,41 +223,92 @@ class YoloDetector(object):
             * type: 版面元素对应的类型；可选值来自：`self.categories` ;
             * box: 版面元素对应的矩形框；np.ndarray, shape: (4, 2)，对应 box 4个点的坐标值 (x, y) ;
             * score: 得分，越高表示越可信 。
+            `stream==True` 时返回迭代器，每个元素为一张图片的结果。
 
         """
         dedup_thrsh = kwargs.pop('dedup_thrsh') if 'dedup_thrsh' in kwargs else 0.1
-        single = not isinstance(img_list, (list, tuple))
-        # Ultralytics 需要的 ndarray 是 HWC，BGR 格式
-        if isinstance(img_list, np.ndarray):
-            img_list = img_list[:, :, ::-1]
-        elif isinstance(img_list, list):
-            img_list = [
-                img[:, :, ::-1] if isinstance(img, np.ndarray) else img
-                for img in img_list
-            ]
-
+        single = isinstance(img_list, (str, Path, Image.Image, np.ndarray))
         if self.static_resized_shape is not None:
             resized_shape = self.static_resized_shape
-        batch_results = self.model.predict(
-            img_list, imgsz=resized_shape, conf=conf, device=self.device, **kwargs
-        )
-        outs = []
-        for res in batch_results:
-            boxes = res.boxes.xyxy.cpu().numpy().tolist()
-            scores = res.boxes.conf.cpu().numpy().tolist()
-            labels = res.boxes.cls.cpu().int().numpy().tolist()
-            categories = res.names
-            height, width = res.orig_shape
-            one_out = []
-            for box, score, label in zip(boxes, scores, labels):
-                box = expand_box_by_margin(box, box_margin, (height, width))
-                box = xyxy24p(box, ret_type=np.array)
-                one_out.append({'box': box, 'score': score, 'type': categories[label]})
-
-            one_out = sort_boxes(one_out, key='box')
-            one_out = dedup_boxes(one_out, threshold=dedup_thrsh)
-            outs.append(one_out)
 
+        outs = self._detect_iter(
+            img_list,
+            batch_size,
+            box_margin=box_margin,
+            dedup_thrsh=dedup_thrsh,
+            imgsz=resized_shape,
+            conf=conf,
+            **kwargs,
+        )
+        if stream:
+            return outs
+        outs = list(outs)
         if single and len(outs) == 1:
             return outs[0]
         return outs
+
+    def _detect_iter(
+        self,
+        img_list: Iterable[Union[str, Path, Image.Image, np.ndarray]],
+        batch_size: int,
+        *,
+        box_margin: int,
+        dedup_thrsh: float,
+        **predict_kwargs,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        predict_kwargs.setdefault('batch', max(1, batch_size))
+        batch_size = predict_kwargs['batch']
+        if isinstance(img_list, (str, Path)):
+            # a file, a directory or a video; Ultralytics loads it by itself
+            yield from self._detect_batch(
+                img_list, box_margin, dedup_thrsh, **predict_kwargs
+            )
+            return
+        if isinstance(img_list, (Image.Image, np.ndarray)):
+            img_list = [img_list]
+
+        batch = []
+        for img in img_list:
+            # Ultralytics 需要的 ndarray 是 HWC，BGR 格式
+            batch.append(img[:, :, ::-1] if isinstance(img, np.ndarray) else img)
+            if len(batch) == batch_size:
+                yield from self._detect_batch(
+                    batch, box_margin, dedup_thrsh, **predict_kwargs
+                )
+                batch = []
+        if len(batch) > 0:
+            yield from self._detect_batch(batch, box_margin, dedup_thrsh, **predict_kwargs)
+
+    def _detect_batch(
+        self, source, box_margin, dedup_thrsh, **predict_kwargs
+    ) -> Iterator[List[Dict[str, Any]]]:
+        results = self.model.predict(
+            source, device=self.device, stream=True, **predict_kwargs
+        )
+        if isinstance(source, list):
+            # the predictor is locked until its generator is exhausted,
+            # so a batch is finished before its outputs are yielded
+            outs = [self._postprocess(res, box_margin, dedup_thrsh) for res in results]
+            yield from outs
+        else:
+            for res in results:
+                yield self._postprocess(res, box_margin, dedup_thrsh)
+
+    @staticmethod
+    def _postprocess(res, box_margin: int, dedup_thrsh: float) -> List[Dict[str, Any]]:
+        """Build the outputs of one image from its `Results`, with one transfer of its boxes."""
+        height, width = res.orig_shape
+        data = res.boxes.data.cpu().numpy().astype(np.float64)
+        xyxy = data[:, :4]
+        xyxy[:, :2] = np.maximum(xyxy[:, :2] - box_margin, 0)
+        xyxy[:, 2:] = np.minimum(xyxy[:, 2:] + box_margin, (width, height))
+        quads = xyxy[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+        scores = data[:, -2].tolist()
+        categories = res.names
+        one_out = [
+            {'box': box, 'score': score, 'type': categories[label]}
+            for box, score, label in zip(quads, scores, data[:, -1].astype(int).tolist())
+        ]
+
+        one_out = sort_boxes(one_out, key='box')
+        return dedup_boxes(one_out, threshold=dedup_thrsh)
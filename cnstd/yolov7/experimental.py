@@ -260,6 +260,36 @@ class End2End(nn.Module):
         return x
 
 
+class ORTEnd2End(nn.Module):
+    '''export onnx model with ONNX-Runtime NMS operation, whose thresholds are inputs of the graph.
+
+    Scores and classes are computed as `general.non_max_suppression()` does (best class only, offset by class),
+    the output is (n, 7): [image index, x1, y1, x2, y2, score, class].
+    '''
+    def __init__(self, model, max_det=300, max_wh=4096):
+        super().__init__()
+        self.model = model
+        self.model.model[-1].end2end = True
+        self.n_classes = self.model.model[-1].nc
+        self.max_det = torch.tensor([max_det])
+        self.max_wh = max_wh
+        self.convert_matrix = torch.tensor([[1, 0, 1, 0], [0, 1, 0, 1], [-0.5, 0, 0.5, 0], [0, -0.5, 0, 0.5]],
+                                           dtype=torch.float32)
+
+    def forward(self, x, conf_threshold, iou_threshold):
+        x = self.model(x)
+        boxes = x[:, :, :4] @ self.convert_matrix.to(x.device)
+        conf = x[:, :, 4:5]
+        scores = conf if self.n_classes == 1 else x[:, :, 5:] * conf
+        max_score, category_id = scores.max(2, keepdim=True)
+        nmsbox = boxes + category_id.float() * self.max_wh
+        selected_indices = ORT_NMS.apply(nmsbox, max_score.transpose(1, 2).contiguous(),
+                                         self.max_det.to(x.device), iou_threshold, conf_threshold)
+        X, Y = selected_indices[:, 0], selected_indices[:, 2]
+        return torch.cat([X.unsqueeze(1).float(), boxes[X, Y, :], max_score[X, Y, :],
+                          category_id[X, Y, :].float()], 1)
+
+
 
 
 
@@ -32,7 +32,6 @@ from pathlib import Path
 
 import cv2
 import numpy as np
-import pandas as pd
 import torch
 import torchvision
 
@@ -44,7 +43,6 @@ logger = logging.getLogger(__name__)
 # Settings
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
-pd.options.display.max_columns = 10
 cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with PyTorch DataLoader)
 os.environ['NUMEXPR_MAX_THREADS'] = str(min(os.cpu_count(), 8))  # NumExpr max threads
 
@@ -681,6 +679,93 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def _segment_ranks(seg_ids):
+    """Rank of every element within its segment; `seg_ids` must be sorted."""
+    counts = torch.bincount(seg_ids)
+    starts = torch.cumsum(counts, 0) - counts
+    return torch.arange(seg_ids.shape[0], device=seg_ids.device) - starts[seg_ids]
+
+
+def _sort_by_segment(seg_ids, scores):
+    """Order sorting by `seg_ids`, and by descending `scores` within every segment."""
+    order = scores.argsort(descending=True)
+    return order[torch.sort(seg_ids[order], stable=True)[1]]
+
+
+def batched_non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, max_det=300, max_nms=30000, max_wh=4096,
+                                max_batched_nms=500):
+    """Same as `non_max_suppression()`, but filters the boxes of all images at once and runs
+    a single NMS on boxes offset by image index and class. On CPU, when there are more than `max_batched_nms`
+    candidates, NMS runs per image on the already filtered and sorted boxes instead: the CPU kernel of
+    `torchvision.ops.nms()` compares all the pairs of boxes, even those offset apart, so a single NMS over
+    the batch costs O(N^2) while the per-image ones cost O(sum n_i^2); it is slower above ~500 candidates.
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+    multi_label &= nc > 1  # multiple labels per box
+
+    img_idx, anchor_idx = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # candidates
+    x = prediction[img_idx, anchor_idx]
+
+    # Compute conf
+    if nc == 1:
+        scores = x[:, 4:5]  # for models with one class, cls_loss is 0 and cls_conf is always 0.5
+    else:
+        scores = x[:, 5:] * x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (scores > conf_thres).nonzero(as_tuple=True)
+        x = torch.cat((box[i], scores[i, j, None], j[:, None].float()), 1)
+        img_idx = img_idx[i]
+    else:  # best class only
+        conf, j = scores.max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x = torch.cat((box, conf, j.float()), 1)[keep]
+        img_idx = img_idx[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, img_idx = x[keep], img_idx[keep]
+
+    # boxes are sorted by image, since `nonzero()` returns indices in lexicographic order
+    if x.shape[0] > 0:
+        if torch.bincount(img_idx).max() > max_nms:  # at most `max_nms` boxes per image into NMS
+            order = _sort_by_segment(img_idx, x[:, 4])
+            x, img_idx = x[order], img_idx[order]
+            keep = _segment_ranks(img_idx) < max_nms
+            x, img_idx = x[keep], img_idx[keep]
+
+        # Batched NMS: boxes are offset by class, and by image
+        boxes = x[:, :4] + x[:, 5:6] * (0 if agnostic else max_wh)
+        if x.device.type == 'cuda' or x.shape[0] <= max_batched_nms:
+            boxes = boxes + img_idx[:, None] * (boxes.max() + 1)
+            i = torchvision.ops.nms(boxes, x[:, 4], iou_thres)
+            i = i[torch.sort(img_idx[i], stable=True)[1]]
+        else:
+            # the boxes (sorted by image already) are split into one NMS per image
+            counts = torch.bincount(img_idx, minlength=bs).tolist()
+            i, start = [], 0
+            for img_boxes, img_scores in zip(torch.split(boxes, counts), torch.split(x[:, 4], counts)):
+                i.append(torchvision.ops.nms(img_boxes, img_scores, iou_thres) + start)
+                start += img_boxes.shape[0]
+            i = torch.cat(i)
+
+        # limit detections per image
+        i = i[_segment_ranks(img_idx[i]) < max_det]
+        x, img_idx = x[i], img_idx[i]
+
+    counts = torch.bincount(img_idx, minlength=bs).tolist()
+    return list(torch.split(x, counts))
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, nc=None, nkpt=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
@@ -19,9 +19,12 @@
 # Credits to: https://github.com/WongKinYiu/yolov7, forked to https://github.com/breezedeus/yolov7
 
 import os
+import json
+import hashlib
+import inspect
 import logging
 from pathlib import Path
-from typing import Union, Optional, Any, List, Dict, Tuple
+from typing import Union, Optional, Any, List, Dict, Tuple, Iterable, Iterator
 
 from PIL import Image
 import cv2
@@ -31,18 +34,43 @@ from torch import nn
 from numpy import random
 
 from ..consts import MODEL_VERSION, ANALYSIS_SPACE, ANALYSIS_MODELS, DOWNLOAD_SOURCE
-from ..utils import data_dir, get_model_file, sort_boxes, dedup_boxes, xyxy24p
+from ..utils import (
+    data_dir,
+    get_model_file,
+    sort_boxes,
+    dedup_boxes,
+    xyxy24p,
+    check_color_order,
+    split_image_batch,
+    to_uint8_hwc,
+    FrameChangeEstimator,
+    iter_frames,
+    reuse_detections,
+    iter_img_pages,
+    prefetch,
+    InferenceRunner,
+    check_inference_mode,
+    file_sha1,
+    load_checkpoint,
+    assign_state_dict,
+    file_lock,
+)
 from .yolo import Model
 from .consts import CATEGORY_DICT
 from .common import Conv
+from .experimental import ORTEnd2End
 from .datasets import letterbox
 from .general import (
     check_img_size,
-    non_max_suppression,
+    batched_non_max_suppression,
     scale_coords,
 )
-from .torch_utils import select_device, time_synchronized
-from .plots import plot_one_box
+from .torch_utils import (
+    select_device,
+    time_synchronized,
+    serialize_model,
+    load_serialized_model,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -62,20 +90,71 @@ class Ensemble(nn.ModuleList):
         return y, None  # inference, train output
 
 
+@torch.no_grad()
+def reparameterize(model: Model, rtol: float = 1e-3, atol: float = 1e-2) -> bool:
+    """
+    Reparameterize the multi-branch blocks (`RepConv`, `RepConv_OREPA`), Conv+BN and the implicit layers of `IDetect`
+    of `model` in place into their deploy forms, by `Model.fuse()`, and check the outputs on a random image
+    against the ones computed before fusing. No copy of the model is made.
+
+    Returns: whether the outputs match; if not, `model` is broken and should be loaded again
+    """
+    stride = int(model.stride.max())
+    x = torch.rand(1, 3, 4 * stride, 4 * stride, device=next(model.parameters()).device)
+    expected = model.eval()(x)[0]
+    out = model.fuse().eval()(x)[0]
+    if not torch.allclose(out, expected, rtol=rtol, atol=atol):
+        logger.warning(
+            'outputs of the reparameterized model mismatch the original ones, max diff: %f; '
+            'the original model is used' % (out - expected).abs().max()
+        )
+        return False
+    return True
+
+
 @torch.no_grad()
 def attempt_load(
-    categories, model_fp, cfg_fp, map_location=None,
+    categories, model_fp, cfg_fp, map_location=None, deployed_fp=None,
 ):
+    """
+    Load the model, and reparameterize it for deployment.
+    `model_fp` is either the original weights, or the deployed weights saved with `deployed_fp`.
+
+    Args:
+        deployed_fp: if not None, the deployed weights are saved to this file when the reparameterization
+            matches the original model; loading them later skips the reparameterization.
+            On mismatch, the original (not reparameterized) model is returned, and nothing is saved
+    """
+    def _load():
+        # the weights are memory-mapped, and used by the model without copying them
+        model = Model(cfg_fp, ch=3, nc=len(categories), anchors=None).to(map_location)
+        return model, load_checkpoint(model_fp, map_location=map_location, mmap=True)
+
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
-    inner_model = Model(cfg_fp, ch=3, nc=len(categories), anchors=None).to(
-        map_location
-    )  # create
-    state_dict = torch.load(model_fp, map_location=map_location)  # load
-    inner_model.load_state_dict(state_dict)
-    # inner_model.names = CATEGORIES
+    inner_model, state_dict = _load()
+    if 'deployed_state_dict' in state_dict:
+        inner_model.to_deploy_structure()
+        assign_state_dict(inner_model, state_dict['deployed_state_dict'])
+        inner_model.float().eval()
+    else:
+        assign_state_dict(inner_model, state_dict)
+        # inner_model.names = CATEGORIES
+        if not reparameterize(inner_model.float()):
+            # fusing modifies some of the weights in place
+            inner_model, state_dict = _load()
+            assign_state_dict(inner_model, state_dict)
+            inner_model.float().eval()
+        elif deployed_fp is not None:
+            tmp_fp = '%s.tmp%d' % (deployed_fp, os.getpid())
+            try:
+                torch.save({'deployed_state_dict': inner_model.state_dict()}, tmp_fp)
+                os.replace(tmp_fp, deployed_fp)
+                logger.info('deployed weights are saved to %s' % deployed_fp)
+            except (OSError, RuntimeError) as e:
+                logger.warning('failed to save the deployed weights to %s: %s' % (deployed_fp, e))
 
     model = Ensemble()
-    model.append(inner_model.float().fuse().eval())
+    model.append(inner_model)
 
     # Compatibility updates
     for m in model.modules():
@@ -95,6 +174,100 @@ def attempt_load(
         return model  # return ensemble
 
 
+@torch.no_grad()
+def export_onnx(
+    categories: List[str],
+    model_fp: Union[str, Path],
+    cfg_fp: Union[str, Path],
+    output_fp: Union[str, Path],
+    *,
+    include_nms: bool = False,
+    opset_version: int = 17,
+):
+    """
+    Export the fused YOLOv7 model to ONNX, with dynamic batch size, height and width of the input `images`.
+
+    Args:
+        categories: category names of the model
+        model_fp: file path of the PyTorch weights
+        cfg_fp: architecture yaml file of the model
+        output_fp: file path of the exported ONNX model
+        include_nms: whether to run NMS in the graph (with the ONNX `NonMaxSuppression` operator).
+            If True, the graph has two more inputs `conf_threshold` and `iou_threshold` (float32 tensors of shape [1]),
+            and outputs `detections` with shape (n, 7): [image index, x1, y1, x2, y2, score, class];
+            otherwise it outputs the raw predictions `output` with shape (batch, anchors, 5 + nc)
+        opset_version: ONNX opset version
+    """
+    import onnx
+
+    model = attempt_load(categories, model_fp, cfg_fp, map_location='cpu')
+    detect = model.model[-1]
+    # grids cached for other shapes would be exported as constants
+    detect.grid = [torch.zeros(1)] * detect.nl
+    stride = int(model.stride.max())
+    img = torch.zeros(1, 3, 4 * stride, 5 * stride)
+    dynamic_axes = {'images': {0: 'batch', 2: 'height', 3: 'width'}}
+    if include_nms:
+        model = ORTEnd2End(model)
+        args = (img, torch.tensor([0.25]), torch.tensor([0.45]))
+        input_names = ['images', 'conf_threshold', 'iou_threshold']
+        output_names = ['detections']
+        dynamic_axes['detections'] = {0: 'num_dets'}
+    else:
+        detect.concat = True
+        args = (img,)
+        input_names = ['images']
+        output_names = ['output']
+        dynamic_axes['output'] = {0: 'batch', 1: 'anchors'}
+
+    export_kwargs = dict(
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+        do_constant_folding=True,
+    )
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # torch >= 2.5; the TorchScript-based exporter handles `dynamic_axes`
+        export_kwargs['dynamo'] = False
+    tmp_fp = '%s.tmp%d' % (output_fp, os.getpid())
+    torch.onnx.export(model, args, tmp_fp, **export_kwargs)
+
+    onnx_model = onnx.load(tmp_fp)
+    for key, value in (
+        ('stride', str(stride)),
+        ('categories', json.dumps(list(categories), ensure_ascii=False)),
+        ('include_nms', str(int(include_nms))),
+    ):
+        meta = onnx_model.metadata_props.add()
+        meta.key, meta.value = key, value
+    onnx.save(onnx_model, tmp_fp)
+    os.replace(tmp_fp, output_fp)
+    logger.info('ONNX model is exported to %s' % output_fp)
+
+
+def create_ort_session(model_fp: Union[str, Path], device: torch.device):
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    providers = ['CPUExecutionProvider']
+    if device.type == 'cuda' and 'CUDAExecutionProvider' in available:
+        providers.insert(0, 'CUDAExecutionProvider')
+    return ort.InferenceSession(str(model_fp), providers=providers)
+
+
+def model_cache_key(
+    categories: List[str], model_fp: Union[str, Path], cfg_fp: Union[str, Path]
+) -> str:
+    """Key of the serialized model, from the weights, the architecture, the categories and the torch version."""
+    sha1 = hashlib.sha1(file_sha1(model_fp).encode())
+    with open(cfg_fp, 'rb') as f:
+        sha1.update(f.read())
+    sha1.update(json.dumps(list(categories), ensure_ascii=False).encode())
+    sha1.update(torch.__version__.encode())
+    return sha1.hexdigest()[:16]
+
+
 class LayoutAnalyzer(object):
     def __init__(
         self,
@@ -107,6 +280,9 @@ class LayoutAnalyzer(object):
         model_arch_yaml: Optional[str] = None,
         root: Union[str, Path] = data_dir(),
         device: str = 'cpu',
+        inference_mode: str = 'eager',
+        use_model_cache: bool = False,
+        save_deployed: bool = True,
         **kwargs,
     ):
         """
@@ -114,7 +290,9 @@ class LayoutAnalyzer(object):
         Args:
             model_name (str): 模型类型。可选值：'mfd' 表示数学公式检测；'layout' 表示版面分析。默认值：'mfd'
             model_type (str): 模型类型。当前支持 'yolov7_tiny' 和 'yolov7'; 默认值: 'yolov7_tiny'
-            model_backend (str): backend; 当前仅支持: 'pytorch'; 默认值: 'pytorch'
+            model_backend (str): backend; 可选值：'pytorch' 或 'onnx'。使用 'onnx' 时，若没有 ONNX 模型文件，
+                会从 PyTorch 模型文件自动导出一个（支持动态的 batch 和图片尺寸），并保存在其旁边；
+                也可以通过 `model_fp` 直接指定用 `export_onnx()` 导出的模型（包括在图中做 NMS 的模型）。默认值: 'pytorch'
             model_categories (List[str]): 模型的检测类别名称。默认值：None，表示基于 `model_name` 自动决定
             model_fp (str): 模型文件路径；默认值为 None，表示使用默认文件路径。
             model_arch_yaml (str): 架构文件路径，例如 'yolov7-mfd.yaml'；默认值为 None，表示将自动选择。
@@ -122,6 +300,17 @@ class LayoutAnalyzer(object):
                 Linux/Mac下默认值为 `~/.cnstd`，表示模型文件所处文件夹类似 `~/.cnstd/1.2/analysis`
                 Windows下默认值为 `C:/Users/<username>/AppData/Roaming/cnstd`。
             device (str): 'cpu', or 'gpu'; default: 'cpu'
+            inference_mode (str): PyTorch 模型的推理方式，可选值：'eager', 'channels_last', 'bf16', 'compiled'；
+                具体可参考类 `cnstd.Detector` 的说明。仅对 'pytorch' backend 有效。默认值: 'eager'
+            use_model_cache (bool): 是否缓存融合后的模型（TorchScript 格式，保存在模型文件旁边，
+                以模型文件、架构文件、类别和 torch 版本为 key）。之后的加载直接读取缓存，跳过模型的构建和融合。
+                模型文件所在的文件夹需要可写；若 TorchScript 模型的输出与原模型不一致，会记录下来，之后不再尝试缓存。
+                仅对 'pytorch' backend 有效。默认值: False
+            save_deployed (bool): 加载时模型中的多分支结构（`RepConv`、`RepConv_OREPA`、Conv+BN、`IDetect` 的隐式层）
+                会被重参数化为单个卷积，并检查其输出与原模型一致。此参数为 True 时，重参数化后的权重会保存为模型文件旁边的
+                `<模型文件名>-deploy.pt`（多个进程同时加载时只由其中一个保存）；之后的加载若发现此文件（且比模型文件新），
+                会直接使用它，跳过重参数化。此文件以内存映射的方式读取，多个进程加载同一模型时共享其内存。
+                模型文件所在的文件夹不可写时，每个进程各自重参数化。仅对 'pytorch' backend 有效。默认值: True
             **kwargs ():
         """
         if model_name:
@@ -148,19 +337,39 @@ class LayoutAnalyzer(object):
             self._arch_yaml = model_arch_yaml
         else:
             VALID_MODELS = ANALYSIS_MODELS[self._model_name]
-            self._arch_yaml = VALID_MODELS[(self._model_type, self._model_backend)][
-                'arch_yaml'
-            ]
+            model_info = VALID_MODELS.get((self._model_type, self._model_backend))
+            if model_info is None:
+                model_info = VALID_MODELS[(self._model_type, 'pytorch')]
+            self._arch_yaml = model_info['arch_yaml']
+
+        self._onnx_nms = False
+        if self._model_backend == 'onnx':
+            self._prepare_onnx_model()
+            self.model = create_ort_session(self._model_fp, self.device)
+            meta = self.model.get_modelmeta().custom_metadata_map
+            self.stride = int(meta.get('stride', 32))
+            self._onnx_nms = len(self.model.get_inputs()) > 1
+        else:
+            self.model = self._load_pytorch_model(use_model_cache, save_deployed)
+            self.model.eval()
 
-        self.model = attempt_load(
-            self.categories,
-            self._model_fp,
-            cfg_fp=self._arch_yaml,
-            map_location=self.device,
-        )  # load FP32 model
-        self.model.eval()
+            self.stride = int(self.model.stride.max())  # model stride
 
-        self.stride = int(self.model.stride.max())  # model stride
+        inference_mode = check_inference_mode(inference_mode)
+        if self._model_backend == 'onnx':
+            if inference_mode != 'eager':
+                logger.warning('inference_mode is ignored by the onnx backend')
+            self._runner = None
+        else:
+            self._runner = InferenceRunner(
+                self.model,
+                inference_mode,
+                forward=lambda img: self.model(img, augment=False)[0],
+                device=self.device,
+            )
+            self._runner.check_parity(
+                torch.rand(1, 3, 8 * self.stride, 8 * self.stride, device=self.device)
+            )
         # self.img_size = check_img_size(image_size, s=self.stride)  # check img_size
 
     def _assert_and_prepare_model_files(self, model_fp, root):
@@ -171,25 +380,103 @@ class LayoutAnalyzer(object):
             return
 
         VALID_MODELS = ANALYSIS_MODELS[self._model_name]
-        if (self._model_type, self._model_backend) not in VALID_MODELS:
+        model_backend = self._model_backend
+        if (self._model_type, model_backend) not in VALID_MODELS and model_backend == 'onnx':
+            # no released ONNX model, it will be exported from the PyTorch one
+            model_backend = 'pytorch'
+        if (self._model_type, model_backend) not in VALID_MODELS:
             raise NotImplementedError(
                 'model %s is not supported currently'
                 % ((self._model_type, self._model_backend),)
             )
 
         self._model_dir = os.path.join(root, MODEL_VERSION, ANALYSIS_SPACE)
-        suffix = 'pt' if self._model_backend == 'pytorch' else 'onnx'
+        suffix = 'pt' if model_backend == 'pytorch' else 'onnx'
         model_fp = os.path.join(
             self._model_dir, '%s-%s.%s' % (self._model_name, self._model_type, suffix)
         )
         if not os.path.isfile(model_fp):
             logger.warning('Can NOT find model file %s' % model_fp)
-            url = VALID_MODELS[(self._model_type, self._model_backend)]['url']
+            url = VALID_MODELS[(self._model_type, model_backend)]['url']
 
             get_model_file(url, self._model_dir, download_source=DOWNLOAD_SOURCE)  # download the .zip file and unzip
 
         self._model_fp = model_fp
 
+    def _load_pytorch_model(self, use_model_cache, save_deployed):
+        deployed_fp = '%s-deploy.pt' % os.path.splitext(self._model_fp)[0]
+
+        def _is_deployed():
+            return os.path.isfile(deployed_fp) and os.path.getmtime(
+                deployed_fp
+            ) >= os.path.getmtime(self._model_fp)
+
+        model = None
+        if save_deployed and not _is_deployed():
+            try:
+                # only one process reparameterizes the model and saves the deployed weights
+                with file_lock(deployed_fp + '.lock'):
+                    if not _is_deployed():
+                        model = attempt_load(
+                            self.categories,
+                            self._model_fp,
+                            cfg_fp=self._arch_yaml,
+                            map_location=self.device,
+                            deployed_fp=deployed_fp,
+                        )  # load FP32 model
+            except OSError as e:
+                logger.warning('failed to save the deployed weights to %s: %s' % (deployed_fp, e))
+        if _is_deployed():
+            # the fused weights are private to each process; the memory-mapped deployed ones are shared
+            self._model_fp = deployed_fp
+            model = None
+
+        def _load():
+            if model is not None:
+                return model
+            return attempt_load(
+                self.categories,
+                self._model_fp,
+                cfg_fp=self._arch_yaml,
+                map_location=self.device,
+            )  # load FP32 model
+
+        if not use_model_cache:
+            return _load()
+
+        cache_key = model_cache_key(self.categories, self._model_fp, self._arch_yaml)
+        cache_fp = '%s-%s.torchscript' % (os.path.splitext(self._model_fp)[0], cache_key)
+        # marks a traced model mismatching the eager one, not to trace it again at each start
+        mismatch_fp = cache_fp + '.mismatch'
+        if os.path.isfile(cache_fp):
+            try:
+                return load_serialized_model(cache_fp, map_location=self.device)
+            except Exception as e:
+                logger.warning('failed to load the cached model %s: %s' % (cache_fp, e))
+
+        model = _load()
+        if os.path.isfile(mismatch_fp):
+            return model
+        try:
+            serialized = serialize_model(model, cache_fp)
+            if serialized is None:
+                open(mismatch_fp, 'w').close()
+        except (OSError, RuntimeError) as e:
+            logger.warning('failed to cache the model to %s: %s' % (cache_fp, e))
+            serialized = None
+        return model if serialized is None else serialized
+
+    def _prepare_onnx_model(self):
+        if Path(self._model_fp).suffix == '.onnx':
+            return
+        # export the PyTorch model, and keep the ONNX model next to it
+        onnx_fp = os.path.splitext(self._model_fp)[0] + '.onnx'
+        if not os.path.isfile(onnx_fp) or os.path.getmtime(onnx_fp) < os.path.getmtime(
+            self._model_fp
+        ):
+            export_onnx(self.categories, self._model_fp, self._arch_yaml, onnx_fp)
+        self._model_fp = onnx_fp
+
     def __call__(self, *args, **kwargs):
         """参考函数 `self.analyze()` 。"""
         return self.analyze(*args, **kwargs)
@@ -201,22 +488,29 @@ class LayoutAnalyzer(object):
             Path,
             Image.Image,
             np.ndarray,
-            List[Union[str, Path, Image.Image, np.ndarray]],
+            torch.Tensor,
+            List[Union[str, Path, Image.Image, np.ndarray, torch.Tensor]],
         ],
         resized_shape: Union[int, Tuple[int, int]] = 700,
         box_margin: int = 2,
         conf_threshold: float = 0.25,
         iou_threshold: float = 0.45,
+        color_order: str = 'rgb',
+        batch_size: int = 1,
     ) -> Union[List[Dict[str, Any]], List[List[Dict[str, Any]]]]:
         """
         对指定图片（列表）进行版面分析。
 
         Args:
-            img_list (str or list): 待识别图片或图片列表；如果是 `np.ndarray`，则应该是shape为 `[H, W, 3]` 的 RGB 格式数组
+            img_list (str or list): 待识别图片或图片列表；如果是 `np.ndarray`，则应该是shape为 `[H, W, 3]` 的数组；
+                也可以是 shape 为 `[N, H, W, 3]` 的 np.ndarray 或 torch.Tensor
             resized_shape (int or tuple): (H, W); 把图片resize到此大小再做分析；默认值为 `700`
             box_margin (int): 对识别出的内容框往外扩展的像素大小；默认值为 `2`
             conf_threshold (float): 分数阈值；默认值为 `0.25`
             iou_threshold (float): IOU阈值；默认值为 `0.45`
+            color_order (str): np.ndarray 或 torch.Tensor 图片的颜色顺序，'rgb' 或 'bgr'；默认值为 `'rgb'`
+            batch_size (int): 每批同时分析的图片数；同一批的图片会被 letterbox 到相同的尺寸（每条边取这批中的最大值，
+                并对齐到 stride），只做一次前向计算和一次 NMS；默认值为 `1`
             **kwargs ():
 
         Returns: 一张图片的结果为一个list，其中每个元素表示识别出的版面中的一个元素，包含以下信息：
@@ -226,43 +520,109 @@ class LayoutAnalyzer(object):
 
         """
         outs = []
-        single = False
-        if not isinstance(img_list, list):
-            img_list = [img_list]
-            single = True
-
-        for img in img_list:
-            img, img0 = self._preprocess_images(img, resized_shape)
-            outs.append(
-                self._analyze_one(img, img0, box_margin, conf_threshold, iou_threshold)
+        color_order = check_color_order(color_order)
+        img_list, single = split_image_batch(img_list)
+
+        for start in range(0, len(img_list), batch_size):
+            batch = [
+                self._preprocess_images(img, resized_shape, color_order)
+                for img in img_list[start : start + batch_size]
+            ]
+            outs.extend(
+                self._analyze_batch(batch, box_margin, conf_threshold, iou_threshold)
             )
 
         return outs[0] if single else outs
 
+    def analyze_stream(
+        self,
+        frames: Union[str, Path, np.ndarray, torch.Tensor, Iterable[Any]],
+        *,
+        color_order: str = 'rgb',
+        keyframe_interval: int = 50,
+        change_estimator: Optional[FrameChangeEstimator] = None,
+        **kwargs,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        对视频或者连续帧做版面分析。相邻帧变化很小时，会复用之前的结果，只在关键帧或者有变化的区域上重新分析。
+
+        Args:
+            frames: 视频文件路径；或者 shape 为 `[N, H, W, 3]` 的 np.ndarray 或 torch.Tensor；或者可迭代的帧序列
+            color_order (str): np.ndarray 或 torch.Tensor 帧的颜色顺序，'rgb' 或 'bgr'；视频文件读出的帧总是 'bgr'；默认值为 `'rgb'`
+            keyframe_interval (int): 至少每隔这么多帧，对整帧重新分析一次；默认值为 `50`
+            change_estimator (FrameChangeEstimator): 用于度量帧间变化；为 `None` 时使用默认参数
+            **kwargs (): 其他传给 `self.analyze()` 的参数
+
+        Returns: 迭代器，每个元素对应一帧，为 Dict，包含以下 keys：
+            * frame_idx: 帧的序号，从 0 开始 ;
+            * frame_status: 此帧结果的来源，取值为 'keyframe', 'static', 'shifted' 或 'region'，
+                含义参考 `CnStd.detect_stream()` ;
+            * layout: 此帧的分析结果，格式与 `self.analyze()` 中一张图片的结果相同 。
+
+        """
+        color_order = check_color_order(color_order)
+        frames, color_order = iter_frames(frames, color_order)
+        for idx, status, layout in reuse_detections(
+            frames,
+            lambda img: self.analyze(img, color_order=color_order, **kwargs),
+            estimator=change_estimator,
+            keyframe_interval=keyframe_interval,
+        ):
+            yield dict(frame_idx=idx, frame_status=status, layout=layout)
+
+    def analyze_pages(
+        self,
+        img_fps: Union[str, Path, List[Union[str, Path]]],
+        *,
+        num_prefetch: int = 1,
+        **kwargs,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        对多页图片（如多页 TIFF、GIF 等）或者图片序列逐页做版面分析。分析第 i 页时，后台线程解码第 i+1 页。
+
+        Args:
+            img_fps (str or list): 单个图片文件路径，或者多个图片文件路径；每个文件都可以包含多页
+            num_prefetch (int): 后台最多提前解码的页数；默认值为 `1`
+            **kwargs (): 其他传给 `self.analyze()` 的参数
+
+        Returns: 迭代器，每个元素对应一页，为 Dict，包含以下 keys：
+            * img_fp: 此页所在的图片文件路径 ;
+            * page_idx: 此页在其文件中的序号，从 0 开始 ;
+            * layout: 此页的分析结果，格式与 `self.analyze()` 中一张图片的结果相同 。
+
+        """
+        for img_fp, page_idx, page in prefetch(iter_img_pages(img_fps), num_prefetch):
+            yield dict(img_fp=img_fp, page_idx=page_idx, layout=self.analyze(page, **kwargs))
+
     def _preprocess_images(
         self,
         img: Union[str, Path, Image.Image, np.ndarray],
         resized_shape: Union[int, Tuple[int, int]],
-    ) -> Tuple[np.ndarray, np.ndarray]:
+        color_order: str = 'rgb',
+    ) -> Tuple[np.ndarray, np.ndarray, Tuple[Tuple[float, float], Tuple[float, float]]]:
         """
 
         Args:
             img ():
+            resized_shape ():
+            color_order (): color order of the ndarray `img`, 'rgb' or 'bgr'
 
-        Returns: (img, img0)
+        Returns: (img, img0, ratio_pad)
             * img: RGB-formated ndarray: [3, H, W]
-            * img0: BGR-formated ndarray: [H, W, 3]
+            * img0: uint8 ndarray: [H, W, 3], the original image without any color conversion or copy
+            * ratio_pad: ((ratio, ratio), (pad_w, pad_h)) of the letterbox, used by `scale_coords()`
 
         """
         if isinstance(img, (str, Path)):
             if not os.path.isfile(img):
                 raise FileNotFoundError(img)
-            img0 = cv2.imread(img, cv2.IMREAD_COLOR)
+            img0 = cv2.imread(str(img), cv2.IMREAD_COLOR)
+            color_order = 'bgr'
         elif isinstance(img, Image.Image):
-            img0 = np.asarray(img.convert('RGB'), dtype='float32')
-            img0 = cv2.cvtColor(img0, cv2.COLOR_RGB2BGR)
+            img0 = to_uint8_hwc(img)
+            color_order = 'rgb'
         elif isinstance(img, np.ndarray):
-            img0 = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            img0 = to_uint8_hwc(img)
         else:
             raise TypeError('type %s is not supported now' % str(type(img)))
 
@@ -272,47 +632,79 @@ class LayoutAnalyzer(object):
             check_img_size(x, s=self.stride) for x in resized_shape
         ]  # check img_size
         # Padded resize
-        img = letterbox(img0, img_size, stride=self.stride)[0]
+        img, ratio, pad = letterbox(img0, img_size, stride=self.stride)
 
         # Convert
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-        img = np.ascontiguousarray(img)
+        if color_order == 'bgr':
+            img = img[:, :, ::-1]  # BGR to RGB
+        img = np.ascontiguousarray(img.transpose(2, 0, 1))  # to 3x416x416
 
-        return img, img0
+        return img, img0, (ratio, pad)
 
-    @torch.no_grad()
-    def _analyze_one(
-        self, img, img0, box_margin, conf_threshold, iou_threshold,
+    @staticmethod
+    def _collate(
+        batch: List[Tuple[np.ndarray, np.ndarray, Any]]
+    ) -> Tuple[np.ndarray, List[Tuple[Tuple[float, float], Tuple[float, float]]]]:
+        """
+        Pad letterboxed images to the largest height and width of the batch (which are stride-aligned already),
+        keeping every image centered as `letterbox()` does, and update their pads accordingly.
+        """
+        if len(batch) == 1:
+            img, _, ratio_pad = batch[0]
+            return img[None], [ratio_pad]
+        height = max(img.shape[1] for img, _, _ in batch)
+        width = max(img.shape[2] for img, _, _ in batch)
+        imgs = np.full((len(batch), 3, height, width), 114, dtype=np.uint8)
+        ratio_pads = []
+        for idx, (img, _, (ratio, (pad_w, pad_h))) in enumerate(batch):
+            top, left = (height - img.shape[1]) // 2, (width - img.shape[2]) // 2
+            imgs[idx, :, top : top + img.shape[1], left : left + img.shape[2]] = img
+            ratio_pads.append((ratio, (pad_w + left, pad_h + top)))
+        return imgs, ratio_pads
+
+    @torch.inference_mode()
+    def _analyze_batch(
+        self, batch, box_margin, conf_threshold, iou_threshold,
     ):
-        img = torch.from_numpy(img).to(self.device)
+        imgs, ratio_pads = self._collate(batch)
+        img = torch.from_numpy(imgs).to(self.device)
         img = img.float()  # uint8 to fp16/32
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)
 
         # Inference
         t1 = time_synchronized()
-        pred = self.model(img, augment=False)[0]
+        if self._model_backend == 'onnx':
+            pred = self._onnx_forward(img, conf_threshold, iou_threshold)
+        else:
+            pred = self._runner(img)
         t2 = time_synchronized()
 
         # Apply NMS
-        pred = non_max_suppression(
-            pred,
-            conf_thres=conf_threshold,
-            iou_thres=iou_threshold,
-            classes=None,
-            agnostic=False,
-        )
+        if not self._onnx_nms:
+            pred = batched_non_max_suppression(
+                pred,
+                conf_thres=conf_threshold,
+                iou_thres=iou_threshold,
+                classes=None,
+                agnostic=False,
+            )
         t3 = time_synchronized()
 
-        one_out = []
+        logger.info(
+            f'Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS'
+        )
+
+        outs = []
         # Process detections
-        for i, det in enumerate(pred):  # detections per image
+        for det, (_, img0, _), ratio_pad in zip(pred, batch, ratio_pads):  # detections per image
+            one_out = []
             if len(det) > 0:
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], img0.shape).round()
+                det[:, :4] = scale_coords(
+                    img.shape[2:], det[:, :4], img0.shape, ratio_pad=ratio_pad
+                ).round()
 
-                for *xyxy, conf, cls in reversed(det):
+                for *xyxy, conf, cls in reversed(det.tolist()):
                     xyxy = self._expand(xyxy, box_margin, img0.shape)
                     one_out.append(
                         {
@@ -322,12 +714,25 @@ class LayoutAnalyzer(object):
                         }
                     )
 
-            logger.info(
-                f'Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS'
-            )
+            one_out = sort_boxes(one_out, key='box')
+            outs.append(dedup_boxes(one_out, threshold=0.1))
+        return outs
 
-        one_out = sort_boxes(one_out, key='box')
-        return dedup_boxes(one_out, threshold=0.1)
+    def _onnx_forward(
+        self, img: torch.Tensor, conf_threshold: float, iou_threshold: float
+    ) -> Union[torch.Tensor, List[torch.Tensor]]:
+        """
+        Run the ONNX model. Returns the raw predictions, or the detections of every image
+        with the same format as `non_max_suppression()` if NMS is in the graph.
+        """
+        inputs = {'images': img.cpu().numpy()}
+        if not self._onnx_nms:
+            return torch.from_numpy(self.model.run(None, inputs)[0]).to(img.device)
+
+        inputs['conf_threshold'] = np.array([conf_threshold], dtype=np.float32)
+        inputs['iou_threshold'] = np.array([iou_threshold], dtype=np.float32)
+        dets = torch.from_numpy(self.model.run(None, inputs)[0]).to(img.device)
+        return [dets[dets[:, 0] == idx, 1:] for idx in range(img.shape[0])]
 
     def _expand(self, xyxy, box_margin, shape):
         xmin, ymin, xmax, ymax = [float(_x) for _x in xyxy]
@@ -357,6 +762,8 @@ COLOR_LIST = [
 
 def save_layout_img(img0, categories, one_out, save_path):
     """可视化版面分析结果。"""
+    from .plots import plot_one_box  # matplotlib, seaborn, etc.
+
     if isinstance(img0, Image.Image):
         img0 = cv2.cvtColor(np.asarray(img0.convert('RGB')), cv2.COLOR_RGB2BGR)
 
@@ -392,3 +392,54 @@ class TracedModel(nn.Module):
         out = self.detect_layer(out)
         return out
 
+
+
+class SerializedModel(nn.Module):
+    """A fused and eval-ready model traced by TorchScript, see `serialize_model()`.
+    Loading it skips the yaml parsing, building and fusing of `Model`."""
+
+    def __init__(self, model, stride):
+        super(SerializedModel, self).__init__()
+        self.model = model
+        self.stride = stride
+
+    def forward(self, x, augment=False, profile=False):
+        return self.model(x)
+
+
+@torch.no_grad()
+def serialize_model(model, save_fp, example_shapes=((1, 3, 256, 320), (2, 3, 448, 384)), atol=1e-4):
+    """
+    Trace the fused `model` with TorchScript and save it to `save_fp`. The grids of the detection layer are
+    traced from the input shape, so the traced model accepts any batch size and image size; this is
+    checked on `example_shapes[1:]` against the eager outputs before saving.
+
+    Returns: the loaded `SerializedModel`, or None if the traced model mismatches the eager one.
+    """
+    device = next(model.parameters()).device
+    detect = model.model[-1]
+    detect.grid = [torch.zeros(1)] * detect.nl  # otherwise the cached grids are traced as constants
+    traced = torch.jit.trace(
+        model, torch.rand(example_shapes[0], device=device), strict=False, check_trace=False
+    )
+    for shape in example_shapes[1:]:
+        x = torch.rand(shape, device=device)
+        if not torch.allclose(traced(x)[0], model(x)[0], atol=atol):
+            logger.warning('the traced model mismatches the eager one, it is not saved')
+            return None
+
+    extra_files = {'stride.txt': ','.join(str(float(s)) for s in model.stride)}
+    tmp_fp = '%s.tmp%d' % (save_fp, os.getpid())
+    torch.jit.save(traced, tmp_fp, _extra_files=extra_files)
+    os.replace(tmp_fp, save_fp)
+    return SerializedModel(traced, model.stride.clone())
+
+
+def load_serialized_model(save_fp, map_location=None):
+    extra_files = {'stride.txt': ''}
+    traced = torch.jit.load(str(save_fp), map_location=map_location, _extra_files=extra_files)
+    stride_txt = extra_files['stride.txt']
+    if isinstance(stride_txt, bytes):
+        stride_txt = stride_txt.decode()
+    stride = torch.tensor([float(s) for s in stride_txt.split(',')])
+    return SerializedModel(traced.eval(), stride)
@@ -38,6 +38,11 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+def _is_compiling():
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None)
+    return is_compiling is not None and is_compiling()
+
+
 class Detect(nn.Module):
     stride = None  # strides computed during build
     export = False  # onnx export
@@ -145,11 +150,10 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                grid = self._get_grid(i, nx, ny, x[i].device)
 
                 y = x[i].sigmoid()
-                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
+                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + grid) * self.stride[i]  # xy
                 y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
                 z.append(y.view(bs, -1, self.no))
 
@@ -165,16 +169,15 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                grid = self._get_grid(i, nx, ny, x[i].device)
 
                 y = x[i].sigmoid()
                 if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
+                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + grid) * self.stride[i]  # xy
                     y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
                 else:
                     xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
-                    xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
+                    xy = xy * (2. * self.stride[i]) + (self.stride[i] * (grid - 0.5))  # new xy
                     wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
                     y = torch.cat((xy, wh, conf), 4)
                 z.append(y.view(bs, -1, self.no))
@@ -207,6 +210,14 @@ class IDetect(nn.Module):
             self.m[i].bias *= self.im[i].implicit.reshape(c2)
             self.m[i].weight *= self.im[i].implicit.transpose(0,1)
             
+    def _get_grid(self, i, nx, ny, device):
+        if _is_compiling():
+            # the cached grids are guarded by torch.compile, updating them would trigger recompilations
+            return self._make_grid(nx, ny).to(device)
+        if self.grid[i].shape[2:4] != (ny, nx):
+            self.grid[i] = self._make_grid(nx, ny).to(device)
+        return self.grid[i]
+
     @staticmethod
     def _make_grid(nx=20, ny=20):
         yv, xv = torch.meshgrid([torch.arange(ny), torch.arange(nx)])
@@ -727,6 +738,43 @@ class Model(nn.Module):
         self.info()
         return self
 
+    def to_deploy_structure(self):
+        """Convert the modules to the structure of a fused model without computing any weight,
+        so the state dict of a fused model can be loaded directly."""
+        for m in self.model.modules():
+            if isinstance(m, RepConv):
+                if not m.deploy:
+                    conv = m.rbr_dense[0]
+                    for name in ('rbr_dense', 'rbr_1x1', 'rbr_identity'):
+                        delattr(m, name)
+                    m.rbr_reparam = nn.Conv2d(
+                        conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                        conv.padding, groups=conv.groups, bias=True,
+                    )
+                    m.rbr_identity = m.rbr_1x1 = None
+                    m.deploy = True
+            elif isinstance(m, RepConv_OREPA):
+                if not hasattr(m, 'rbr_reparam'):
+                    conv = m.rbr_dense
+                    m.rbr_reparam = nn.Conv2d(
+                        conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                        conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True,
+                    )
+                    for name in ('rbr_dense', 'rbr_1x1', 'rbr_identity'):
+                        if hasattr(m, name):
+                            delattr(m, name)
+            elif type(m) is Conv and hasattr(m, 'bn'):
+                conv = m.conv
+                m.conv = nn.Conv2d(
+                    conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                    conv.padding, groups=conv.groups, bias=True,
+                )
+                delattr(m, 'bn')
+                m.forward = m.fuseforward
+            elif isinstance(m, (IDetect, IAuxDetect)):
+                m.forward = m.fuseforward
+        return self
+
     def nms(self, mode=True):  # add or remove NMS module
         present = type(self.model[-1]) is NMS  # last layer is NMS
         if mode and not present:
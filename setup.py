@@ -62,6 +62,7 @@ required = [
 extras_require = {
     "ort-cpu": ["onnxruntime"],
     "ort-gpu": ["onnxruntime-gpu"],
+    "export": ["pyarrow"],
     "dev": ["pip-tools", "pytest"],
 }
 
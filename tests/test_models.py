@@ -29,3 +29,745 @@ def test_db_shufflenet():
     out = model(input_tensor)
     print(out.keys())
     print(out['preds'][0][0].shape)
+
+
+def test_predictor_zero_copy_inputs():
+    import numpy as np
+    from torch.profiler import profile, ProfilerActivity
+    from cnstd.model.core import DetectionPredictor
+    from cnstd.utils import split_image_batch
+
+    model = gen_dbnet(
+        MODEL_CONFIGS['db_mobilenet_v3'], pretrained=False, pretrained_backbone=False
+    )
+    predictor = DetectionPredictor(model)
+    rgb_batch = np.random.randint(0, 255, (2, 2048, 1536, 3), dtype=np.uint8)
+    bgr_batch = np.ascontiguousarray(rgb_batch[..., ::-1])
+
+    # torch allocations are not seen by tracemalloc, but by the profiler
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        ori_imgs, bgr_flags, batch, _ = predictor.preprocess(
+            list(bgr_batch), (256, 256), True, 'bgr'
+        )
+    peak = max(evt.self_cpu_memory_usage for evt in prof.events())
+    # the original images are used in place, and resized as uint8: no full-size copy is made
+    assert all(np.shares_memory(img, bgr_batch) for img in ori_imgs)
+    assert peak < bgr_batch[0].nbytes
+    assert bgr_flags == [True, True]
+
+    rgb_imgs, single = split_image_batch(torch.from_numpy(rgb_batch))
+    assert not single and np.shares_memory(rgb_imgs[1], rgb_batch)
+    _, _, rgb_input, _ = predictor.preprocess(rgb_imgs, (256, 256), True, 'rgb')
+    assert torch.equal(batch, rgb_input)
+
+
+def test_predictor_resize_fallback(monkeypatch):
+    import numpy as np
+    from cnstd.model import core
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 255, (300, 200, 3), dtype=np.uint8)
+    expected = core.DetectionPredictor._resize(img, (128, 128), True)
+    torch_interpolate = torch.nn.functional.interpolate
+
+    # torch < 2.1 resizes no uint8 tensors, and torch < 1.11 has no `antialias`
+    def interpolate_1_11(
+        input, size=None, scale_factor=None, mode='nearest', align_corners=None, antialias=False
+    ):
+        if input.dtype == torch.uint8:
+            raise RuntimeError('"upsample_bilinear2d_out_frame" not implemented for \'Byte\'')
+        return torch_interpolate(input, size, scale_factor, mode, align_corners, antialias=antialias)
+
+    def interpolate_1_8(input, size=None, scale_factor=None, mode='nearest', align_corners=None):
+        return interpolate_1_11(input, size, scale_factor, mode, align_corners)
+
+    for interpolate, antialias in [(interpolate_1_11, True), (interpolate_1_8, False)]:
+        monkeypatch.setattr(torch.nn.functional, 'interpolate', interpolate)
+        core._uint8_interpolate_supported.cache_clear()
+        try:
+            assert not core._uint8_interpolate_supported()
+            out = core.DetectionPredictor._resize(img, (128, 128), True)
+        finally:
+            core._uint8_interpolate_supported.cache_clear()
+        assert out.dtype == np.uint8 and out.shape == expected.shape == (3, 128, 128)
+        if antialias:  # same as the uint8 resizing, up to rounding
+            assert np.abs(out.astype(int) - expected.astype(int)).max() <= 1
+        assert (out[:, :, 86:] == 0).all()  # the padding
+
+
+def test_predictor_inference_modes():
+    import numpy as np
+    from cnstd.model.core import DetectionPredictor
+
+    torch.manual_seed(0)
+    model = gen_dbnet(
+        MODEL_CONFIGS['db_mobilenet_v3'], pretrained=False, pretrained_backbone=False
+    )
+    imgs = list(np.random.randint(0, 255, (2, 300, 400, 3), dtype=np.uint8))
+    x = torch.rand(1, 3, 256, 256)
+    expected = DetectionPredictor(model)._runner(x)
+    for mode in ('channels_last', 'bf16'):
+        predictor = DetectionPredictor(model, inference_mode=mode)
+        # bf16 falls back to channels_last on CPUs without native support
+        assert predictor.inference_mode in (mode, 'channels_last')
+        assert torch.allclose(predictor._runner(x), expected, atol=5e-2)
+        assert len(predictor(imgs, (256, 256))) == 2
+
+
+def _random_layout_analyzer(tmp_path, **kwargs):
+    from cnstd.yolov7.consts import CATEGORY_DICT
+    from cnstd.yolov7.yolo import Model
+    from cnstd.yolov7.layout_analyzer import LayoutAnalyzer
+
+    arch_yaml = os.path.join(root_dir, 'cnstd', 'yolov7', 'yolov7-tiny-mfd.yaml')
+    torch.manual_seed(0)
+    model = Model(arch_yaml, ch=3, nc=len(CATEGORY_DICT['mfd']))
+    model_fp = str(tmp_path / 'mfd.pt')
+    torch.save(model.state_dict(), model_fp)
+    return LayoutAnalyzer('mfd', model_fp=model_fp, model_arch_yaml=arch_yaml, **kwargs)
+
+
+def _file_backed(tensor, fp):
+    """Whether the data of `tensor` is in the pages of file `fp` mapped into memory (Linux only)."""
+    with open('/proc/self/maps') as f:
+        ranges = [
+            [int(addr, 16) for addr in line.split()[0].split('-')]
+            for line in f
+            if line.rstrip().endswith(str(fp))
+        ]
+    return any(start <= tensor.data_ptr() < end for start, end in ranges)
+
+
+def _random_dbnet_ckpt(tmp_path, key_prefix=''):
+    torch.manual_seed(0)
+    model = gen_dbnet(
+        MODEL_CONFIGS['db_mobilenet_v3'], pretrained=False, pretrained_backbone=False
+    )
+    det_fp = str(tmp_path / 'det.ckpt')
+    state_dict = {key_prefix + k: v for k, v in model.state_dict().items()}
+    torch.save({'state_dict': state_dict}, det_fp)
+    return model, det_fp
+
+
+def _write_eval_index(tmp_path, names, label='20,20,120,20,120,50,20,50,text\n'):
+    import numpy as np
+    from PIL import Image
+
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    rng = np.random.default_rng(0)
+    lines = []
+    for name in names:
+        img = rng.integers(0, 255, (120, 200, 3), dtype='uint8')
+        Image.fromarray(img).save(data_dir / ('%s.png' % name))
+        (data_dir / ('%s.txt' % name)).write_text(label)
+        lines.append('%s.png\t%s.txt' % (name, name))
+    index_fp = data_dir / 'dev.tsv'
+    index_fp.write_text('\n'.join(lines) + '\n')
+    return index_fp
+
+
+def test_layout_analyzer_batch(tmp_path):
+    import numpy as np
+
+    analyzer = _random_layout_analyzer(tmp_path)
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 255, (300, 420, 3), dtype=np.uint8)
+    kwargs = dict(resized_shape=320, conf_threshold=0.05)
+
+    single = analyzer.analyze(img, **kwargs)
+    outs = analyzer.analyze([img, img.copy()], batch_size=2, **kwargs)
+    for out in outs:
+        assert len(out) == len(single)
+        for info1, info2 in zip(out, single):
+            assert np.allclose(info1['box'], info2['box'])
+
+    # images with different sizes are padded to the same shape
+    other = rng.integers(0, 255, (420, 200, 3), dtype=np.uint8)
+    outs = analyzer.analyze([img, other, img], batch_size=3, **kwargs)
+    assert len(outs) == 3
+    for info in outs[1]:
+        assert info['box'][:, 0].max() <= 200 and info['box'][:, 1].max() <= 420
+
+
+def test_layout_analyzer_onnx(tmp_path, monkeypatch):
+    from cnstd.yolov7.general import non_max_suppression
+    from cnstd.yolov7.layout_analyzer import LayoutAnalyzer, export_onnx
+
+    # torch < 2.5 has no `dynamo` argument
+    torch_export = torch.onnx.export
+
+    def old_export(
+        model,
+        args,
+        f,
+        input_names=None,
+        output_names=None,
+        dynamic_axes=None,
+        opset_version=None,
+        do_constant_folding=True,
+    ):
+        return torch_export(
+            model,
+            args,
+            f,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=do_constant_folding,
+            dynamo=False,
+        )
+
+    analyzer = _random_layout_analyzer(tmp_path)
+    # the ONNX model is exported next to the PyTorch one
+    onnx_analyzer = _random_layout_analyzer(tmp_path, model_backend='onnx')
+    assert os.path.isfile(tmp_path / 'mfd.onnx')
+    assert onnx_analyzer.stride == analyzer.stride
+
+    with monkeypatch.context() as m:
+        m.setattr(torch.onnx, 'export', old_export)
+        export_onnx(
+            analyzer.categories,
+            tmp_path / 'mfd.pt',
+            analyzer._arch_yaml,
+            tmp_path / 'mfd-nms.onnx',
+            include_nms=True,
+        )
+    nms_analyzer = LayoutAnalyzer(
+        'mfd', model_fp=tmp_path / 'mfd-nms.onnx', model_backend='onnx'
+    )
+
+    # dynamic batch size and image size
+    torch.manual_seed(0)
+    for shape in [(1, 3, 256, 320), (2, 3, 416, 224)]:
+        img = torch.rand(shape)
+        with torch.no_grad():
+            expected = analyzer.model(img)[0]
+        pred = onnx_analyzer._onnx_forward(img, 0.25, 0.45)
+        assert pred.shape == expected.shape
+        assert torch.allclose(pred, expected, atol=1e-3)
+
+        dets = nms_analyzer._onnx_forward(img, 0.25, 0.45)
+        for det, expected_det in zip(dets, non_max_suppression(expected, 0.25, 0.45)):
+            assert det.shape == expected_det.shape
+            assert torch.allclose(det[:, 4], expected_det[:, 4], atol=1e-3)
+
+
+def test_layout_analyzer_model_cache(tmp_path, monkeypatch):
+    from glob import glob
+    from cnstd.yolov7 import layout_analyzer
+    from cnstd.yolov7.torch_utils import SerializedModel
+
+    # no cache by default
+    analyzer = _random_layout_analyzer(tmp_path)
+    assert len(glob(str(tmp_path / '*.torchscript*'))) == 0
+
+    cached = _random_layout_analyzer(tmp_path, use_model_cache=True)
+    assert len(glob(str(tmp_path / '*.torchscript'))) == 1
+    # the second start loads the serialized model directly
+    cached = _random_layout_analyzer(tmp_path, use_model_cache=True)
+    assert isinstance(cached.model, SerializedModel)
+    assert cached.stride == analyzer.stride
+
+    for shape in [(1, 3, 256, 320), (3, 3, 192, 416)]:
+        img = torch.rand(shape)
+        with torch.no_grad():
+            assert torch.allclose(cached.model(img)[0], analyzer.model(img)[0], atol=1e-4)
+
+    # other categories lead to another cache
+    kwargs = dict(use_model_cache=True, model_categories=['embedding', 'isolated2'])
+    _random_layout_analyzer(tmp_path, **kwargs)
+    assert len(glob(str(tmp_path / '*.torchscript'))) == 2
+
+    # a traced model mismatching the eager one is not traced again at the next starts
+    kwargs['model_categories'] = ['embedding', 'isolated3']
+    monkeypatch.setattr(layout_analyzer, 'serialize_model', lambda model, fp: None)
+    assert not isinstance(_random_layout_analyzer(tmp_path, **kwargs).model, SerializedModel)
+    assert len(glob(str(tmp_path / '*.torchscript.mismatch'))) == 1
+
+    def _fail(model, fp):
+        raise AssertionError('traced again')
+
+    monkeypatch.setattr(layout_analyzer, 'serialize_model', _fail)
+    assert not isinstance(_random_layout_analyzer(tmp_path, **kwargs).model, SerializedModel)
+
+
+def test_batched_non_max_suppression():
+    from cnstd.yolov7.general import non_max_suppression, batched_non_max_suppression
+
+    def _rows(det):
+        return sorted(tuple(row) for row in det.tolist())
+
+    torch.manual_seed(0)
+    pred = torch.rand(4, 2000, 7)
+    pred[..., :2] *= 600
+    pred[..., 2:4] = pred[..., 2:4] * 80 + 2
+    pred[2, :, 4] = 0  # no candidates in this image
+    for multi_label in (False, True):
+        expected = non_max_suppression(pred.clone(), 0.3, 0.45, multi_label=multi_label)
+        # both branches: one NMS for the whole batch, or one NMS per image (the default here, on CPU)
+        for max_batched_nms in (10 ** 6, 0, None):
+            kwargs = dict() if max_batched_nms is None else dict(max_batched_nms=max_batched_nms)
+            dets = batched_non_max_suppression(
+                pred, 0.3, 0.45, multi_label=multi_label, **kwargs
+            )
+            assert len(dets) == len(expected)
+            for det, expected_det in zip(dets, expected):
+                assert _rows(det) == _rows(expected_det)
+
+    expected = non_max_suppression(pred.clone(), 0.3, 0.45)
+    dets = batched_non_max_suppression(pred, 0.3, 0.45, max_det=5)
+    for det, expected_det in zip(dets, expected):
+        assert torch.equal(det[:, 4], expected_det[:5, 4])
+
+
+def test_layout_analyzer_deployed_weights(tmp_path, monkeypatch):
+    import time
+    from cnstd.yolov7.common import RepConv
+    from cnstd.yolov7.consts import CATEGORY_DICT
+    from cnstd.yolov7.yolo import Model
+    from cnstd.yolov7.layout_analyzer import LayoutAnalyzer
+
+    # the tiny model, with RepConv blocks in the head as the full yolov7 model
+    with open(os.path.join(root_dir, 'cnstd', 'yolov7', 'yolov7-tiny-mfd.yaml')) as f:
+        lines = f.read().splitlines()
+    for idx, line in enumerate(lines):
+        if line.strip().startswith(('[57, 1, Conv', '[65, 1, Conv', '[73, 1, Conv')):
+            lines[idx] = line.split(', Conv,')[0] + ', RepConv, [%s, 3, 1]],' % line.split('[')[2].split(',')[0]
+    arch_yaml = tmp_path / 'rep.yaml'
+    arch_yaml.write_text('\n'.join(lines))
+
+    torch.manual_seed(0)
+    model = Model(str(arch_yaml), ch=3, nc=len(CATEGORY_DICT['mfd']))
+    assert sum(isinstance(m, RepConv) for m in model.modules()) == 3
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):  # not an identity
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+    model_fp = tmp_path / 'mfd.pt'
+    torch.save(model.state_dict(), model_fp)
+    img = torch.rand(2, 3, 192, 256)
+    with torch.no_grad():
+        expected = model.eval()(img)[0]
+
+    kwargs = dict(model_fp=str(model_fp), model_arch_yaml=str(arch_yaml))
+
+    # a reparameterization mismatching the original model is neither used nor saved
+    fuse = Model.fuse
+
+    def _broken_fuse(self):
+        fused = fuse(self)
+        fused.model[-1].m[0].bias.data += 1
+        return fused
+
+    monkeypatch.setattr(Model, 'fuse', _broken_fuse)
+    analyzer = LayoutAnalyzer('mfd', save_deployed=True, **kwargs)
+    assert not os.path.isfile(tmp_path / 'mfd-deploy.pt')
+    assert not any(m.deploy for m in analyzer.model.modules() if isinstance(m, RepConv))
+    with torch.no_grad():
+        assert torch.allclose(analyzer.model(img)[0], expected, rtol=1e-3, atol=1e-2)
+    monkeypatch.undo()
+
+    deployed_fp = str(tmp_path / 'mfd-deploy.pt')
+    analyzer = LayoutAnalyzer('mfd', **kwargs)
+    assert os.path.isfile(deployed_fp)
+    deployed = LayoutAnalyzer('mfd', **kwargs)
+    for m in (analyzer.model, deployed.model):
+        assert all(m.deploy for m in m.modules() if isinstance(m, RepConv))
+        with torch.no_grad():
+            assert torch.allclose(m(img)[0], expected, rtol=1e-3, atol=1e-2)
+    # both use the memory-mapped deployed weights, including the one which saved them
+    for loaded in (analyzer, deployed):
+        assert loaded._model_fp == deployed_fp
+        if sys.platform.startswith('linux'):
+            weight = loaded.model.model[-1].m[0].weight
+            assert _file_backed(weight, deployed_fp)
+
+    # the deployed weights of older original weights are not used
+    os.utime(deployed_fp, (time.time() - 10, time.time() - 10))
+    assert LayoutAnalyzer('mfd', save_deployed=False, **kwargs)._model_fp == str(model_fp)
+    assert LayoutAnalyzer('mfd', **kwargs)._model_fp == deployed_fp
+    assert os.path.getmtime(deployed_fp) >= os.path.getmtime(model_fp)
+
+
+def test_detect_multiscale(tmp_path, monkeypatch):
+    import numpy as np
+    from cnstd import CnStd, cn_std
+
+    _, det_fp = _random_dbnet_ckpt(tmp_path)
+    std = CnStd('db_mobilenet_v3', model_backend='pytorch', model_fp=det_fp)
+    calls, cropped = [], []
+    detect, extract_quad_crops = std.det_model.detect, cn_std.extract_quad_crops
+
+    def detect_spy(img_list, **kwargs):
+        calls.append(kwargs)
+        return detect(img_list, **kwargs)
+
+    def crops_spy(img, quads, **kwargs):
+        cropped.append(len(quads))
+        return extract_quad_crops(img, quads, **kwargs)
+
+    monkeypatch.setattr(std.det_model, 'detect', detect_spy)
+    monkeypatch.setattr(cn_std, 'extract_quad_crops', crops_spy)
+    img = np.random.default_rng(0).integers(0, 255, (256, 320, 3), dtype=np.uint8)
+    # every text region is too small, so all the tiles are refined
+    out = std.detect_multiscale(
+        img, resized_shape=128, box_score_thresh=0.0, min_text_height=1e6
+    )
+    assert len(calls) == 2 and not any(kwargs['return_cropped_image'] for kwargs in calls)
+    assert calls[0]['return_prob_map'] and not calls[1]['return_prob_map']
+    # the merged boxes are cropped once
+    assert cropped == [len(out['detected_texts'])]
+    assert 'prob_map' not in out
+    for info in out['detected_texts']:
+        assert info['cropped_img'].dtype == np.uint8
+
+
+def test_document_detector(tmp_path):
+    import numpy as np
+    from cnstd import CnStd, DocumentDetector
+    from cnstd.document_detector import _bboxes, _covered_ratios
+
+    _, det_fp = _random_dbnet_ckpt(tmp_path)
+    std = CnStd('db_mobilenet_v3', model_backend='pytorch', model_fp=det_fp)
+    detector = DocumentDetector(std, _random_layout_analyzer(tmp_path))
+
+    img = np.random.default_rng(0).integers(0, 255, (1200, 900, 3), dtype=np.uint8)
+    kwargs = dict(
+        text_resized_shape=384, mfd_resized_shape=320, box_score_thresh=0.0, conf_threshold=0.01
+    )
+    out = detector.detect(img, suppress_isolated=False, **kwargs)
+    elements = out['elements']
+    texts = [info for info in elements if info['type'] == 'text']
+    assert len(texts) > 0 and len(texts) < len(elements)
+    for info in elements:
+        assert info['box'].shape == (4, 2)
+        assert ('cropped_img' in info) == (info['type'] == 'text')
+    # formula boxes are mapped back to the original resolution
+    formula_boxes = np.stack([info['box'] for info in elements if info['type'] != 'text'])
+    assert formula_boxes[..., 0].max() > 450 and formula_boxes[..., 0].max() <= 899
+    assert formula_boxes[..., 1].max() > 600 and formula_boxes[..., 1].max() <= 1199
+
+    isolated = [info for info in elements if info['type'] == 'isolated']
+    covered = _covered_ratios(_bboxes(texts), _bboxes(isolated))
+    out = detector.detect(
+        [img, img], suppress_isolated=True, isolated_overlap_thresh=0.5, **kwargs
+    )[1]
+    assert len(out['elements']) == len(elements) - int((covered >= 0.5).sum())
+    boxes = np.array([[0, 0, 10, 10], [0, 0, 40, 10], [50, 50, 60, 60]], dtype=np.float32)
+    assert np.allclose(
+        _covered_ratios(boxes, np.array([[0, 0, 20, 20]], dtype=np.float32)), [1, 0.5, 0]
+    )
+
+    out = detector.detect(img, return_cropped_image=False, **kwargs)
+    assert all('cropped_img' not in info for info in out['elements'])
+
+
+def test_yolo_detector_stream(tmp_path):
+    import numpy as np
+    from ultralytics import YOLO
+    from cnstd.yolo_detector import YoloDetector
+
+    torch.manual_seed(0)
+    model_fp = str(tmp_path / 'yolov8n.pt')
+    YOLO('yolov8n.yaml', task='detect').save(model_fp)
+    detector = YoloDetector(model_path=model_fp)
+
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 255, (240, 320, 3), dtype=np.uint8) for _ in range(5)]
+    kwargs = dict(resized_shape=160, conf=0.0001, box_margin=3, verbose=False)
+    outs = detector.detect(imgs, **kwargs)
+    assert len(outs) == 5
+    streamed = detector.detect(iter(imgs), batch_size=2, stream=True, **kwargs)
+    assert not isinstance(streamed, list)
+    for out, out2 in zip(outs, streamed):
+        assert len(out) == len(out2)
+        for info, info2 in zip(out, out2):
+            assert info['type'] == info2['type']
+            assert np.allclose(info['box'], info2['box'], atol=1e-3)
+            assert info['box'][:, 0].max() <= 320 and info['box'][:, 1].max() <= 240
+    assert len(detector.detect(imgs[0], **kwargs)) == len(outs[0])
+
+
+def test_yolo_detector_onnx_runtime(tmp_path):
+    import numpy as np
+    from ultralytics import YOLO
+    from cnstd.yolo_detector import YoloDetector, runtime_artifact_path
+
+    torch.manual_seed(0)
+    model_fp = str(tmp_path / 'yolov8n.pt')
+    YOLO('yolov8n.yaml', task='detect').save(model_fp)
+    detector = YoloDetector(model_path=model_fp, runtime='onnx', static_resized_shape=160)
+    assert detector.runtime == 'onnx' and detector.static_resized_shape == (160, 160)
+    onnx_fp = runtime_artifact_path(model_fp, 'onnx', (160, 160))
+    assert onnx_fp.exists() and onnx_fp.parent == tmp_path
+    assert sorted(os.listdir(tmp_path)) == sorted(['yolov8n.pt', onnx_fp.name])
+
+    # the cached artifact is loaded directly
+    mtime = onnx_fp.stat().st_mtime_ns
+    detector = YoloDetector(model_path=model_fp, runtime='onnx', static_resized_shape=160)
+    assert detector.runtime == 'onnx' and onnx_fp.stat().st_mtime_ns == mtime
+
+    img = np.random.default_rng(0).integers(0, 255, (240, 320, 3), dtype=np.uint8)
+    kwargs = dict(conf=0.0001, verbose=False)
+    out = detector.detect(img, **kwargs)
+    expected = YoloDetector(model_path=model_fp).detect(img, resized_shape=160, **kwargs)
+    assert len(out) == len(expected)
+    for info, info2 in zip(out, expected):
+        assert np.allclose(info['box'], info2['box'], atol=0.5)
+
+
+def test_mmap_load_and_lazy_angle_clf(tmp_path):
+    from cnstd import CnStd
+    from cnstd.utils import load_model_params
+
+    # saved by PlTrainer, with the parameter names prefixed by `model.`
+    model, det_fp = _random_dbnet_ckpt(tmp_path, key_prefix='model.')
+    model2 = gen_dbnet(
+        MODEL_CONFIGS['db_mobilenet_v3'], pretrained=False, pretrained_backbone=False
+    )
+    load_model_params(model2, det_fp, mmap=True)
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, model2.state_dict()[k])
+    if sys.platform.startswith('linux'):
+        # the parameters are backed by the pages of the file, not copied
+        assert _file_backed(model2.prob_head[0].weight, det_fp)
+        # a plain load copies them
+        load_model_params(model, det_fp)
+        assert not _file_backed(model.prob_head[0].weight, det_fp)
+
+    # the angle classifier is only created when it is used
+    std = CnStd(
+        'db_mobilenet_v3', model_backend='pytorch', model_fp=det_fp, use_angle_clf=True
+    )
+    assert std._angle_clf is None
+    out = std.detect(torch.zeros(64, 64, 3, dtype=torch.uint8), return_cropped_image=False)
+    assert std._angle_clf is None
+    assert all('cropped_img' not in info for info in out['detected_texts'])
+
+
+def test_cli_predict_jsonl(tmp_path):
+    import json
+    from PIL import Image
+    from click.testing import CliRunner
+    from cnstd.cli import cli
+
+    _, det_fp = _random_dbnet_ckpt(tmp_path)
+
+    img_dir = tmp_path / 'imgs'
+    (img_dir / 'sub').mkdir(parents=True)
+    img = Image.new('RGB', (200, 120), color=(255, 255, 255))
+    for fp in ['a.jpg', 'sub/b.PNG', 'sub/c.png']:
+        img.save(img_dir / fp)
+    (img_dir / 'notes.txt').write_text('not an image')
+    (img_dir / 'sub' / 'broken.jpg').write_bytes(b'not an image')
+
+    for num_workers in (1, 2):
+        out_dir = tmp_path / ('out%d' % num_workers)
+        args = ['predict', '-m', 'db_mobilenet_v3', '-b', 'pytorch', '-p', det_fp]
+        args += ['--resized-shape', '128,128', '-i', str(img_dir), '-o', str(out_dir)]
+        args += ['-w', str(num_workers), '--plot']
+        result = CliRunner().invoke(cli, args, catch_exceptions=False)
+        assert result.exit_code == 0
+        with open(out_dir / 'predictions.jsonl') as f:
+            records = {os.path.relpath(r['path'], img_dir): r for r in map(json.loads, f)}
+        assert sorted(records) == ['a.jpg', 'sub/b.PNG', 'sub/broken.jpg', 'sub/c.png']
+        assert 'error' in records['sub/broken.jpg']
+        for name in ['a.jpg', 'sub/b.PNG', 'sub/c.png']:
+            record = records[name]
+            assert len(record['boxes']) == len(record['scores'])
+            assert set(record['timings']) == {'read', 'detect'}
+        assert (out_dir / 'sub' / 'c-result.png').exists()
+
+    # the failed image is retried when the job is resumed, other parameters are refused
+    result = CliRunner().invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    with open(out_dir / 'predictions.jsonl') as f:
+        lines = f.readlines()
+    assert len(lines) == 4 and 'error' in json.loads(lines[-1])
+    args[args.index('128,128')] = '256,256'
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code != 0 and isinstance(result.exception, ValueError)
+
+    # sharded jobs on a manifest, resumed after being killed, and merged
+    manifest_fp = tmp_path / 'manifest.txt'
+    manifest_fp.write_text('# images\nimgs/a.jpg\nimgs/sub/b.PNG\n\nimgs/sub/c.png\n')
+    out_dir = tmp_path / 'sharded'
+    shard_fps = []
+    for shard_index in range(2):
+        args = ['predict', '-m', 'db_mobilenet_v3', '-b', 'pytorch', '-p', det_fp]
+        args += ['--resized-shape', '128,128', '--manifest', str(manifest_fp)]
+        args += ['-o', str(out_dir), '--num-shards', '2', '--shard-index', str(shard_index)]
+        result = CliRunner().invoke(cli, args, catch_exceptions=False)
+        assert result.exit_code == 0
+        shard_fps.append(
+            str(out_dir / ('predictions.shard-%05d-of-00002.jsonl' % shard_index))
+        )
+        with open(shard_fps[-1], 'rb') as f:
+            content = f.read()
+        if content:
+            # kill the job in the middle of its last record, and resume it
+            with open(shard_fps[-1], 'wb') as f:
+                f.write(content[:-10])
+            result = CliRunner().invoke(cli, args, catch_exceptions=False)
+            assert result.exit_code == 0
+            with open(shard_fps[-1], 'rb') as f:
+                resumed = f.read()
+            # the truncated record is redone once, the others are kept as they are
+            assert resumed.count(b'\n') == content.count(b'\n')
+            last_start = content.rfind(b'\n', 0, len(content) - 1) + 1
+            assert resumed[:last_start] == content[:last_start]
+
+    merged_fp = str(tmp_path / 'merged.jsonl')
+    result = CliRunner().invoke(cli, ['merge', '-o', merged_fp] + shard_fps)
+    assert result.exit_code == 0
+    with open(merged_fp) as f:
+        keys = sorted(json.loads(line)['key'] for line in f)
+    assert keys == ['imgs/a.jpg', 'imgs/sub/b.PNG', 'imgs/sub/c.png']
+
+
+def test_cli_analyze_jsonl(tmp_path):
+    import json
+    from PIL import Image
+    from click.testing import CliRunner
+    from cnstd.cli import cli
+
+    _random_layout_analyzer(tmp_path)
+    arch_yaml = os.path.join(root_dir, 'cnstd', 'yolov7', 'yolov7-tiny-mfd.yaml')
+    img_dir = tmp_path / 'imgs'
+    img_dir.mkdir()
+    rng = __import__('numpy').random.default_rng(0)
+    for fp in ['a.jpg', 'b.png']:
+        Image.fromarray(rng.integers(0, 255, (160, 200, 3), dtype='uint8')).save(img_dir / fp)
+
+    out_dir = tmp_path / 'out'
+    args = ['analyze', '-m', 'mfd', '-p', str(tmp_path / 'mfd.pt'), '-y', arch_yaml]
+    args += ['-i', str(img_dir), '-o', str(out_dir), '--resized-shape', '320']
+    args += ['--conf-thresh', '0.01', '-w', '2']
+    result = CliRunner().invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    with open(out_dir / 'analysis.jsonl') as f:
+        records = sorted(map(json.loads, f), key=lambda r: r['key'])
+    assert [r['key'] for r in records] == ['a.jpg', 'b.png']
+    for record in records:
+        assert len(record['elements']) > 0
+        assert {'type', 'box', 'score'} == set(record['elements'][0])
+    assert (out_dir / 'analysis-b.png').exists()
+
+
+def test_cli_evaluate(tmp_path):
+    import json
+    import numpy as np
+    from click.testing import CliRunner
+    from cnstd.cli import cli
+    from cnstd.utils import evaluate_image
+
+    # the predictions falling into an ignored ground truth are left out
+    gt_polys = np.array(
+        [[[10, 10], [90, 10], [90, 30], [10, 30]], [[10, 50], [90, 50], [90, 70], [10, 70]]]
+    )
+    res = evaluate_image(gt_polys, [False, True], gt_polys[::-1] + 1)
+    assert (res['num_gts'], res['num_preds'], res['num_matches']) == (1, 1, 1)
+
+    _, det_fp = _random_dbnet_ckpt(tmp_path)
+
+    index_fp = _write_eval_index(
+        tmp_path, ['a', 'b', 'c'], label='20,20,120,20,120,50,20,50,text\n1,1,9,1,9,9,1,9,###\n'
+    )
+    data_dir = index_fp.parent
+    (data_dir / 'c.png').write_bytes((data_dir / 'a.png').read_bytes())  # same content as a.png
+    with open(index_fp, 'a') as f:
+        f.write('missing.png\ta.txt\n')
+
+    out_dir = tmp_path / 'eval'
+    args = ['evaluate', '-m', 'db_mobilenet_v3', '-b', 'pytorch', '-p', det_fp]
+    args += ['--resized-shape', '128,128', '-i', str(index_fp), '-o', str(out_dir)]
+    args += ['--batch-size', '2', '--box-score-thresh', '0.0']
+    result = CliRunner().invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    with open(out_dir / 'summary.json') as f:
+        summary = json.load(f)
+    assert summary['num_images'] == 3 and summary['num_failed'] == 1
+    assert summary['num_gts'] == 3
+    assert summary['inference']['num_predicted'] == 2  # a.png and c.png are predicted once
+    assert set(summary['latency']) == {'read', 'detect'}
+    for name in ('precision', 'recall', 'hmean', 'mean_iou'):
+        assert 0 <= summary[name] <= 1
+    with open(out_dir / 'per_image.jsonl') as f:
+        per_image = {r['key']: r for r in map(json.loads, f)}
+    assert 'error' in per_image['missing.png']
+    assert per_image['a.png']['num_preds'] == per_image['c.png']['num_preds']
+    cache_fp = summary['cache_fp']
+    with open(cache_fp) as f:
+        cached = f.read()
+
+    # other metric settings reuse the cached predictions
+    result = CliRunner().invoke(
+        cli, args + ['--iou-thresh', '0.3', '--min-score', '1.1'], catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    with open(out_dir / 'summary.json') as f:
+        summary = json.load(f)
+    assert summary['inference']['num_predicted'] == 0
+    assert summary['num_preds'] == 0 and summary['precision'] == 0
+    with open(cache_fp) as f:
+        assert f.read() == cached
+
+
+def test_cli_sweep(tmp_path):
+    import json
+    import numpy as np
+    from click.testing import CliRunner
+    from cnstd import CnStd
+    from cnstd.cli import cli
+    from cnstd.utils import replay_prob_map
+
+    _, det_fp = _random_dbnet_ckpt(tmp_path)
+
+    index_fp = _write_eval_index(tmp_path, ['a', 'b'])
+    data_dir = index_fp.parent
+
+    # replaying the post-processing with the detection parameters gives the detected boxes
+    std = CnStd('db_mobilenet_v3', model_backend='pytorch', model_fp=det_fp)
+    out = std.detect(
+        str(data_dir / 'a.png'), resized_shape=(128, 128), box_score_thresh=0.0,
+        return_prob_map=True,
+    )
+    assert out['prob_map']['map'].dtype == np.uint8
+    replayed = replay_prob_map(out['prob_map'])
+    assert len(replayed['detected_texts']) == len(out['detected_texts'])
+    for info, expected in zip(replayed['detected_texts'], out['detected_texts']):
+        np.testing.assert_allclose(info['box'], expected['box'], atol=2)
+
+    out_dir = tmp_path / 'sweep'
+    cache_dir = tmp_path / 'cache'
+    args = ['sweep', '-m', 'db_mobilenet_v3', '-b', 'pytorch', '-p', det_fp]
+    args += ['--resized-shape', '128,128', '-i', str(index_fp), '-o', str(out_dir)]
+    args += ['--cache-dir', str(cache_dir)]
+    args += ['-g', 'bin_thresh=0.2,0.6;box_score_thresh=0.0,1.1']
+    result = CliRunner().invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    with open(out_dir / 'sweep.jsonl') as f:
+        points = [json.loads(line) for line in f]
+    assert len(points) == 4
+    assert points[0]['hmean'] >= points[-1]['hmean']
+    for point in points:
+        assert point['num_images'] == 2 and point['num_gts'] == 2
+        if point['params']['box_score_thresh'] > 1:
+            assert point['num_preds'] == 0
+    cache_fps = sorted(cache_dir.glob('prob-maps-*/*.npz'))
+    assert len(cache_fps) == 2
+    mtimes = [fp.stat().st_mtime_ns for fp in cache_fps]
+
+    # other grids reuse the cached probability maps
+    args[-1] = 'unclip_ratio=1.5,2.5;kernel_size=3'
+    result = CliRunner().invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+    assert [fp.stat().st_mtime_ns for fp in cache_fps] == mtimes
+    with open(out_dir / 'sweep.jsonl') as f:
+        assert len(f.readlines()) == 2
+
+    args[-1] = 'use_dilation=true'  # only for the ppocr models
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code != 0
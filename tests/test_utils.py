@@ -1,5 +1,9 @@
 # coding: utf-8
 
+import os
+import subprocess
+import sys
+
 from cnstd.utils.utils import sort_boxes
 
 
@@ -19,3 +23,704 @@ def test_sort_boxes():
     boxes = [{'box': four_to_eight(box)} for box in boxes]
     out = sort_boxes(boxes, key='box')
     print(out)
+
+
+def test_dedup_boxes():
+    from cnstd.utils.utils import dedup_boxes
+
+    boxes = [
+        [0, 0, 100, 20],
+        [10, 2, 50, 18],  # inside the first box
+        [90, 0, 200, 20],  # overlaps the first box a little
+        [300, 0, 310, 10],
+        [290, 0, 320, 12],  # covers the previous box
+    ]
+    infos = [{'box': four_to_eight(box)} for box in boxes]
+    assert dedup_boxes(infos, threshold=0.5) == [infos[0], infos[2], infos[4]]
+    # the box with the lower coverage ratio is kept
+    assert dedup_boxes(infos, threshold=0.05) == [infos[2], infos[4]]
+    assert dedup_boxes(infos[:1], threshold=0.1) == infos[:1]
+
+
+def test_vectorized_db_postprocess():
+    import cv2
+    import numpy as np
+
+    from cnstd.ppocr import PPDetector
+    from cnstd.ppocr.postprocess.db_postprocess import DBPostProcess
+    from cnstd.utils import sort_box_points
+    from cnstd.utils.geometry import rbboxes_to_polygons, sort_polygons_points
+
+    # both tie-breaks of the point order, for the two left-most points with the same y
+    polygons = np.array(
+        [[[10, 5], [30, 5], [30, 20], [10, 20]], [[0, 10], [20, 0], [20, 20], [5, 10]]], dtype=np.float32
+    )
+    assert not np.array_equal(
+        sort_polygons_points(polygons[1:]), sort_polygons_points(polygons[1:], swap_ties=False)
+    )
+    for polygon, sorted_pts, ordered_pts in zip(
+        polygons, sort_polygons_points(polygons), sort_polygons_points(polygons, swap_ties=False)
+    ):
+        assert np.array_equal(np.array(sort_box_points(polygon)), sorted_pts)
+        assert np.array_equal(PPDetector.order_points_clockwise(None, polygon), ordered_pts)
+
+    rbboxes = np.array([[50, 40, 60, 12, 10], [150, 120, 80, 20, -30]], dtype=np.float32)
+    for rbbox, polygon in zip(rbboxes, rbboxes_to_polygons(rbboxes)):
+        x, y, w, h, alpha = rbbox
+        assert np.allclose(cv2.boxPoints(((x, y), (w, h), alpha)), polygon, atol=1e-3)
+
+    pred = np.zeros((200, 240), dtype=np.float32)
+    cv2.fillPoly(pred, [cv2.boxPoints(((60, 50), (80, 16), 5)).astype(np.int32)], 0.9)
+    cv2.fillPoly(pred, [cv2.boxPoints(((150, 140), (100, 20), -20)).astype(np.int32)], 0.7)
+    outs_dict = {'maps': np.stack([pred, pred])[:, None]}
+    shape_list = np.array([[400, 480, 0.5, 0.5]] * 2)
+    loop_out = DBPostProcess(vectorized=False)(outs_dict, shape_list)
+    vec_out = DBPostProcess(vectorized=True, num_workers=2)(outs_dict, shape_list)
+    for loop_res, vec_res in zip(loop_out, vec_out):
+        assert len(loop_res['points']) == len(vec_res['points']) == 2
+        assert np.allclose(sorted(loop_res['scores']), sorted(vec_res['scores']), atol=0.05)
+        loop_pts = sorted(map(lambda p: p.tolist(), loop_res['points']))
+        vec_pts = sorted(map(lambda p: p.tolist(), vec_res['points']))
+        assert np.abs(np.array(loop_pts) - np.array(vec_pts)).max() <= 3
+
+
+def test_extract_quad_crops():
+    import numpy as np
+
+    from cnstd.utils import extract_quad_crops
+    from cnstd.ppocr.utility import get_rotate_crop_image
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 255, (300, 400, 3), dtype=np.uint8)
+    quads = np.array(
+        [
+            [[10, 20], [110, 20], [110, 50], [10, 50]],  # axis-aligned
+            [[50, 100], [250, 130], [245, 165], [45, 135]],  # rotated
+            [[300, 10], [330, 10], [330, 120], [300, 120]],  # vertical
+        ],
+        dtype=np.float32,
+    )
+    crops = extract_quad_crops(img, quads, interpolation='cubic', num_workers=2)
+    assert np.array_equal(crops[0], img[20:50, 10:110])
+    for quad, crop in zip(quads, crops):
+        expected = get_rotate_crop_image(img, quad.copy()).astype(np.uint8)
+        assert crop.dtype == np.uint8
+        assert crop.shape == expected.shape
+        assert np.abs(crop.astype(int) - expected).max() <= 1
+
+
+def test_pack_crops():
+    import numpy as np
+
+    from cnstd.utils import pack_crops
+
+    crops = [
+        np.full((16, 40, 3), 1, dtype=np.uint8),
+        np.full((64, 64, 3), 2, dtype=np.uint8),
+        np.full((10, 3, 3), 3, dtype=np.uint8),
+    ]
+    buffer, offsets, widths = pack_crops(crops, 32, dtype='float32')
+    assert buffer.dtype == np.float32 and buffer.flags['C_CONTIGUOUS']
+    assert widths.tolist() == [80, 32, 10]
+    assert offsets.tolist() == [0, 80, 112]
+    assert buffer.shape == (32, 128, 3)
+    for idx, (offset, width) in enumerate(zip(offsets, widths)):
+        assert (buffer[:, offset : offset + width] == idx + 1).all()
+    assert (buffer[:, 122:] == 0).all()
+
+    # the float32 buffer holds the same values as the uint8 one
+    rng = np.random.default_rng(0)
+    crops = [rng.integers(0, 255, (h, w, 3), dtype=np.uint8) for h, w in [(20, 50), (40, 30)]]
+    uint8_buffer = pack_crops(crops, 32, pad_value=7)[0]
+    float_buffer = pack_crops(crops, 32, dtype='float32', pad_value=7)[0]
+    assert np.array_equal(uint8_buffer.astype(np.float32), float_buffer)
+
+
+def test_reuse_detections():
+    import cv2
+    import numpy as np
+
+    from cnstd.utils import reuse_detections
+
+    rng = np.random.default_rng(0)
+    base = np.full((480, 640, 3), 255, dtype=np.uint8)
+    for _ in range(20):
+        x, y = rng.integers(20, 560), rng.integers(20, 420)
+        cv2.rectangle(base, (x, y), (x + 60, y + 20), (0, 0, 0), -1)
+    shifted = np.full_like(base, 255)
+    shifted[8:, 12:] = base[:-8, :-12]
+    changed_region = shifted.copy()
+    cv2.rectangle(changed_region, (500, 400), (600, 440), (0, 0, 255), -1)
+    frames = [base, base.copy(), shifted, changed_region, 255 - base]
+
+    calls = []
+
+    def detect_fn(img):
+        calls.append(img.shape[:2])
+        box = np.array([[100, 100], [160, 100], [160, 120], [100, 120]], dtype=np.float32)
+        return [{'box': box}] if img.shape[0] > 120 and img.shape[1] > 160 else []
+
+    outs = list(reuse_detections(frames, detect_fn))
+    statuses = [status for _, status, _ in outs]
+    assert statuses == ['keyframe', 'static', 'shifted', 'region', 'keyframe']
+    # revealed borders of the shifted frame, and the changed region
+    assert len(calls) == 5
+    assert all(h * w < 480 * 640 / 4 for h, w in calls[1:4])
+    assert np.array_equal(outs[2][2][0]['box'][0], [112, 108])
+
+    # scrolling a page over several frames gives the boxes of a full detection
+    page = np.full((1200, 640, 3), 255, dtype=np.uint8)
+    for _ in range(40):
+        x, y = rng.integers(20, 560), rng.integers(20, 1160)
+        cv2.rectangle(page, (x, y), (x + 60, y + 20), (0, 0, 0), -1)
+    frames = [page[top : top + 480] for top in range(0, 400, 40)]
+
+    def detect_rects(img):
+        mask = (img[:, :, 0] < 128).astype(np.uint8)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        infos = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            box = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]], dtype=np.float32)
+            infos.append({'box': box, 'crop': img[y : y + h, x : x + w]})
+        return infos
+
+    def rects(infos):
+        return sorted(np.asarray(info['box']).reshape(-1).tolist() for info in infos)
+
+    outs = list(reuse_detections(frames, detect_rects))
+    assert [status for _, status, _ in outs] == ['keyframe'] + ['shifted'] * (len(frames) - 1)
+    for frame, (_, _, box_infos) in zip(frames, outs):
+        assert rects(box_infos) == rects(detect_rects(frame))
+        for info in box_infos:  # the reused crops are still those of the boxes
+            x0, y0 = np.asarray(info['box']).reshape(-1, 2).min(axis=0).astype(int)
+            h, w = info['crop'].shape[:2]
+            assert np.array_equal(info['crop'], frame[y0 : y0 + h, x0 : x0 + w])
+
+
+def test_iter_img_pages(tmp_path):
+    import numpy as np
+    import pytest
+    from PIL import Image
+
+    from cnstd.utils import iter_img_pages, prefetch
+
+    pages = [Image.new('L', (40 + 10 * idx, 30), color=idx * 50) for idx in range(3)]
+    tiff_fp = str(tmp_path / 'pages.tif')
+    pages[0].save(tiff_fp, save_all=True, append_images=pages[1:])
+
+    outs = list(prefetch(iter_img_pages([tiff_fp, tiff_fp])))
+    assert [(fp, idx) for fp, idx, _ in outs] == [(tiff_fp, idx) for idx in range(3)] * 2
+    assert [page.size for _, _, page in outs[:3]] == [(40, 30), (50, 30), (60, 30)]
+    assert all(page.mode == 'RGB' for _, _, page in outs)
+    assert np.asarray(outs[2][2])[0, 0, 0] == 100
+
+    with pytest.raises(FileNotFoundError):
+        list(prefetch(iter_img_pages(str(tmp_path / 'missing.tif'))))
+
+
+def test_merge_refined_boxes():
+    import numpy as np
+
+    from cnstd.utils import (
+        split_refine_tiles,
+        prob_map_text_regions,
+        select_refine_tiles,
+        merge_refined_boxes,
+    )
+
+    def rect(xmin, ymin, xmax, ymax, score):
+        box = [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]]
+        return {'box': np.array(box, dtype=np.float32), 'score': score}
+
+    tiles = split_refine_tiles((1000, 1000), 2.0, overlap=0.1)
+    assert tiles == [(0, 0, 550, 550), (450, 0, 1000, 550), (0, 450, 550, 1000), (450, 450, 1000, 1000)]
+
+    coarse = [
+        rect(100, 100, 400, 200, 0.9),  # large text
+        rect(100, 800, 300, 810, 0.8),  # small text
+        rect(300, 300, 700, 320, 0.25),  # borderline score
+    ]
+    selected, flags = select_refine_tiles(
+        coarse, tiles, 0.5, min_text_height=12, box_score_thresh=0.3
+    )
+    assert flags.tolist() == [False, True, True]
+    assert selected == [0, 1, 2]
+
+    # small text of the probability map, too small to give a box, in the last tile
+    prob_map = np.zeros((500, 500), dtype=np.float32)
+    prob_map[50:100, 50:200] = 0.9  # large text
+    prob_map[400:403, 300:360] = 0.8  # small text
+    centers, heights = prob_map_text_regions(
+        prob_map, (2.0, 2.0), bin_thresh=0.3, unclip_ratio=1.5
+    )
+    assert np.allclose(centers, [[249, 149], [659, 802]])
+    assert heights[0] > 2 * 50 and heights[1] * 0.5 < 12
+    selected, flags = select_refine_tiles(
+        coarse,
+        tiles,
+        0.5,
+        min_text_height=12,
+        box_score_thresh=0.3,
+        text_regions=(centers, heights),
+    )
+    assert flags.tolist() == [False, True, True]
+    assert selected == [0, 1, 2, 3]
+
+    refined = [
+        # tile 0: the large text again, and the left part of the borderline line
+        [rect(100, 100, 400, 200, 0.9), rect(300, 300, 550, 322, 0.6)],
+        # tile 1: the right part of the borderline line
+        [rect(0, 301, 250, 321, 0.7)],
+        # tile 2: nothing found
+        [],
+    ]
+    kept, new = merge_refined_boxes(
+        coarse, flags, refined, [tiles[idx] for idx in selected], box_score_thresh=0.3
+    )
+    assert [info['score'] for info in kept] == [0.9, 0.8]
+    assert len(new) == 1
+    assert np.array_equal(new[0]['box'][[0, 2]], [[300, 300], [700, 322]])
+    assert new[0]['score'] == 0.7
+
+
+def test_inference_runner_fallback():
+    import torch
+
+    from cnstd.utils import InferenceRunner
+
+    class ToyModel(torch.nn.Module):
+        def __init__(self, broken):
+            super().__init__()
+            self.conv = torch.nn.Conv2d(3, 4, 3, padding=1)
+            self.broken = broken
+
+        def forward(self, x):
+            out = self.conv(x)
+            if self.broken and x.is_contiguous(memory_format=torch.channels_last):
+                out = out + 1
+            return out
+
+    x = torch.rand(2, 3, 16, 16)
+    runner = InferenceRunner(ToyModel(broken=False), 'channels_last')
+    assert runner.check_parity(x)
+    assert runner.inference_mode == 'channels_last'
+    assert torch.allclose(runner(x), runner.module(x), atol=1e-5)
+
+    runner = InferenceRunner(ToyModel(broken=True), 'channels_last')
+    assert not runner.check_parity(x)
+    assert runner.inference_mode == 'eager'
+    assert runner.module.conv.weight.is_contiguous()
+
+
+def test_inference_runner_compiled_buckets():
+    import torch
+
+    from cnstd.utils import InferenceRunner
+
+    limit_name = 'recompile_limit'
+    if not hasattr(torch._dynamo.config, limit_name):
+        limit_name = 'cache_size_limit'
+    limit = getattr(torch._dynamo.config, limit_name)
+
+    model = torch.nn.Conv2d(3, 4, 3, padding=1)
+    runner = InferenceRunner(model, 'compiled', max_shape_buckets=limit + 1)
+    with torch.no_grad():
+        for batch_size in (3, 4):  # both in the bucket of 4 images
+            x = torch.rand(batch_size, 3, 16, 16)
+            out = runner(x)
+            assert out.shape == (batch_size, 4, 16, 16)
+            assert torch.allclose(out, model(x), atol=1e-4)
+    assert runner._compiled_shapes == {(4, 3, 16, 16)}
+    # the recompile limit of dynamo is not changed outside of the calls
+    assert getattr(torch._dynamo.config, limit_name) == limit
+
+
+def _serve_dir(directory):
+    """A local HTTP server supporting range requests, recording the `Range` headers of the requests."""
+    import functools
+    import http.server
+    import threading
+
+    requests_log = []
+
+    class RangeHandler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requests_log.append(self.headers.get('Range'))
+            fp = self.translate_path(self.path)
+            if not os.path.isfile(fp):
+                self.send_error(404)
+                return
+            with open(fp, 'rb') as f:
+                data = f.read()
+            start = 0
+            if self.headers.get('Range'):
+                start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(data) - start))
+            self.end_headers()
+            self.wfile.write(data[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(RangeHandler, directory=str(directory))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, requests_log
+
+
+def test_get_model_file_from_mirror(tmp_path, monkeypatch):
+    import hashlib
+    import threading
+    import zipfile
+
+    import pytest
+    from cnstd.consts import format_hf_hub_url
+    from cnstd.utils.utils import get_model_file, ModelDownloadingError
+
+    weights = os.urandom(300000)
+    mirror_dir = tmp_path / 'mirror'
+    mirror_dir.mkdir()
+    with zipfile.ZipFile(mirror_dir / 'model.zip', 'w') as zf:
+        zf.writestr('model/weights.ckpt', weights)
+    sha1 = hashlib.sha1((mirror_dir / 'model.zip').read_bytes()).hexdigest()
+    url = format_hf_hub_url('model.zip', sha1=sha1)
+
+    server, requests_log = _serve_dir(mirror_dir)
+    try:
+        monkeypatch.setenv(
+            'CNSTD_MODEL_MIRROR', 'http://127.0.0.1:%d/' % server.server_address[1]
+        )
+        # an interrupted download is resumed
+        root = tmp_path / 'resume'
+        root.mkdir()
+        (root / 'model.zip.part').write_bytes((mirror_dir / 'model.zip').read_bytes()[:1000])
+        assert get_model_file(url, root / 'model') == str(root / 'model')
+        assert (root / 'model' / 'weights.ckpt').read_bytes() == weights
+        assert requests_log == ['bytes=1000-']
+        assert not (root / 'model.zip').exists() and not (root / 'model.zip.part').exists()
+
+        # concurrent workers download the file once
+        root = tmp_path / 'concurrent'
+        threads = [
+            threading.Thread(target=get_model_file, args=(url, root / 'model'))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert (root / 'model' / 'weights.ckpt').read_bytes() == weights
+        assert len(requests_log) == 2
+
+        with pytest.raises(ModelDownloadingError):
+            get_model_file(
+                format_hf_hub_url('model.zip', sha1='0' * 40), tmp_path / 'bad' / 'model'
+            )
+        assert not (tmp_path / 'bad' / 'model.zip').exists()
+    finally:
+        server.shutdown()
+
+    # a local directory as the mirror
+    monkeypatch.setenv('CNSTD_MODEL_MIRROR', str(mirror_dir))
+    assert get_model_file(url, tmp_path / 'local' / 'model')
+    assert (tmp_path / 'local' / 'model' / 'weights.ckpt').read_bytes() == weights
+
+
+# seconds; importing torch alone takes longer than this
+IMPORT_TIME_BUDGET = 1.5
+
+
+def test_import_time():
+    code = (
+        'import sys, time\n'
+        't = time.perf_counter()\n'
+        'import cnstd\n'
+        'from cnstd import CnStd, PPDetector\n'
+        'print(time.perf_counter() - t)\n'
+        'print(sorted(m for m in ("torch", "torchvision", "scipy", "pandas", "matplotlib") if m in sys.modules))\n'
+    )
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run(
+        [sys.executable, '-c', code], cwd=root_dir, capture_output=True, text=True, check=True
+    ).stdout.splitlines()
+    assert out[1] == '[]'
+    assert float(out[0]) < IMPORT_TIME_BUDGET
+
+    # the heavy modules are still imported on demand
+    code = 'import cnstd, torch; print(cnstd.Detector.__module__, cnstd.LayoutAnalyzer.__name__)'
+    out = subprocess.run(
+        [sys.executable, '-c', code], cwd=root_dir, capture_output=True, text=True, check=True
+    ).stdout
+    assert out.split() == ['cnstd.detector', 'LayoutAnalyzer']
+
+
+def test_job_log_resume_and_merge(tmp_path):
+    import json
+    from cnstd.utils import JobLog, merge_job_logs, shard_index_of, shard_output_path
+
+    keys = ['dir%d/img%d.jpg' % (i % 3, i) for i in range(40)]
+    shards = [shard_index_of(key, 3) for key in keys]
+    # deterministic, and every shard gets some keys
+    assert shards == [shard_index_of(key, 3) for key in keys]
+    assert set(shards) == {0, 1, 2}
+
+    fps = [shard_output_path(tmp_path, 'predictions', 3, idx) for idx in range(3)]
+    assert os.path.basename(fps[1]) == 'predictions.shard-00001-of-00003.jsonl'
+    for idx, fp in enumerate(fps):
+        with JobLog(fp) as job_log:
+            for key, shard in zip(keys, shards):
+                if shard == idx and not job_log.is_done(key):
+                    job_log.write({'key': key, 'score': 1.0})
+                    if idx == 0 and len(job_log.done) == 3:
+                        break  # the job is killed
+
+    # a partial last line is left by the killed job
+    with open(fps[0], 'ab') as f:
+        f.write(b'{"key": "dir0/img')
+    with JobLog(fps[0]) as job_log:
+        assert len(job_log.done) == 3
+        for key, shard in zip(keys, shards):
+            if shard == 0 and not job_log.is_done(key):
+                job_log.write({'key': key, 'score': 1.0})
+
+    merged_fp = str(tmp_path / 'merged.jsonl')
+    assert merge_job_logs(fps + [fps[0]], merged_fp) == len(keys)
+    with open(merged_fp) as f:
+        merged = [json.loads(line)['key'] for line in f]
+    assert sorted(merged) == sorted(keys)
+
+    with JobLog(fps[0], resume=False) as job_log:
+        assert len(job_log.done) == 0
+    assert os.path.getsize(fps[0]) == 0
+
+
+def test_job_log_header_and_retry(tmp_path):
+    import json
+    import pytest
+    from cnstd.utils import JobLog, merge_job_logs, read_job_header
+
+    fp = str(tmp_path / 'predictions.jsonl')
+    header = {'input': '/data/a', 'params': '0123'}
+    with JobLog(fp, header=header) as job_log:
+        job_log.write({'key': 'a.jpg', 'score': 1.0})
+        job_log.write({'key': 'b.jpg', 'error': 'OSError: broken'})
+    assert read_job_header(fp) == header
+
+    # another input or other parameters never resume the log
+    for other in ({'input': '/data/b', 'params': '0123'}, {'input': '/data/a', 'params': '4567'}):
+        with pytest.raises(ValueError):
+            JobLog(fp, header=other).open()
+    with open(fp) as f:
+        assert len(f.readlines()) == 2
+
+    # the failed records are retried, without duplicating the records
+    with JobLog(fp, header=header) as job_log:
+        assert job_log.done == {'a.jpg'}
+        job_log.write({'key': 'b.jpg', 'score': 0.5})
+    with open(fp) as f:
+        assert [json.loads(line)['key'] for line in f] == ['a.jpg', 'b.jpg']
+
+    # starting over takes the new header
+    other = {'input': '/data/b', 'params': '0123'}
+    with JobLog(fp, resume=False, header=other) as job_log:
+        job_log.write({'key': 'c.jpg', 'score': 1.0})
+    assert read_job_header(fp) == other
+
+    # logs of different jobs are not merged
+    fp2 = str(tmp_path / 'other.jsonl')
+    with JobLog(fp2, header=header) as job_log:
+        job_log.write({'key': 'a.jpg', 'score': 1.0})
+    with pytest.raises(ValueError):
+        merge_job_logs([fp, fp2], str(tmp_path / 'merged.jsonl'))
+
+
+def test_result_exporter(tmp_path):
+    import numpy as np
+    import pytest
+
+    pytest.importorskip('pyarrow')
+    from cnstd.utils import CropBlobReader, ResultExporter, ResultReader
+
+    rng = np.random.RandomState(0)
+
+    def fake_result(num_boxes):
+        return {
+            'rotated_angle': 0.0,
+            'detected_texts': [
+                {
+                    'box': rng.rand(4, 2).astype(np.float32) * 100,
+                    'score': float(rng.rand()),
+                    'cropped_img': rng.randint(0, 256, (8 + i, 20, 3), dtype=np.uint8),
+                }
+                for i in range(num_boxes)
+            ],
+        }
+
+    results = {'img%d.jpg' % i: fake_result(i % 4) for i in range(10)}
+    for crop_format, suffix in [('raw', 'arrow'), ('png', 'parquet')]:
+        output_fp = tmp_path / ('results-%s.%s' % (crop_format, suffix))
+        with ResultExporter(output_fp, crop_format=crop_format, batch_size=3) as exporter:
+            for image_id, result in results.items():
+                exporter.add(image_id, result)
+        assert exporter.num_images == len(results)
+
+        with ResultReader(output_fp) as reader:
+            table = reader.table
+            # one row per box, and one row for each image without boxes
+            assert len(reader) == sum(max(len(r['detected_texts']), 1) for r in results.values())
+            rows = table.to_pylist()
+            for row_idx, row in enumerate(rows):
+                box_infos = results[row['image_id']]['detected_texts']
+                if row['box_idx'] is None:
+                    assert len(box_infos) == 0 and reader.crop(row_idx) is None
+                    continue
+                info = box_infos[row['box_idx']]
+                np.testing.assert_allclose(row['box'], info['box'].reshape(-1), rtol=1e-6)
+                assert row['score'] == pytest.approx(info['score'])
+                np.testing.assert_array_equal(reader.crop(row_idx), info['cropped_img'])
+
+        # one crop is fetched with its (offset, length) only
+        row = next(row for row in rows if row['crop_offset'] is not None)
+        with CropBlobReader(tmp_path / ('results-%s.crops' % crop_format), crop_format) as blob:
+            crop = blob.get(
+                row['crop_offset'],
+                row['crop_length'],
+                (row['crop_height'], row['crop_width'], row['crop_channels']),
+            )
+            assert crop.shape == (row['crop_height'], row['crop_width'], 3)
+            del crop
+
+
+def test_localization_matching():
+    import numpy as np
+    from scipy.optimize import linear_sum_assignment
+
+    from cnstd.utils import box_overlap_pairs, match_boxes, polygon_iou, LocalizationConfusion
+    from cnstd.utils.geometry import rbbox_to_polygon
+
+    rng = np.random.RandomState(0)
+
+    def random_polys(num):
+        rboxes = np.concatenate(
+            (
+                rng.rand(num, 2) * 500,
+                rng.rand(num, 1) * 80 + 10,
+                rng.rand(num, 1) * 20 + 5,
+                rng.rand(num, 1) * 30 - 15,
+            ),
+            axis=1,
+        )
+        return np.stack([rbbox_to_polygon(rbox) for rbox in rboxes]).astype(np.float32)
+
+    gt_polys = random_polys(120)
+    pred_polys = gt_polys[:100] + rng.randn(100, 4, 2).astype(np.float32) * 3
+    pred_polys = np.concatenate((pred_polys, random_polys(30)))
+
+    # the spatial index finds exactly the overlapping extents
+    extents = lambda polys: np.concatenate((polys.min(axis=1), polys.max(axis=1)), axis=1)
+    gt_boxes, pred_boxes = extents(gt_polys), extents(pred_polys)
+    idx_1, idx_2 = box_overlap_pairs(gt_boxes, pred_boxes)
+    dense = (
+        (gt_boxes[:, None, 0] < pred_boxes[None, :, 2])
+        & (pred_boxes[None, :, 0] < gt_boxes[:, None, 2])
+        & (gt_boxes[:, None, 1] < pred_boxes[None, :, 3])
+        & (pred_boxes[None, :, 1] < gt_boxes[:, None, 3])
+    )
+    assert set(zip(idx_1.tolist(), idx_2.tolist())) == set(zip(*np.nonzero(dense)))
+
+    # same matches as the dense assignment
+    all_1, all_2 = [a.reshape(-1) for a in np.indices(dense.shape)]
+    iou_mat = polygon_iou(gt_polys, pred_polys, all_1, all_2).reshape(dense.shape)
+    iou_mat[iou_mat < 0.5] = 0
+    rows, cols = linear_sum_assignment(-iou_mat)
+    expected = {(r, c) for r, c in zip(rows, cols) if iou_mat[r, c] >= 0.5}
+    res = match_boxes(gt_polys, pred_polys, iou_thresh=0.5)
+    assert set(zip(res['gt_indices'].tolist(), res['pred_indices'].tolist())) == expected
+    assert 80 < len(expected) <= 100
+
+    # a rotated box matches itself, and the metrics are per box
+    metric = LocalizationConfusion(rotated_bbox=True, mask_shape=(500, 500))
+    rboxes = np.array([[100, 100, 80, 20, 10], [300, 200, 60, 15, -5]], dtype=np.float32)
+    gts = [np.stack([rbbox_to_polygon(rbox) for rbox in rboxes])]
+    norm_preds = rboxes[:1].copy()
+    norm_preds[:, :4] /= 500
+    res = metric.update(gts, [norm_preds])
+    assert res['precision'] > 0.99 and abs(res['recall'] - 0.5) < 1e-3
+    assert abs(metric.summary()['hmean'] - 2 / 3) < 1e-3
+
+    metric = LocalizationConfusion(rotated_bbox=False, mask_shape=(500, 500))
+    gts = [[np.array([[10, 10], [110, 10], [110, 40], [10, 40]])], []]
+    res = metric.update(gts, [np.array([[0.02, 0.02, 0.22, 0.08]]), np.array([[0.5, 0.5, 0.6, 0.6]])])
+    assert res['recall'] > 0.99 and abs(res['precision'] - 0.5) < 1e-3
+
+
+def test_replay_prob_map(tmp_path):
+    import numpy as np
+    from cnstd.utils import (
+        quantize_prob_map,
+        save_prob_map,
+        load_prob_map,
+        parse_param_grid,
+        replay_prob_map,
+    )
+
+    assert parse_param_grid('bin_thresh=0.2,0.3; use_dilation=true') == [
+        {'bin_thresh': 0.2, 'use_dilation': True},
+        {'bin_thresh': 0.3, 'use_dilation': True},
+    ]
+
+    prob = np.full((128, 256), 0.05, dtype=np.float32)
+    prob[20:40, 20:120] = 0.9
+    prob[70:90, 60:220] = 0.7
+    prob_maps = {
+        'cnstd': dict(
+            map=quantize_prob_map(prob),
+            detector='cnstd',
+            image_shape=[256, 512],
+            compress_ratio=[1.0, 1.0],
+            params=dict(
+                box_score_thresh=0.3,
+                min_box_size=8,
+                bin_thresh=0.3,
+                box_thresh=0.1,
+                unclip_ratio=1.5,
+                kernel_size=None,
+                rotated_bbox=False,
+                auto_rotate_whole_image=False,
+            ),
+        ),
+        'ppocr': dict(
+            map=quantize_prob_map(prob),
+            detector='ppocr',
+            image_shape=[256, 512],
+            shape_list=[256.0, 512.0, 0.5, 0.5],
+            params=dict(
+                box_score_thresh=0.3,
+                min_box_size=4,
+                bin_thresh=0.3,
+                unclip_ratio=1.5,
+                use_dilation=False,
+                kernel_size=2,
+                score_mode='fast',
+                max_candidates=1000,
+            ),
+        ),
+    }
+    for detector, prob_map in prob_maps.items():
+        fp = tmp_path / ('%s.npz' % detector)
+        save_prob_map(fp, prob_map)
+        prob_map = load_prob_map(fp)
+        np.testing.assert_array_equal(prob_map['map'], prob_maps[detector]['map'])
+
+        out = replay_prob_map(prob_map)
+        assert len(out['detected_texts']) == 2
+        # boxes are in the coordinates of the original image, twice as large as the map
+        boxes = np.stack([info['box'] for info in out['detected_texts']])
+        assert boxes[:, :, 0].max() > 256
+        assert len(replay_prob_map(prob_map, box_score_thresh=0.8)['detected_texts']) == 1
+        assert len(replay_prob_map(prob_map, bin_thresh=0.95)['detected_texts']) == 0